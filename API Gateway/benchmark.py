@@ -0,0 +1,191 @@
+"""
+Нагрузочный тест API Gateway.
+
+По умолчанию шлюз из main.py запускается в том же процессе, а Auth Service, Matching Service,
+WebSocket Manager и Message Service заменяются заглушками, которые отвечают через ASGI без сети.
+Так измеряются задержка и пропускная способность самого шлюза: балансировка, проверка токенов,
+проксирование и ограничения. С параметром --gateway-url нагрузка подается на уже запущенный шлюз.
+
+Запуск из каталога API Gateway:
+
+    python benchmark.py --concurrency 50 --requests 5000
+"""
+import argparse
+import asyncio
+import json
+import logging
+import time
+from typing import Dict, List, Optional
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+import main
+
+# Маршруты шлюза, которые можно нагружать: метод и функция, формирующая параметры запроса по номеру запроса
+ROUTES = {
+    'login': ('POST', '/login', lambda n: {'json': {'email': f'user{n}@example.com', 'password': 'password'}}),
+    'token_login': ('POST', '/token_login', lambda n: {'json': {'token': 'token', 'uid': str(n % 1000)}}),
+    'token_check': ('GET', '/token_check', lambda n: {'params': {'token': 'token', 'uid': str(n % 1000)}}),
+    'matching': ('POST', '/matching', lambda n: {'json': {'token': 'token', 'uid': str(n % 1000)}}),
+    'get_websocket_handler': ('POST', '/get_websocket_handler',
+                              lambda n: {'json': {'token': 'token', 'uid': str(n % 1000)}}),
+}
+
+
+def create_stub_service(name: str, delay: float) -> FastAPI:
+    """
+    Создает заглушку сервиса, которая отвечает на любые запросы после заданной задержки.
+
+    Заглушка Auth Service подтверждает любой токен, а заглушка WebSocket Manager сообщает нулевую загрузку обработчиков.
+
+    :param name: Название сервиса.
+    :param delay: Задержка ответа в секундах.
+    :return: Приложение FastAPI.
+    """
+    stub = FastAPI(title=f"{name} stub")
+
+    @stub.api_route("/{path:path}", methods=['GET', 'POST'])
+    async def respond(path: str, request: Request):
+        if delay:
+            await asyncio.sleep(delay)
+        if path == 'handler_loads':
+            return JSONResponse({'loads': {}})
+        if path == 'matching':
+            return JSONResponse({'partner_uid': '100000000000'})
+        if path in ('login', 'token_login', 'register'):
+            return JSONResponse({'uid': '100000000000', 'access_token': 'token', 'refresh_token': 'token'})
+        return JSONResponse({'detail': 'ok'})
+
+    return stub
+
+
+def attach_stub_services(instances: int, delay: float):
+    """
+    Подменяет экземпляры сервисов шлюза заглушками, работающими в том же процессе.
+
+    Ограничения частоты запросов отключаются, так как весь трафик теста идет от одного клиента.
+
+    :param instances: Число экземпляров каждого сервиса.
+    :param delay: Задержка ответа заглушек в секундах.
+    """
+    main.RATE_LIMITS = {}
+    for service_name in main.services:
+        urls = [{'url': f"http://{service_name}-{index}", 'id': f"{service_name}-{index}"} for index in range(instances)]
+        main.services[service_name] = main.init_service(urls, main.service_strategy(service_name))
+        transport = httpx.ASGITransport(app=create_stub_service(service_name, delay))
+        main.upstream_clients[service_name] = httpx.AsyncClient(transport=transport)
+
+
+def percentile(ordered: List[float], fraction: float) -> float:
+    """
+    Возвращает перцентиль отсортированного списка задержек.
+
+    :param ordered: Отсортированные задержки.
+    :param fraction: Доля от 0 до 1.
+    :return: Значение перцентиля или 0.0 для пустого списка.
+    """
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def drive_route(client: httpx.AsyncClient, route: str, total: int, concurrency: int) -> Dict:
+    """
+    Отправляет total запросов к маршруту шлюза, поддерживая concurrency одновременных запросов.
+
+    :param client: HTTP клиент, подключенный к шлюзу.
+    :param route: Название маршрута из ROUTES.
+    :param total: Общее число запросов.
+    :param concurrency: Число одновременных запросов.
+    :return: Словарь с числом запросов в секунду, перцентилями задержки в миллисекундах и статусами ответов.
+    """
+    method, path, make_params = ROUTES[route]
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+    counter = iter(range(total))
+
+    async def worker():
+        for n in counter:
+            started = time.perf_counter()
+            try:
+                response = await client.request(method, path, **make_params(n))
+                status = str(response.status_code)
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - started)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    ordered = sorted(latencies)
+    return {
+        'requests': total,
+        'rps': total / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(ordered, 0.50) * 1000,
+        'p95_ms': percentile(ordered, 0.95) * 1000,
+        'p99_ms': percentile(ordered, 0.99) * 1000,
+        'statuses': statuses
+    }
+
+
+async def run_benchmark(routes: List[str], total: int, concurrency: int, instances: int = 2,
+                        upstream_delay: float = 0.0, gateway_url: Optional[str] = None) -> Dict[str, Dict]:
+    """
+    Выполняет нагрузочный тест маршрутов шлюза по очереди.
+
+    :param routes: Названия маршрутов из ROUTES.
+    :param total: Число запросов к каждому маршруту.
+    :param concurrency: Число одновременных запросов.
+    :param instances: Число экземпляров каждого сервиса-заглушки.
+    :param upstream_delay: Задержка ответа заглушек в секундах.
+    :param gateway_url: URL запущенного шлюза или None для шлюза в том же процессе.
+    :return: Результаты по каждому маршруту.
+    """
+    if gateway_url:
+        client = httpx.AsyncClient(base_url=gateway_url, limits=httpx.Limits(max_connections=concurrency))
+    else:
+        attach_stub_services(instances, upstream_delay)
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://gateway")
+    try:
+        return {route: await drive_route(client, route, total, concurrency) for route in routes}
+    finally:
+        await client.aclose()
+        if not gateway_url:
+            for upstream_client in main.upstream_clients.values():
+                await upstream_client.aclose()
+
+
+def print_report(results: Dict[str, Dict]):
+    """
+    Выводит результаты нагрузочного теста таблицей.
+
+    :param results: Результаты по каждому маршруту.
+    """
+    print(f"{'маршрут':<24}{'запросов':>10}{'RPS':>10}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}  статусы")
+    for route, result in results.items():
+        print(f"{route:<24}{result['requests']:>10}{result['rps']:>10.0f}{result['p50_ms']:>10.2f}"
+              f"{result['p95_ms']:>10.2f}{result['p99_ms']:>10.2f}  {result['statuses']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочный тест API Gateway")
+    parser.add_argument('--routes', default=','.join(ROUTES), help="Маршруты через запятую")
+    parser.add_argument('--requests', type=int, default=2000, help="Число запросов к каждому маршруту")
+    parser.add_argument('--concurrency', type=int, default=20, help="Число одновременных запросов")
+    parser.add_argument('--instances', type=int, default=2, help="Число экземпляров каждого сервиса-заглушки")
+    parser.add_argument('--upstream-delay', type=float, default=0.0, help="Задержка ответа заглушек в секундах")
+    parser.add_argument('--gateway-url', help="URL запущенного шлюза вместо шлюза в том же процессе")
+    parser.add_argument('--log-level', default='WARNING', help="Уровень логирования шлюза во время теста")
+    parser.add_argument('--json', action='store_true', help="Вывести результаты в формате JSON")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(args.log_level)
+
+    benchmark_results = asyncio.run(run_benchmark(args.routes.split(','), args.requests, args.concurrency,
+                                                  args.instances, args.upstream_delay, args.gateway_url))
+    if args.json:
+        print(json.dumps(benchmark_results, ensure_ascii=False, indent=4))
+    else:
+        print_report(benchmark_results)
@@ -1,11 +1,22 @@
 import uvicorn
 import os
 import json
-import threading
+import time
+import asyncio
+import hashlib
+import hmac
+import random
+import bisect
+import math
+import socket
+from collections import deque
+import jwt
+import redis.asyncio as redis
+from cachetools import TLRUCache, TTLCache
 from fastapi import FastAPI, Request, HTTPException, Response, Header
 from fastapi.responses import JSONResponse, StreamingResponse
 import httpx
-from typing import Dict, List, Optional
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
 from urllib.parse import urljoin
 from fastapi.responses import HTMLResponse
 import logging
@@ -26,116 +37,1347 @@ HOST = config.get('host', '0.0.0.0')
 PORT = config.get('port', 8500)
 MAX_ATTEMPTS = config.get('max_attempts', 5)
 
+HEALTH_CHECK_INTERVAL = config.get('health_check_interval', 5)
+HEALTH_CHECK_TIMEOUT = config.get('health_check_timeout', 1.0)
+HEALTH_CHECK_FAILURE_THRESHOLD = config.get('health_check_failure_threshold', 3)
+UPSTREAM_MAX_CONNECTIONS = config.get('upstream_max_connections', 100)
+UPSTREAM_MAX_KEEPALIVE_CONNECTIONS = config.get('upstream_max_keepalive_connections', 20)
+UPSTREAM_KEEPALIVE_EXPIRY = config.get('upstream_keepalive_expiry', 30)
+UPSTREAM_HTTP2 = config.get('upstream_http2', False)
+
+TOKEN_VALIDATION_MODE = config.get('token_validation_mode', 'remote')
+JWT_KEY = config.get('jwt_key')
+JWT_ISSUER = config.get('jwt_issuer', 'Random_chats auth service')
+TOKEN_REVOCATION_PATH = config.get('token_revocation_path')
+TOKEN_REVOCATION_REFRESH_INTERVAL = config.get('token_revocation_refresh_interval', 30)
+TOKEN_CACHE_SIZE = config.get('token_cache_size', 10000)
+TOKEN_CACHE_TTL = config.get('token_cache_ttl', 60)
+TOKEN_CACHE_NEGATIVE_TTL = config.get('token_cache_negative_ttl', 5)
+
+BALANCING_STRATEGY = config.get('balancing_strategy', 'round_robin')
+SERVICE_BALANCING_STRATEGIES = config.get('service_balancing_strategies', {})
+EWMA_ALPHA = config.get('ewma_alpha', 0.3)
+
+BREAKER_WINDOW = config.get('breaker_window', 20)
+BREAKER_MIN_CALLS = config.get('breaker_min_calls', 5)
+BREAKER_ERROR_RATE = config.get('breaker_error_rate', 0.5)
+BREAKER_SLOW_CALL_THRESHOLD = config.get('breaker_slow_call_threshold', 2.0)
+BREAKER_OPEN_SECONDS = config.get('breaker_open_seconds', 10)
+RETRY_BUDGET_RATIO = config.get('retry_budget_ratio', 0.2)
+RETRY_BUDGET_MIN_PER_SECOND = config.get('retry_budget_min_per_second', 1)
+RETRY_BUDGET_CAPACITY = config.get('retry_budget_capacity', 50)
+RETRY_BACKOFF_BASE = config.get('retry_backoff_base', 0.05)
+RETRY_BACKOFF_MAX = config.get('retry_backoff_max', 1.0)
+
+REGISTRY_TTL = config.get('registry_ttl', 30)
+REGISTRY_SWEEP_INTERVAL = config.get('registry_sweep_interval', 5)
+REGISTRY_WATCH_TIMEOUT = config.get('registry_watch_timeout', 30)
+DISCOVERY_MAX_AGE = config.get('discovery_max_age', 5)
+REGISTRY_TOKEN = config.get('registry_token')
+
+WEBSOCKET_PLACEMENT = config.get('websocket_placement', 'least_loaded')
+WEBSOCKET_HANDLER_CAPACITY = config.get('websocket_handler_capacity', 10000)
+HANDLER_LOAD_REFRESH_INTERVAL = config.get('handler_load_refresh_interval', 2)
+WEBSOCKET_HASH_KEY = config.get('websocket_hash_key', 'uid')
+CONSISTENT_HASH_REPLICAS = config.get('consistent_hash_replicas', 100)
+CONSISTENT_HASH_LOAD_FACTOR = config.get('consistent_hash_load_factor', 1.25)
+
+RATE_LIMITS = config.get('rate_limits', {})
+RATE_LIMIT_BACKEND = config.get('rate_limit_backend', 'memory')
+RATE_LIMIT_CACHE_SIZE = config.get('rate_limit_cache_size', 100000)
+REDIS_URL = config.get('redis_url', 'redis://localhost:6379/0')
+
+HEDGING_ROUTES = config.get('hedging_routes', [])
+HEDGE_PERCENTILE = config.get('hedge_percentile', 0.95)
+HEDGE_MIN_DELAY = config.get('hedge_min_delay', 0.01)
+HEDGE_MAX_RATE = config.get('hedge_max_rate', 0.05)
+HEDGE_BURST = config.get('hedge_burst', 2)
+HEDGE_WINDOW = config.get('hedge_window', 200)
+HEDGE_MIN_SAMPLES = config.get('hedge_min_samples', 20)
+
+ADMISSION_CONTROL = config.get('admission_control', True)
+ADMISSION_INITIAL_LIMIT = config.get('admission_initial_limit', 50)
+ADMISSION_MIN_LIMIT = config.get('admission_min_limit', 5)
+ADMISSION_MAX_LIMIT = config.get('admission_max_limit', 500)
+ADMISSION_LATENCY_TARGET = config.get('admission_latency_target', 0.5)
+ADMISSION_DECREASE_RATIO = config.get('admission_decrease_ratio', 0.9)
+ADMISSION_LOW_PRIORITY_SHARE = config.get('admission_low_priority_share', 0.8)
+ADMISSION_PRIORITY_ROUTES = config.get('admission_priority_routes', ['/token_login', '/get_websocket_handler'])
+LOGS_MAX_CONCURRENCY = config.get('logs_max_concurrency', 1)
+
+# Объединять можно только пути, ответ которых определяется путем и строкой запроса: остальные заголовки запроса
+# в ключ не входят, а заголовки ответа, включая Set-Cookie, получают все ожидающие клиенты. Authorization и Cookie
+# входят в ключ, поэтому клиенты с разными учетными данными ответами не обмениваются
+COALESCED_ROUTES = config.get('coalesced_routes', ['/token_check'])
+COALESCING_KEY_HEADERS = ('authorization', 'cookie')
+
+WORKERS = config.get('workers', 1)
+SHARED_STATE_BACKEND = config.get('shared_state_backend', 'memory')
+
+if WEBSOCKET_PLACEMENT not in ('round_robin', 'least_loaded', 'consistent_hash'):
+    raise ValueError(f"Неизвестный режим размещения WebSocket подключений: {WEBSOCKET_PLACEMENT}")
+if RATE_LIMIT_BACKEND not in ('memory', 'redis'):
+    raise ValueError(f"Неизвестное хранилище ограничений частоты запросов: {RATE_LIMIT_BACKEND}")
+if SHARED_STATE_BACKEND not in ('memory', 'redis'):
+    raise ValueError(f"Неизвестное хранилище общего состояния: {SHARED_STATE_BACKEND}")
+if WORKERS > 1 and SHARED_STATE_BACKEND != 'redis':
+    raise ValueError("Для нескольких процессов API Gateway должен быть указан shared_state_backend: redis")
+
+# При общем состоянии корзины ограничений частоты запросов тоже хранятся в Redis
+if SHARED_STATE_BACKEND == 'redis':
+    RATE_LIMIT_BACKEND = 'redis'
+if TOKEN_VALIDATION_MODE not in ('remote', 'local'):
+    raise ValueError(f"Неизвестный режим проверки токенов: {TOKEN_VALIDATION_MODE}")
+if TOKEN_VALIDATION_MODE == 'local' and not JWT_KEY:
+    raise ValueError("Для локальной проверки токенов в конфигурации должен быть указан jwt_key")
+
+
+def new_breaker() -> Dict:
+    """
+    Создает автоматический выключатель экземпляра в закрытом состоянии.
+
+    :return: Словарь с состоянием, окном последних результатов, моментом размыкания и началом пробного запроса.
+    """
+    return {'state': 'closed', 'results': deque(maxlen=BREAKER_WINDOW), 'opened_at': None, 'trial_started_at': None}
+
+
+def init_service(instances: List[Dict], strategy: str = 'round_robin') -> Dict:
+    """
+    Создает запись сервиса с таблицей состояния его экземпляров.
+
+    До первой проверки все экземпляры считаются живыми, чтобы шлюз мог обслуживать запросы сразу после запуска.
+
+    :param instances: Список экземпляров сервиса из конфигурации.
+    :param strategy: Название стратегии балансировки нагрузки.
+    :return: Словарь с экземплярами, списком живых экземпляров, таблицей состояния, статистикой запросов,
+        автоматическими выключателями, сроками регистрации, окном задержек для хеджирования,
+        лимитом одновременных запросов и указателем.
+    """
+    return {
+        'instances': instances,
+        'live': list(instances),
+        'health': {instance['url']: {'alive': True, 'latency': None, 'checked_at': None, 'failures': 0} for instance in instances},
+        'stats': {instance['url']: {'in_flight': 0, 'ewma': None} for instance in instances},
+        'breakers': {instance['url']: new_breaker() for instance in instances},
+        'leases': {instance['url']: None for instance in instances},
+        'latencies': deque(maxlen=HEDGE_WINDOW),
+        'hedge_tokens': 1.0,
+        'admission': {'limit': float(ADMISSION_INITIAL_LIMIT), 'admitted': 0, 'decreased_at': 0.0, 'shed': 0},
+        'strategy': strategy,
+        'pointer': 0
+    }
+
+
+def service_strategy(service_name: str) -> str:
+    """
+    Определяет стратегию балансировки нагрузки для сервиса по конфигурации.
+
+    :param service_name: Название сервиса.
+    :return: Название стратегии балансировки.
+    """
+    strategy = SERVICE_BALANCING_STRATEGIES.get(service_name, BALANCING_STRATEGY)
+    if strategy not in ('round_robin', 'least_outstanding', 'p2c_ewma'):
+        raise ValueError(f"Неизвестная стратегия балансировки для {service_name}: {strategy}")
+    return strategy
+
+
 # Инициализация экземпляров сервисов и указателей
 services = {
-    'auth_service': {
-        'instances': config.get('auth_service_instances', []),
-        'pointer': 0,
-        'lock': threading.Lock()
-    },
-    'matching_service': {
-        'instances': config.get('matching_service_instances', []),
-        'pointer': 0,
-        'lock': threading.Lock()
-    },
-    'websocket_handlers': {
-        'instances': config.get('websocket_handlers', []),
-        'pointer': 0,
-        'lock': threading.Lock()
-    },
-    'websocket_manager': {
-        'instances': config.get('websocket_manager_instances', []),
-        'pointer': 0,
-        'lock': threading.Lock()
-    },
-    'message_service': {
-        'instances': config.get('message_service_instances', []),
-        'pointer': 0,
-        'lock': threading.Lock()
+    'auth_service': init_service(config.get('auth_service_instances', []), service_strategy('auth_service')),
+    'matching_service': init_service(config.get('matching_service_instances', []),
+                                     service_strategy('matching_service')),
+    'websocket_handlers': init_service(config.get('websocket_handlers', []), service_strategy('websocket_handlers')),
+    'websocket_manager': init_service(config.get('websocket_manager_instances', []),
+                                      service_strategy('websocket_manager')),
+    'message_service': init_service(config.get('message_service_instances', []), service_strategy('message_service'))
+}
+
+background_tasks: List[asyncio.Task] = []
+
+
+def registry_version() -> int:
+    """
+    Вычисляет версию реестра по содержимому списков живых экземпляров.
+
+    Версия зависит только от набора экземпляров, поэтому совпадает во всех процессах API Gateway с одинаковым
+    реестром и не начинается заново после перезапуска: ETag и версия для long-poll, выданные одним процессом,
+    верны и для остальных.
+
+    :return: Неотрицательное целое число меньше 2^52.
+    """
+    live = {service_name: service['live'] for service_name, service in services.items()}
+    digest = hashlib.sha256(json.dumps(live, sort_keys=True).encode()).hexdigest()
+    return int(digest[:13], 16)
+
+
+# Версия реестра экземпляров меняется при каждом изменении набора живых экземпляров
+registry = {'version': registry_version(), 'changed': asyncio.Event()}
+
+# Бюджет повторных попыток, общий для всех сервисов
+retry_budget = {'tokens': float(RETRY_BUDGET_CAPACITY), 'updated_at': time.monotonic()}
+
+# Число подключенных пользователей по ID WebSocket Handler, по данным WebSocket Manager
+handler_loads: Dict[str, int] = {}
+
+# Кольцо согласованного хеширования WebSocket Handler, перестраивается при изменении набора живых обработчиков
+hash_ring = {'urls': (), 'points': [], 'owners': []}
+
+# Корзины токенов ограничения частоты запросов: (маршрут, клиент) -> [токены, время обновления].
+# Запись живет не дольше времени полного пополнения корзины, после которого она все равно была бы полной
+rate_limit_buckets = TTLCache(
+    maxsize=RATE_LIMIT_CACHE_SIZE,
+    ttl=max([limit['burst'] / limit['rate'] for limit in RATE_LIMITS.values()] or [1]),
+    timer=time.monotonic
+)
+
+# Клиент Redis создается только для общего состояния процессов и ограничений частоты запросов
+redis_client = redis.from_url(REDIS_URL) if RATE_LIMIT_BACKEND == 'redis' else None
+
+# Атомарное списание токена из корзины в Redis; возвращает признак разрешения и время до появления токена
+RATE_LIMIT_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(now - ts, 0) * rate)
+local allowed = 0
+local retry_after = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    retry_after = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+return {allowed, tostring(retry_after)}
+"""
+
+# Идентификатор процесса API Gateway для аренды фоновой проверки экземпляров в общем состоянии
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# Отпечатки отозванных токенов, периодически загружаемые из Auth Service
+revoked_tokens: Set[str] = set()
+
+# Кэш результатов проверки токенов в Auth Service: (uid, отпечаток токена) -> (действителен, момент истечения)
+token_cache = TLRUCache(maxsize=TOKEN_CACHE_SIZE, ttu=lambda key, value, now: value[1], timer=time.time)
+token_cache_stats = {'hits': 0, 'misses': 0, 'negative_hits': 0}
+
+# Заголовки уровня соединения, которые не передаются через прокси (RFC 7230, раздел 6.1)
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+                      'te', 'trailer', 'transfer-encoding', 'upgrade', 'host', 'content-length'}
+
+# Тело ответа передается без перекодирования, поэтому content-encoding и content-length сохраняются
+RESPONSE_EXCLUDED_HEADERS = HOP_BY_HOP_HEADERS - {'content-length'}
+
+# Долгоживущие HTTP клиенты с пулом соединений, по одному на сервис
+upstream_clients: Dict[str, httpx.AsyncClient] = {}
+
+# Выполняющиеся обращения к сервисам, к результату которых присоединяются одинаковые запросы
+inflight_calls: Dict[Tuple, asyncio.Future] = {}
+coalescing_stats = {'leaders': 0, 'coalesced': 0}
+
+# Число одновременно выполняемых запросов /logs
+logs_readers = {'active': 0}
+
+app = FastAPI(title="API Gateway")
+
+logging.basicConfig(level=logging.INFO,
+                    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+                    handlers=[
+                        logging.StreamHandler(),
+                        logging.FileHandler(log_file, mode='a')
+                    ])
+logger = logging.getLogger("API Gateway")
+
+
+def create_upstream_client() -> httpx.AsyncClient:
+    """
+    Создает HTTP клиент с пулом keep-alive соединений к экземплярам сервиса.
+
+    :return: Клиент httpx.AsyncClient с лимитами пула из конфигурации.
+    """
+    limits = httpx.Limits(max_connections=UPSTREAM_MAX_CONNECTIONS,
+                          max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE_CONNECTIONS,
+                          keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY)
+    try:
+        return httpx.AsyncClient(limits=limits, http2=UPSTREAM_HTTP2)
+    except ImportError:
+        logger.warning("Пакет h2 не установлен, соединения с сервисами будут использовать HTTP/1.1")
+        return httpx.AsyncClient(limits=limits)
+
+
+def get_upstream_client(service_name: str) -> httpx.AsyncClient:
+    """
+    Возвращает общий HTTP клиент сервиса, создавая его при первом обращении.
+
+    :param service_name: Название сервиса.
+    :return: Клиент httpx.AsyncClient, переиспользующий соединения между запросами.
+    """
+    client = upstream_clients.get(service_name)
+    if client is None or client.is_closed:
+        client = create_upstream_client()
+        upstream_clients[service_name] = client
+    return client
+
+
+class CreateRequest(BaseModel):
+    token: str
+    uid: str
+
+
+class InstanceRegistration(BaseModel):
+    service_name: str
+    url: str
+    id: Optional[str] = None
+    ttl: Optional[float] = None
+
+
+class InstanceHeartbeat(BaseModel):
+    service_name: str
+    url: str
+    ttl: Optional[float] = None
+
+
+def update_live_instances(service: Dict):
+    """
+    Пересобирает список живых экземпляров сервиса по таблице состояния.
+
+    :param service: Запись сервиса из словаря services.
+    """
+    live = [instance for instance in service['instances'] if service['health'][instance['url']]['alive']]
+    if live != service['live']:
+        service['live'] = live
+        bump_registry_version()
+
+
+def bump_registry_version():
+    """
+    Пересчитывает версию реестра и, если она изменилась, будит запросы, ожидающие изменений.
+    """
+    version = registry_version()
+    if version == registry['version']:
+        return
+    registry['version'] = version
+    registry['changed'].set()
+    registry['changed'] = asyncio.Event()
+
+
+def registry_snapshot() -> Dict:
+    """
+    Формирует снимок реестра с живыми экземплярами всех сервисов.
+
+    :return: Словарь с версией реестра и списками живых экземпляров по сервисам.
+    """
+    return {
+        'version': registry['version'],
+        'services': {service_name: service['live'] for service_name, service in services.items()}
     }
+
+
+def add_instance(service_name: str, instance: Dict, expires_at: Optional[float]):
+    """
+    Добавляет экземпляр в реестр или продлевает срок его регистрации.
+
+    :param service_name: Название сервиса. Неизвестный сервис создается.
+    :param instance: Экземпляр сервиса с url и, при наличии, id.
+    :param expires_at: Момент истечения регистрации по монотонным часам или None для бессрочной.
+    """
+    if service_name not in services:
+        services[service_name] = init_service([], service_strategy(service_name))
+    service = services[service_name]
+    url = instance['url']
+    if url in service['leases']:
+        if service['leases'][url] is None:
+            return  # Экземпляры из конфигурации не переопределяются регистрацией
+        service['leases'][url] = expires_at
+        existing = next(item for item in service['instances'] if item['url'] == url)
+        if existing != instance:
+            existing.clear()
+            existing.update(instance)
+            bump_registry_version()
+        return
+    logger.info(f"Экземпляр {url} сервиса {service_name} зарегистрирован")
+    service['instances'].append(instance)
+    service['health'][url] = {'alive': True, 'latency': None, 'checked_at': None, 'failures': 0}
+    service['stats'][url] = {'in_flight': 0, 'ewma': None}
+    service['breakers'][url] = new_breaker()
+    service['leases'][url] = expires_at
+    update_live_instances(service)
+
+
+def remove_instance(service_name: str, url: str) -> bool:
+    """
+    Удаляет экземпляр из реестра.
+
+    :param service_name: Название сервиса.
+    :param url: URL экземпляра.
+    :return: True, если экземпляр был зарегистрирован.
+    """
+    service = services.get(service_name)
+    if not service or url not in service['leases']:
+        return False
+    logger.info(f"Экземпляр {url} сервиса {service_name} удален из реестра")
+    service['instances'] = [instance for instance in service['instances'] if instance['url'] != url]
+    for table in ('health', 'stats', 'breakers', 'leases'):
+        service[table].pop(url, None)
+    update_live_instances(service)
+    return True
+
+
+def expire_instances():
+    """
+    Удаляет из реестра экземпляры, не приславшие heartbeat до истечения срока регистрации.
+    """
+    now = time.monotonic()
+    for service_name, service in list(services.items()):
+        for url, expires_at in list(service['leases'].items()):
+            if expires_at is not None and expires_at <= now:
+                logger.warning(f"Срок регистрации экземпляра {url} сервиса {service_name} истек")
+                remove_instance(service_name, url)
+
+
+def shared_instance_key(service_name: str, url: str) -> str:
+    """
+    Формирует ключ регистрации экземпляра в Redis.
+
+    :param service_name: Название сервиса.
+    :param url: URL экземпляра.
+    :return: Ключ Redis.
+    """
+    return f"gateway:instance:{service_name}:{url}"
+
+
+async def sync_shared_registry():
+    """
+    Загружает из Redis регистрации экземпляров, полученные любым процессом API Gateway.
+
+    Экземпляры, регистрация которых в Redis истекла или удалена, удаляются из локального реестра.
+    """
+    keys = [key async for key in redis_client.scan_iter(match='gateway:instance:*')]
+    pipe = redis_client.pipeline()
+    for key in keys:
+        pipe.get(key)
+        pipe.pttl(key)
+    values = await pipe.execute() if keys else []
+    now = time.monotonic()
+    shared = set()
+    for raw, ttl in zip(values[::2], values[1::2]):
+        if raw is None or ttl <= 0:
+            continue
+        registration = json.loads(raw)
+        shared.add((registration['service_name'], registration['instance']['url']))
+        add_instance(registration['service_name'], registration['instance'], now + ttl / 1000)
+    for service_name, service in list(services.items()):
+        for url, expires_at in list(service['leases'].items()):
+            if expires_at is not None and (service_name, url) not in shared:
+                remove_instance(service_name, url)
+
+
+async def registry_monitor():
+    """
+    Фоновая задача, периодически удаляющая экземпляры с истекшей регистрацией.
+
+    При общем состоянии в Redis реестр предварительно синхронизируется с регистрациями других процессов.
+    """
+    while True:
+        await asyncio.sleep(REGISTRY_SWEEP_INTERVAL)
+        if SHARED_STATE_BACKEND == 'redis':
+            try:
+                await sync_shared_registry()
+            except Exception as e:
+                logger.error(f"Ошибка синхронизации реестра с Redis: {e}")
+        expire_instances()
+
+
+def mark_instance_dead(service_name: str, instance: Dict):
+    """
+    Учитывает ошибку запроса к экземпляру и помечает его неработающим до следующей успешной проверки фоновым
+    монитором, если ошибок подряд набралось health_check_failure_threshold.
+
+    :param service_name: Название сервиса.
+    :param instance: Экземпляр сервиса, запрос к которому завершился ошибкой.
+    """
+    service = services[service_name]
+    state = service['health'].get(instance['url'])
+    if state is None:
+        return
+    state['failures'] += 1
+    if state['alive'] and state['failures'] >= HEALTH_CHECK_FAILURE_THRESHOLD:
+        logger.warning(f"Экземпляр {instance['url']} сервиса {service_name} помечен как недоступный")
+        state['alive'] = False
+        update_live_instances(service)
+
+
+async def probe_instance(service_name: str, instance: Dict):
+    """
+    Проверяет доступность экземпляра сервиса и записывает результат в таблицу состояния.
+
+    Успешная проверка сбрасывает счетчик ошибок, а неработающим экземпляр считается после
+    health_check_failure_threshold ошибок подряд, чтобы одна медленная проверка не исключала его из балансировки.
+
+    :param service_name: Название сервиса.
+    :param instance: Экземпляр сервиса.
+    """
+    url = urljoin(instance['url'], "/")
+    started = time.monotonic()
+    try:
+        response = await get_upstream_client(service_name).get(url, timeout=HEALTH_CHECK_TIMEOUT)
+        alive = response.status_code == 200
+    except Exception:
+        alive = False
+    state = services[service_name]['health'].get(instance['url'])
+    if state is None:
+        return  # Экземпляр удален из реестра во время проверки
+    if alive:
+        state['failures'] = 0
+        state['latency'] = time.monotonic() - started
+    else:
+        state['failures'] += 1
+        if state['failures'] < HEALTH_CHECK_FAILURE_THRESHOLD:
+            logger.warning(f"Проверка экземпляра {instance['url']} сервиса {service_name} не прошла "
+                           f"({state['failures']} из {HEALTH_CHECK_FAILURE_THRESHOLD})")
+            alive = state['alive']
+        else:
+            state['latency'] = None
+    if state['alive'] != alive:
+        logger.info(f"Экземпляр {instance['url']} сервиса {service_name} {'доступен' if alive else 'недоступен'}")
+    state['alive'] = alive
+    state['checked_at'] = time.time()
+
+
+async def publish_shared_health():
+    """
+    Сохраняет таблицу состояния экземпляров в Redis для остальных процессов API Gateway.
+    """
+    health = {f"{service_name}|{url}": json.dumps(state)
+              for service_name, service in services.items() for url, state in service['health'].items()}
+    if health:
+        pipe = redis_client.pipeline()
+        pipe.hset('gateway:health', mapping=health)
+        pipe.expire('gateway:health', max(int(HEALTH_CHECK_INTERVAL * 3), 1))
+        await pipe.execute()
+
+
+async def load_shared_health():
+    """
+    Загружает из Redis таблицу состояния экземпляров, заполненную другим процессом API Gateway.
+    """
+    health = await redis_client.hgetall('gateway:health')
+    for field, raw in health.items():
+        service_name, url = field.decode().split('|', 1)
+        service = services.get(service_name)
+        if service and url in service['health']:
+            service['health'][url].update(json.loads(raw))
+    for service in services.values():
+        update_live_instances(service)
+
+
+async def check_all_instances():
+    """
+    Параллельно проверяет все экземпляры всех сервисов и обновляет списки живых экземпляров.
+
+    При общем состоянии в Redis проверку за интервал выполняет только процесс, получивший аренду,
+    остальные загружают его результаты. Если Redis недоступен, процесс проверяет экземпляры сам.
+    """
+    if SHARED_STATE_BACKEND == 'redis':
+        try:
+            if not await redis_client.set('gateway:health_lease', WORKER_ID, nx=True,
+                                          px=int(HEALTH_CHECK_INTERVAL * 1000)):
+                await load_shared_health()
+                return
+        except Exception as e:
+            logger.error(f"Ошибка чтения общего состояния экземпляров из Redis: {e}")
+
+    await asyncio.gather(*(probe_instance(service_name, instance)
+                           for service_name, service in services.items()
+                           for instance in service['instances']))
+    for service in services.values():
+        update_live_instances(service)
+    if SHARED_STATE_BACKEND == 'redis':
+        try:
+            await publish_shared_health()
+        except Exception as e:
+            logger.error(f"Ошибка сохранения состояния экземпляров в Redis: {e}")
+
+
+async def health_monitor():
+    """
+    Фоновая задача, периодически проверяющая состояние экземпляров сервисов.
+    """
+    while True:
+        await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+        try:
+            await check_all_instances()
+        except Exception as e:
+            logger.error(f"Ошибка фоновой проверки экземпляров: {e}")
+
+
+def token_fingerprint(token: str) -> str:
+    """
+    Вычисляет отпечаток токена для списка отзыва, чтобы не хранить сами токены.
+
+    :param token: JWT токен.
+    :return: SHA-256 от токена в шестнадцатеричном виде.
+    """
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+async def refresh_revoked_tokens():
+    """
+    Загружает из Auth Service список отозванных токенов: их идентификаторов (jti) или отпечатков.
+
+    При ошибке сохраняется ранее загруженный список.
+    """
+    instance = await get_work_instance('auth_service')
+    if instance is None:
+        logger.warning("Нет доступных экземпляров auth_service для загрузки списка отозванных токенов")
+        return
+    url = urljoin(instance['url'], TOKEN_REVOCATION_PATH)
+    try:
+        response = await get_upstream_client('auth_service').get(url, timeout=5)
+        if response.status_code == 200:
+            global revoked_tokens
+            revoked_tokens = set(response.json().get('revoked', []))
+        else:
+            logger.warning(f"Не удалось загрузить список отозванных токенов: {response.status_code}")
+    except Exception as e:
+        logger.error(f"Ошибка при загрузке списка отозванных токенов: {e}")
+
+
+async def revocation_monitor():
+    """
+    Фоновая задача, периодически обновляющая список отозванных токенов.
+    """
+    while True:
+        await asyncio.sleep(TOKEN_REVOCATION_REFRESH_INTERVAL)
+        await refresh_revoked_tokens()
+
+
+async def refresh_handler_loads():
+    """
+    Загружает из WebSocket Manager число подключенных пользователей на каждом WebSocket Handler.
+
+    При ошибке сохраняются ранее загруженные значения.
+    """
+    instance = await get_work_instance('websocket_manager')
+    if instance is None:
+        return
+    handler_ids = [handler['id'] for handler in services['websocket_handlers']['instances'] if handler.get('id')]
+    url = urljoin(instance['url'], '/handler_loads')
+    try:
+        response = await get_upstream_client('websocket_manager').get(
+            url, params={'handler_ids': ','.join(handler_ids)}, timeout=HEALTH_CHECK_TIMEOUT)
+        if response.status_code == 200:
+            handler_loads.clear()
+            handler_loads.update(response.json().get('loads', {}))
+        else:
+            logger.warning(f"Не удалось получить нагрузку WebSocket Handler: {response.status_code}")
+    except Exception as e:
+        logger.error(f"Ошибка при получении нагрузки WebSocket Handler: {e}")
+
+
+async def handler_load_monitor():
+    """
+    Фоновая задача, периодически обновляющая нагрузку WebSocket Handler.
+    """
+    while True:
+        await asyncio.sleep(HANDLER_LOAD_REFRESH_INTERVAL)
+        await refresh_handler_loads()
+
+
+@app.on_event("startup")
+async def startup_event():
+    """Создание пулов соединений, первичная проверка экземпляров и запуск фоновых задач."""
+    for service_name in services:
+        get_upstream_client(service_name)
+    await check_all_instances()
+    background_tasks.append(asyncio.create_task(health_monitor()))
+    background_tasks.append(asyncio.create_task(registry_monitor()))
+    if WEBSOCKET_PLACEMENT != 'round_robin':
+        await refresh_handler_loads()
+        background_tasks.append(asyncio.create_task(handler_load_monitor()))
+    if TOKEN_VALIDATION_MODE == 'local' and TOKEN_REVOCATION_PATH:
+        await refresh_revoked_tokens()
+        background_tasks.append(asyncio.create_task(revocation_monitor()))
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Остановка фоновых задач и закрытие пулов соединений при завершении работы приложения."""
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+    for client in upstream_clients.values():
+        await client.aclose()
+    upstream_clients.clear()
+    if redis_client is not None:
+        await redis_client.aclose()
+
+
+def pick_round_robin(service: Dict, live: List[Dict]) -> Dict:
+    """
+    Выбирает живые экземпляры сервиса по очереди.
+
+    :param service: Запись сервиса из словаря services.
+    :param live: Непустой список живых экземпляров.
+    :return: Выбранный экземпляр.
+    """
+    pointer = service['pointer'] % len(live)
+    service['pointer'] = pointer + 1
+    return live[pointer]
+
+
+async def pick_shared_round_robin(service_name: str, service: Dict, live: List[Dict]) -> Dict:
+    """
+    Выбирает живые экземпляры сервиса по очереди с общим для всех процессов указателем в Redis.
+
+    Если Redis недоступен, используется локальный указатель процесса.
+
+    :param service_name: Название сервиса.
+    :param service: Запись сервиса из словаря services.
+    :param live: Непустой список живых экземпляров.
+    :return: Выбранный экземпляр.
+    """
+    try:
+        pointer = await redis_client.incr(f"gateway:rr:{service_name}")
+    except Exception as e:
+        logger.error(f"Ошибка получения общего указателя балансировки из Redis: {e}")
+        return pick_round_robin(service, live)
+    return live[pointer % len(live)]
+
+
+def pick_least_outstanding(service: Dict, live: List[Dict]) -> Dict:
+    """
+    Выбирает живой экземпляр с наименьшим числом незавершенных запросов.
+
+    Перебор начинается с позиции указателя, чтобы при равенстве нагрузка распределялась по очереди.
+
+    :param service: Запись сервиса из словаря services.
+    :param live: Непустой список живых экземпляров.
+    :return: Выбранный экземпляр.
+    """
+    pointer = service['pointer'] % len(live)
+    service['pointer'] = pointer + 1
+    rotated = live[pointer:] + live[:pointer]
+    return min(rotated, key=lambda instance: service['stats'][instance['url']]['in_flight'])
+
+
+def instance_cost(service: Dict, instance: Dict) -> float:
+    """
+    Оценивает ожидаемую задержку запроса к экземпляру с учетом уже выполняющихся на нем запросов.
+
+    :param service: Запись сервиса из словаря services.
+    :param instance: Экземпляр сервиса.
+    :return: Экспоненциально сглаженная задержка, умноженная на число запросов в очереди вместе с новым.
+    """
+    stats = service['stats'][instance['url']]
+    latency = stats['ewma'] or service['health'][instance['url']]['latency'] or 0.0
+    return latency * (stats['in_flight'] + 1)
+
+
+def pick_p2c_ewma(service: Dict, live: List[Dict]) -> Dict:
+    """
+    Выбирает из двух случайных живых экземпляров тот, у которого ниже ожидаемая задержка (power of two choices).
+
+    :param service: Запись сервиса из словаря services.
+    :param live: Непустой список живых экземпляров.
+    :return: Выбранный экземпляр.
+    """
+    if len(live) == 1:
+        return live[0]
+    first, second = random.sample(live, 2)
+    return first if instance_cost(service, first) <= instance_cost(service, second) else second
+
+
+BALANCING_STRATEGIES = {
+    'round_robin': pick_round_robin,
+    'least_outstanding': pick_least_outstanding,
+    'p2c_ewma': pick_p2c_ewma
 }
 
-app = FastAPI(title="API Gateway")
 
-logging.basicConfig(level=logging.INFO,
-                    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-                    handlers=[
-                        logging.StreamHandler(),
-                        logging.FileHandler(log_file, mode='a')
-                    ])
-logger = logging.getLogger("API Gateway")
+def acquire_instance(service_name: str, instance: Dict) -> float:
+    """
+    Учитывает начало запроса к экземпляру сервиса.
+
+    :param service_name: Название сервиса.
+    :param instance: Экземпляр сервиса.
+    :return: Момент начала запроса по монотонным часам.
+    """
+    stats = services[service_name]['stats'].get(instance['url'])
+    if stats is not None:
+        stats['in_flight'] += 1
+    return time.monotonic()
+
+
+def release_instance(service_name: str, instance: Dict, latency: Optional[float] = None):
+    """
+    Учитывает завершение запроса к экземпляру сервиса и обновляет сглаженную задержку.
+
+    :param service_name: Название сервиса.
+    :param instance: Экземпляр сервиса.
+    :param latency: Задержка ответа в секундах или None, если запрос завершился ошибкой.
+    """
+    stats = services[service_name]['stats'].get(instance['url'])
+    if stats is None:
+        return
+    stats['in_flight'] = max(stats['in_flight'] - 1, 0)
+    if latency is not None:
+        stats['ewma'] = latency if stats['ewma'] is None else EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * stats['ewma']
+        services[service_name]['latencies'].append(latency)
+
+
+def breaker_allows(service: Dict, instance: Dict) -> bool:
+    """
+    Проверяет, пропускает ли автоматический выключатель запросы к экземпляру.
+
+    Разомкнутый выключатель по истечении breaker_open_seconds переходит в полуоткрытое состояние
+    и пропускает один пробный запрос.
+
+    :param service: Запись сервиса из словаря services.
+    :param instance: Экземпляр сервиса.
+    :return: True, если запрос к экземпляру разрешен.
+    """
+    breaker = service['breakers'].get(instance['url'])
+    if breaker is None or breaker['state'] == 'closed':
+        return True
+    now = time.monotonic()
+    if breaker['state'] == 'open':
+        if now - breaker['opened_at'] < BREAKER_OPEN_SECONDS:
+            return False
+        breaker['state'] = 'half_open'
+        breaker['trial_started_at'] = None
+    # Пробный запрос, результат которого так и не пришел, не должен блокировать экземпляр навсегда
+    trial_started_at = breaker['trial_started_at']
+    return trial_started_at is None or now - trial_started_at >= BREAKER_OPEN_SECONDS
+
+
+def record_result(service_name: str, instance: Dict, success: bool, latency: Optional[float] = None):
+    """
+    Записывает результат запроса к экземпляру в его автоматический выключатель.
+
+    Медленный ответ (дольше breaker_slow_call_threshold) считается ошибкой. Выключатель размыкается,
+    когда доля ошибок в окне из breaker_window последних запросов достигает breaker_error_rate.
+
+    :param service_name: Название сервиса.
+    :param instance: Экземпляр сервиса.
+    :param success: True, если экземпляр ответил без ошибки сервера.
+    :param latency: Задержка ответа в секундах.
+    """
+    update_concurrency_limit(service_name, not success or (latency is not None and latency > ADMISSION_LATENCY_TARGET))
+    breaker = services[service_name]['breakers'].get(instance['url'])
+    if breaker is None:
+        return
+    failed = not success or (latency is not None and latency > BREAKER_SLOW_CALL_THRESHOLD)
+    if breaker['state'] == 'half_open':
+        if failed:
+            open_breaker(service_name, instance, breaker)
+        else:
+            logger.info(f"Автоматический выключатель экземпляра {instance['url']} сервиса {service_name} замкнут")
+            breaker['state'] = 'closed'
+            breaker['results'].clear()
+            breaker['trial_started_at'] = None
+        return
+
+    breaker['results'].append(failed)
+    results = breaker['results']
+    if breaker['state'] == 'closed' and len(results) >= BREAKER_MIN_CALLS \
+            and sum(results) / len(results) >= BREAKER_ERROR_RATE:
+        open_breaker(service_name, instance, breaker)
+
+
+def update_concurrency_limit(service_name: str, overloaded: bool):
+    """
+    Подстраивает лимит одновременных запросов к сервису по схеме AIMD.
+
+    Успешный быстрый ответ увеличивает лимит на 1/лимит (примерно на единицу за каждый лимит ответов),
+    ошибка или ответ дольше admission_latency_target уменьшает его в admission_decrease_ratio раз,
+    но не чаще одного раза за admission_latency_target секунд.
+
+    :param service_name: Название сервиса.
+    :param overloaded: True, если ответ указывает на перегрузку сервиса.
+    """
+    admission = services[service_name]['admission']
+    if not overloaded:
+        admission['limit'] = min(ADMISSION_MAX_LIMIT, admission['limit'] + 1 / admission['limit'])
+        return
+    now = time.monotonic()
+    if now - admission['decreased_at'] >= ADMISSION_LATENCY_TARGET:
+        admission['limit'] = max(ADMISSION_MIN_LIMIT, admission['limit'] * ADMISSION_DECREASE_RATIO)
+        admission['decreased_at'] = now
+        logger.warning(f"Лимит одновременных запросов к {service_name} снижен до {admission['limit']:.1f}")
+
+
+def admission_exceeded(service_name: str, path: Optional[str]) -> bool:
+    """
+    Проверяет, достигнут ли лимит одновременных запросов к сервису для запроса с указанным путем.
+
+    Приоритетным путям из admission_priority_routes доступен весь лимит, остальным - доля
+    admission_low_priority_share, поэтому при перегрузке первыми отклоняются менее важные запросы.
+
+    :param service_name: Название сервиса.
+    :param path: Путь входящего запроса.
+    :return: True, если запрос нужно отклонить.
+    """
+    if not ADMISSION_CONTROL:
+        return False
+    service = services[service_name]
+    limit = service['admission']['limit']
+    if path not in ADMISSION_PRIORITY_ROUTES:
+        limit *= ADMISSION_LOW_PRIORITY_SHARE
+    return service['admission']['admitted'] >= limit
+
+
+def admit_request(service_name: str, path: Optional[str]):
+    """
+    Пропускает запрос к сервису, занимая место в лимите одновременных запросов, или сразу отклоняет его,
+    если сервис перегружен.
+
+    Место занимается при допуске, а не при отправке запроса экземпляру, поэтому запросы, которые еще читают тело
+    или ждут выбора экземпляра, тоже учитываются. Занятое место освобождается вызовом release_admission.
+
+    :param service_name: Название сервиса.
+    :param path: Путь входящего запроса.
+    :raises HTTPException: 503, если лимит одновременных запросов к сервису исчерпан.
+    """
+    if admission_exceeded(service_name, path):
+        services[service_name]['admission']['shed'] += 1
+        logger.warning(f"Запрос {path} отклонен: превышен лимит одновременных запросов к {service_name}")
+        raise HTTPException(status_code=503, detail=f"Сервис {service_name} перегружен",
+                            headers={'Retry-After': '1'})
+    services[service_name]['admission']['admitted'] += 1
+
+
+def release_admission(service_name: str):
+    """
+    Освобождает место в лимите одновременных запросов к сервису, занятое admit_request.
+
+    :param service_name: Название сервиса.
+    """
+    admission = services[service_name]['admission']
+    admission['admitted'] = max(0, admission['admitted'] - 1)
+
+
+def open_breaker(service_name: str, instance: Dict, breaker: Dict):
+    """
+    Размыкает автоматический выключатель экземпляра на breaker_open_seconds.
+
+    :param service_name: Название сервиса.
+    :param instance: Экземпляр сервиса.
+    :param breaker: Автоматический выключатель экземпляра.
+    """
+    logger.warning(f"Автоматический выключатель экземпляра {instance['url']} сервиса {service_name} разомкнут")
+    breaker['state'] = 'open'
+    breaker['opened_at'] = time.monotonic()
+    breaker['trial_started_at'] = None
+    breaker['results'].clear()
+
+
+def refill_retry_budget():
+    """
+    Пополняет бюджет повторных попыток на retry_budget_min_per_second за каждую прошедшую секунду.
+    """
+    now = time.monotonic()
+    elapsed = now - retry_budget['updated_at']
+    retry_budget['updated_at'] = now
+    retry_budget['tokens'] = min(RETRY_BUDGET_CAPACITY, retry_budget['tokens'] + elapsed * RETRY_BUDGET_MIN_PER_SECOND)
+
+
+def deposit_retry_budget():
+    """
+    Пополняет бюджет повторных попыток долей retry_budget_ratio за каждый новый запрос.
+    """
+    refill_retry_budget()
+    retry_budget['tokens'] = min(RETRY_BUDGET_CAPACITY, retry_budget['tokens'] + RETRY_BUDGET_RATIO)
+
+
+async def allow_retry(service_name: str, attempt: int) -> bool:
+    """
+    Списывает повторную попытку из бюджета и выжидает экспоненциальную задержку со случайным разбросом.
+
+    :param service_name: Название сервиса.
+    :param attempt: Номер уже выполненной попытки, начиная с 1.
+    :return: True, если повторная попытка разрешена.
+    """
+    refill_retry_budget()
+    if retry_budget['tokens'] < 1:
+        logger.warning(f"Бюджет повторных попыток исчерпан, повтор запроса к {service_name} отменен")
+        return False
+    retry_budget['tokens'] -= 1
+    await asyncio.sleep(random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** (attempt - 1))))
+    return True
+
+
+async def get_work_instance(service_name: str) -> Dict or None:
+    """
+    Получает рабочий экземпляр сервиса с использованием балансировки нагрузки по таблице живых экземпляров.
+
+    Таблица поддерживается фоновым монитором, поэтому выбор экземпляра не требует сетевых запросов.
+
+    :param service_name: Название сервиса.
+    :return: Словарь с информацией об рабочем экземпляре сервиса или None, если все сервисы не работают.
+    """
+    service = services.get(service_name)
+    if not service or not service['instances']:
+        logger.error(f"Нет доступных экземпляров для {service_name}")
+        raise HTTPException(status_code=503, detail=f"Нет доступных экземпляров для {service_name}")
+
+    live = [instance for instance in service['live'] if breaker_allows(service, instance)]
+    if not live:
+        logger.error(f"Ни один экземпляр сервиса {service_name} не работает")
+        return None  # Если ни один экземпляр не работает
+
+    if SHARED_STATE_BACKEND == 'redis' and service['strategy'] == 'round_robin':
+        instance = await pick_shared_round_robin(service_name, service, live)
+    else:
+        instance = BALANCING_STRATEGIES[service['strategy']](service, live)
+    breaker = service['breakers'].get(instance['url'])
+    if breaker and breaker['state'] == 'half_open':
+        breaker['trial_started_at'] = time.monotonic()
+    return instance
+
+
+def verify_token_locally(token: str, uid: str) -> bool:
+    """
+    Проверяет подпись, издателя, срок действия и владельца JWT токена без обращения к Auth Service.
+
+    :param token: Токен пользователя.
+    :param uid: UID пользователя, которому должен принадлежать токен.
+    :return: True, если токен действителен, иначе False.
+    """
+    try:
+        payload = jwt.decode(token, JWT_KEY, algorithms=['HS256'], issuer=JWT_ISSUER,
+                             options={'require': ['exp', 'iss', 'sub']})
+    except jwt.ExpiredSignatureError:
+        logger.warning(f"Срок действия токена пользователя {uid} истек")
+        return False
+    except jwt.InvalidTokenError as e:
+        logger.warning(f"Токен пользователя {uid} недействителен: {e}")
+        return False
+
+    if payload['sub'] != uid:
+        logger.warning(f"Токен выдан другому пользователю, а не {uid}")
+        return False
+    if revoked_tokens and (payload.get('jti') in revoked_tokens or token_fingerprint(token) in revoked_tokens):
+        logger.warning(f"Токен пользователя {uid} отозван")
+        return False
+    return True
+
+
+async def check_token_remotely(token: str, uid: str, path: Optional[str] = None) -> Optional[bool]:
+    """
+    Проверяет токен, перенаправляя его в Auth Service.
+
+    :param token: Токен пользователя.
+    :param uid: UID пользователя.
+    :param path: Путь входящего запроса, для которого проверяется токен.
+    :return: True или False по ответу Auth Service, None если ни один экземпляр не ответил.
+    :raises HTTPException: 503, если Auth Service перегружен.
+    """
+    service_name = 'auth_service'
+    admit_request(service_name, path)
+    try:
+        return await send_token_check(service_name, token, uid)
+    finally:
+        release_admission(service_name)
+
+
+async def send_token_check(service_name: str, token: str, uid: str) -> Optional[bool]:
+    """
+    Отправляет токен на проверку в экземпляры Auth Service с повторными попытками.
+
+    :param service_name: Название сервиса.
+    :param token: Токен пользователя.
+    :param uid: UID пользователя.
+    :return: True или False по ответу Auth Service, None если ни один экземпляр не ответил.
+    """
+    attempts = 0
+    max_attempts = len(services[service_name]['instances'])
+    deposit_retry_budget()
+    while attempts < max_attempts:
+        instance = await get_work_instance(service_name)
+        if instance is None:
+            break
+        url = urljoin(instance['url'], '/token_check')
+        json_data = {'token': token, 'uid': uid}
+        started = acquire_instance(service_name, instance)
+        latency = None
+        try:
+            client = get_upstream_client(service_name)
+            response = await client.post(url, json=json_data)
+            latency = time.monotonic() - started
+            record_result(service_name, instance, response.status_code < 500, latency)
+            if response.status_code == 200:
+                logger.info(f"Токен пользователя {uid} действителен")
+                return True
+            elif response.status_code < 500:
+                logger.warning(f"Токен пользователя {uid} недействителен. Детали: {response.json().get('detail')}")
+                return False
+            logger.error(f"Ошибка Auth Service при валидации токена пользователя {uid}: {response.status_code}")
+        except Exception as e:
+            logger.error(f"Ошибка при валидации токена пользователя {uid}: {e}")
+            record_result(service_name, instance, False)
+            mark_instance_dead(service_name, instance)
+        finally:
+            release_instance(service_name, instance, latency)
+        attempts += 1
+        if attempts < max_attempts and not await allow_retry(service_name, attempts):
+            break
+    logger.error(f"Не удалось валидировать токен пользователя {uid} после {MAX_ATTEMPTS} попыток")
+    return None
+
+
+def token_cache_expiry(token: str, is_valid: bool) -> float:
+    """
+    Вычисляет момент, до которого результат проверки токена можно брать из кэша.
+
+    Положительный результат хранится не дольше token_cache_ttl и не дольше срока действия самого токена,
+    отрицательный - token_cache_negative_ttl.
+
+    :param token: Токен пользователя.
+    :param is_valid: Результат проверки токена.
+    :return: Время истечения записи в секундах от эпохи.
+    """
+    now = time.time()
+    if not is_valid:
+        return now + TOKEN_CACHE_NEGATIVE_TTL
+    try:
+        exp = jwt.decode(token, options={'verify_signature': False}).get('exp')
+    except jwt.InvalidTokenError:
+        exp = None
+    if exp is None:
+        return now
+    return min(now + TOKEN_CACHE_TTL, float(exp))
+
+
+async def validate_token(token: str, uid: str, path: Optional[str] = None) -> bool:
+    """
+    Проверяет токен локально или перенаправляя его в Auth Service, в зависимости от token_validation_mode.
+
+    Результаты проверки в Auth Service кэшируются по паре (uid, токен), а одновременные проверки
+    одной и той же пары объединяются в один запрос.
+
+    :param token: Токен пользователя.
+    :param uid: UID пользователя.
+    :param path: Путь входящего запроса, используется для приоритизации при перегрузке Auth Service.
+    :return: True, если токен действителен.
+    """
+    logger.info(f"Валидация токена для пользователя {uid} с токеном {token}")
+    if TOKEN_VALIDATION_MODE == 'local':
+        return verify_token_locally(token, uid)
+
+    key = (uid, token_fingerprint(token))
+    cached = token_cache.get(key)
+    if cached is not None:
+        token_cache_stats['hits'] += 1
+        if not cached[0]:
+            token_cache_stats['negative_hits'] += 1
+        return cached[0]
+    token_cache_stats['misses'] += 1
+
+    is_valid = await single_flight(('token_check',) + key, lambda: check_token_remotely(token, uid, path))
+    if is_valid is None:
+        return False
+    token_cache[key] = (is_valid, token_cache_expiry(token, is_valid))
+    return is_valid
+
 
+def handler_capacity(handler: Dict) -> int:
+    """
+    Возвращает максимальное число подключений WebSocket Handler.
 
-class CreateRequest(BaseModel):
-    token: str
-    uid: str
+    :param handler: Экземпляр WebSocket Handler.
+    :return: Значение capacity из описания экземпляра или websocket_handler_capacity.
+    """
+    return handler.get('capacity', WEBSOCKET_HANDLER_CAPACITY)
 
 
-async def get_work_instance(service_name: str) -> Dict or None:
+def ring_hash(key: str) -> int:
     """
-    Получает рабочий экземпляр сервиса с использованием балансировки нагрузки, проверяя доступность каждого экземпляра.
+    Вычисляет позицию ключа на кольце согласованного хеширования.
 
-    :param service_name: Название сервиса.
-    :return: Словарь с информацией об рабочем экземпляре сервиса или None, если все сервисы не работают.
+    :param key: Ключ.
+    :return: Первые 8 байт MD5 ключа как целое число.
     """
-    logger.info(f"Получение рабочего экземпляра для сервиса {service_name}")
-    service = services.get(service_name)
-    if not service or not service['instances']:
-        logger.error(f"Нет доступных экземпляров для {service_name}")
-        raise HTTPException(status_code=503, detail=f"Нет доступных экземпляров для {service_name}")
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
 
-    start_pointer = service['pointer']
-    attempts = 0
-    num_instances = len(service['instances'])
 
-    while attempts < num_instances:
-        instance = service['instances'][(start_pointer + attempts) % num_instances]
-        url = urljoin(instance['url'], "/")
+def get_hash_ring(handlers: List[Dict]) -> Dict:
+    """
+    Возвращает кольцо согласованного хеширования для набора обработчиков, перестраивая его при изменении набора.
 
-        try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(url, timeout=1.0)
-                if response.status_code == 200:
-                    # Если сервис отвечает статусом 200, возвращаем его
-                    service['pointer'] = (start_pointer + attempts + 1) % num_instances
-                    logger.info(f"Экземпляр {instance['url']} сервиса {service_name} доступен")
-                    return instance
-        except Exception as e:
-            attempts += 1
-            # logger.error(f"Ошибка при проверке экземпляра {instance['url']} сервиса {service_name}: {e}")
-            continue  # Если ошибка (например, сервис не доступен), продолжаем попытки
-        attempts += 1
+    Каждый обработчик занимает consistent_hash_replicas виртуальных точек, поэтому при добавлении или удалении
+    обработчика переназначается лишь малая доля ключей.
 
-    logger.error(f"Ни один экземпляр сервиса {service_name} не работает")
-    return None  # Если ни один экземпляр не работает
+    :param handlers: Живые WebSocket Handler.
+    :return: Словарь с URL обработчиков, отсортированными точками кольца и URL владельцев точек.
+    """
+    urls = tuple(sorted(handler['url'] for handler in handlers))
+    if hash_ring['urls'] != urls:
+        points = sorted((ring_hash(f"{url}#{replica}"), url)
+                        for url in urls for replica in range(CONSISTENT_HASH_REPLICAS))
+        hash_ring['urls'] = urls
+        hash_ring['points'] = [point for point, _ in points]
+        hash_ring['owners'] = [url for _, url in points]
+    return hash_ring
 
 
-async def validate_token(token: str, uid: str) -> bool:
+def pick_consistent_hash(handlers: List[Dict], key: str) -> Optional[Dict]:
     """
-    Проверяет токен, перенаправляя его в Auth Service.
+    Выбирает обработчик по согласованному хешу ключа с ограничением нагрузки (consistent hashing with bounded loads).
+
+    Обход кольца начинается с позиции ключа; обработчик пропускается, если его нагрузка достигла
+    consistent_hash_load_factor от средней или его capacity.
+
+    :param handlers: Живые WebSocket Handler.
+    :param key: Ключ размещения: UID пользователя или пара UID собеседников.
+    :return: Выбранный обработчик или None, если все обработчики заполнены.
     """
-    logger.info(f"Валидация токена для пользователя {uid} с токеном {token}")
-    service_name = 'auth_service'
-    attempts = 0
-    max_attempts = len(services[service_name]['instances'])
-    while attempts < max_attempts:
-        instance = await get_work_instance(service_name)
-        url = urljoin(instance['url'], '/token_check')
-        json_data = {'token': token, 'uid': uid}
-        try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(url, json=json_data)
-                if response.status_code == 200:
-                    logger.info(f"Токен пользователя {uid} действителен")
-                    return True
-                else:
-                    logger.warning(f"Токен пользователя {uid} недействителен. Детали: {response.json().get('detail')}")
-                    return False
-        except Exception as e:
-            logger.error(f"Ошибка при валидации токена пользователя {uid}: {e}")
-            attempts += 1
-    logger.error(f"Не удалось валидировать токен пользователя {uid} после {MAX_ATTEMPTS} попыток")
-    return False
+    by_url = {handler['url']: handler for handler in handlers}
+    ring = get_hash_ring(handlers)
+    total_load = sum(handler_loads.get(handler.get('id'), 0) for handler in handlers) + 1
+    bound = math.ceil(CONSISTENT_HASH_LOAD_FACTOR * total_load / len(handlers))
+    start = bisect.bisect(ring['points'], ring_hash(key))
+    checked = set()
+    for step in range(len(ring['points'])):
+        url = ring['owners'][(start + step) % len(ring['points'])]
+        if url in checked:
+            continue
+        checked.add(url)
+        handler = by_url[url]
+        if handler_loads.get(handler.get('id'), 0) < min(bound, handler_capacity(handler)):
+            return handler
+        if len(checked) == len(by_url):
+            break
+    return None
+
+
+def placement_key(uid: str, partner_uid: Optional[str]) -> str:
+    """
+    Формирует ключ согласованного хеширования для подключения.
+
+    В режиме chat_pair собеседники получают одинаковый ключ и попадают на один обработчик,
+    так что доставка сообщений между ними не требует пересылки.
+
+    :param uid: UID пользователя.
+    :param partner_uid: UID собеседника, если известен.
+    :return: Ключ размещения.
+    """
+    if WEBSOCKET_HASH_KEY == 'chat_pair' and partner_uid:
+        return ':'.join(sorted((uid, partner_uid)))
+    return uid
+
+
+async def place_websocket_handler(uid: str, partner_uid: Optional[str] = None) -> Optional[Dict]:
+    """
+    Выбирает WebSocket Handler для нового подключения пользователя.
+
+    В режиме least_loaded выбирается живой обработчик с наименьшей долей занятых подключений, в режиме
+    consistent_hash - обработчик по согласованному хешу ключа размещения с ограничением нагрузки.
+    Обработчики, достигшие capacity, не получают новых подключений.
+
+    :param uid: UID пользователя.
+    :param partner_uid: UID собеседника для размещения по паре.
+    :return: Выбранный обработчик или None, если живых обработчиков нет.
+    :raises HTTPException: Если все живые обработчики заполнены.
+    """
+    if WEBSOCKET_PLACEMENT == 'round_robin':
+        return await get_work_instance('websocket_handlers')
+
+    service = services['websocket_handlers']
+    live = [handler for handler in service['live'] if breaker_allows(service, handler)]
+    if not live:
+        logger.error("Ни один WebSocket Handler не работает")
+        return None
+    candidates = [handler for handler in live if handler_loads.get(handler.get('id'), 0) < handler_capacity(handler)]
+    handler = None
+    if candidates and WEBSOCKET_PLACEMENT == 'consistent_hash':
+        handler = pick_consistent_hash(candidates, placement_key(uid, partner_uid))
+    elif candidates:
+        handler = min(candidates, key=lambda item: handler_loads.get(item.get('id'), 0) / handler_capacity(item))
+    if handler is None:
+        logger.error(f"Все WebSocket Handler заполнены, подключение пользователя {uid} отклонено")
+        raise HTTPException(status_code=503, detail="Все WebSocket Handler заполнены",
+                            headers={'Retry-After': str(HANDLER_LOAD_REFRESH_INTERVAL)})
+    # Учитываем подключение сразу, не дожидаясь обновления от WebSocket Manager, чтобы волна переподключений
+    # не попала на один обработчик
+    handler_loads[handler.get('id')] = handler_loads.get(handler.get('id'), 0) + 1
+    return handler
+
+
+def take_token_locally(key: str, rate: float, burst: float) -> float:
+    """
+    Списывает токен из корзины в памяти процесса.
+
+    :param key: Ключ корзины.
+    :param rate: Скорость пополнения корзины в токенах в секунду.
+    :param burst: Емкость корзины.
+    :return: 0, если запрос разрешен, иначе число секунд до появления токена.
+    """
+    now = time.monotonic()
+    tokens, updated_at = rate_limit_buckets.get(key, (burst, now))
+    tokens = min(burst, tokens + (now - updated_at) * rate)
+    if tokens >= 1:
+        rate_limit_buckets[key] = (tokens - 1, now)
+        return 0.0
+    rate_limit_buckets[key] = (tokens, now)
+    return (1 - tokens) / rate
+
+
+async def take_token_shared(key: str, rate: float, burst: float) -> float:
+    """
+    Списывает токен из корзины в Redis, общей для всех экземпляров API Gateway.
+
+    При недоступности Redis запрос пропускается, чтобы сбой хранилища не остановил шлюз.
+
+    :param key: Ключ корзины.
+    :param rate: Скорость пополнения корзины в токенах в секунду.
+    :param burst: Емкость корзины.
+    :return: 0, если запрос разрешен, иначе число секунд до появления токена.
+    """
+    try:
+        allowed, retry_after = await redis_client.eval(RATE_LIMIT_SCRIPT, 1, f"ratelimit:{key}", rate, burst)
+        return 0.0 if int(allowed) else float(retry_after)
+    except Exception as e:
+        logger.error(f"Ошибка ограничения частоты запросов через Redis: {e}")
+        return 0.0
+
+
+async def enforce_rate_limit(request: Request, uid: Optional[str] = None):
+    """
+    Ограничивает частоту запросов клиента к маршруту по алгоритму корзины токенов.
+
+    Лимиты задаются в rate_limits для каждого пути. До проверки токена клиент определяется только по IP
+    (лимит ip_rate/ip_burst, по умолчанию rate/burst), так как UID из запроса еще не подтвержден и его можно
+    менять в каждом запросе. Лимит по UID применяется только после успешной проверки токена.
+
+    :param request: Объект запроса FastAPI.
+    :param uid: UID пользователя с проверенным токеном или None для лимита по IP.
+    :raises HTTPException: 429 с заголовком Retry-After, если лимит исчерпан.
+    """
+    route = request.url.path
+    limit = RATE_LIMITS.get(route)
+    if not limit:
+        return
+    if uid:
+        client_key = f"uid:{uid}"
+        rate, burst = limit['rate'], limit['burst']
+    else:
+        client_key = f"ip:{request.client.host if request.client else 'unknown'}"
+        rate, burst = limit.get('ip_rate', limit['rate']), limit.get('ip_burst', limit['burst'])
+    key = f"{route}:{client_key}"
+    if RATE_LIMIT_BACKEND == 'redis':
+        retry_after = await take_token_shared(key, rate, burst)
+    else:
+        retry_after = take_token_locally(key, rate, burst)
+    if retry_after > 0:
+        logger.warning(f"Превышен лимит запросов к {route} для {client_key}")
+        raise HTTPException(status_code=429, detail="Слишком много запросов",
+                            headers={'Retry-After': str(math.ceil(retry_after))})
 
 
 @app.post("/get_websocket_handler")
@@ -152,6 +1394,7 @@ async def get_websocket_handler(request: Request):
 
         token = request_body.get('token')
         uid = request_body.get('uid')
+        partner_uid = request_body.get('partner_uid')
     except json.JSONDecodeError:
         logger.error("Ошибка при декодировании JSON тела запроса")
         raise HTTPException(status_code=400, detail="Неправильный формат JSON тела запроса")
@@ -161,12 +1404,18 @@ async def get_websocket_handler(request: Request):
         logger.error("Отсутствуют токен или UID в запросе для получения WebSocket Handler")
         raise HTTPException(status_code=401, detail="Необходима аутентификация. Должны быть предоставлены токен и UID.")
 
-    is_valid = await validate_token(token, uid)
+    await enforce_rate_limit(request)
+
+    is_valid = await validate_token(token, uid, request.url.path)
     if not is_valid:
         logger.error(f"Неверный или истекший токен для пользователя {uid}")
         raise HTTPException(status_code=401, detail="Неверный или истекший токен")
 
-    handler = await get_work_instance('websocket_handlers')
+    await enforce_rate_limit(request, uid)
+
+    handler = await place_websocket_handler(uid, partner_uid)
+    if handler is None:
+        raise HTTPException(status_code=503, detail="Нет доступных WebSocket Handler")
     handler_url = handler['url']
     handler_id = handler.get('id')
     logger.info(f"Доступный WebSocket Handler для пользователя {uid}: URL {handler_url}, ID {handler_id}")
@@ -183,6 +1432,7 @@ async def register(request: Request):
     :return: Ответ от Auth Service.
     """
     logger.info("Проксирование запроса на регистрацию в Auth Service")
+    await enforce_rate_limit(request)
     response = await proxy_request(request, 'auth_service')
     return response
 
@@ -196,6 +1446,7 @@ async def login(request: Request):
     :return: Ответ от Auth Service.
     """
     logger.info("Проксирование запроса на вход в Auth Service")
+    await enforce_rate_limit(request)
     response = await proxy_request(request, 'auth_service')
     return response
 
@@ -209,41 +1460,26 @@ async def token_login(request: Request):
     :return: Ответ от Auth Service.
     """
     logger.info("Проксирование запроса на вход по токену в Auth Service")
+    await enforce_rate_limit(request)
     response = await proxy_request(request, 'auth_service')
     return response
 
 
 @app.get("/token_check")
-async def token_check(token: str, uid: str):
+async def token_check(request: Request, token: str, uid: str):
     """
     Проксирует запрос на проверку токена в Auth Service.
 
+    :param request: Объект запроса FastAPI.
     :param token: Токен пользователя.
     :param uid: UID пользователя.
     :return: Ответ от Auth Service.
     """
     logger.info(f"Проксирование запроса на проверку токена для пользователя {uid}")
-    service_name = 'auth_service'
-    attempts = 0
-    max_attempts = len(services[service_name]['instances'])
-    while attempts < max_attempts:
-        instance = await get_work_instance(service_name)
-        url = urljoin(instance['url'], '/token_check')
-        params = {'token': token, 'uid': uid}
-        try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(url, params=params, timeout=5)
-                logger.info(f"Ответ от Auth Service для проверки токена: {response.status_code}")
-                return Response(
-                    status_code=response.status_code,
-                    content=response.content,
-                    headers={k: v for k, v in response.headers.items() if k.lower() != 'content-encoding'}
-                )
-        except Exception as e:
-            logger.error(f"Ошибка при проксировании запроса на проверку токена для {uid}: {e}")
-            attempts += 1
-    logger.error(f"Все экземпляры {service_name} недоступны для проверки токена {uid}")
-    raise HTTPException(status_code=503, detail=f"Все экземпляры {service_name} недоступны")
+    # Токен проверяет сам Auth Service, поэтому UID не подтвержден и лимит действует только по IP
+    await enforce_rate_limit(request)
+    response = await proxy_request(request, 'auth_service')
+    return response
 
 
 # Прокси-эндпоинты для Matching Service
@@ -270,52 +1506,312 @@ async def matching(request: Request):
         logger.error("Отсутствуют токен или UID при подборе пары")
         raise HTTPException(status_code=401, detail="Необходима аутентификация. Должны быть предоставлены токен и UID.")
 
-    is_valid = await validate_token(token, uid)
+    await enforce_rate_limit(request)
+
+    is_valid = await validate_token(token, uid, request.url.path)
     if not is_valid:
         logger.error(f"Неверный или истекший токен для подбора пары у пользователя {uid}")
         raise HTTPException(status_code=401, detail="Неверный или истекший токен")
 
+    await enforce_rate_limit(request, uid)
+
     response = await proxy_request(request, 'matching_service')
     return response
 
 
+class UpstreamResponse(StreamingResponse):
+    """
+    Потоковый ответ клиенту, передающий тело ответа сервиса по частям.
+
+    После отправки ответ сервиса закрывается и учет запроса к экземпляру завершается, в том числе при обрыве
+    соединения клиентом или отмене до начала передачи тела.
+    """
+
+    def __init__(self, upstream: httpx.Response, service_name: str, instance: Dict, latency: float):
+        """
+        :param upstream: Потоковый ответ сервиса.
+        :param service_name: Название сервиса.
+        :param instance: Экземпляр сервиса, обработавший запрос.
+        :param latency: Время до получения заголовков ответа в секундах.
+        """
+        super().__init__(
+            upstream.aiter_raw(),
+            status_code=upstream.status_code,
+            headers={k: v for k, v in upstream.headers.items() if k.lower() not in RESPONSE_EXCLUDED_HEADERS}
+        )
+        self.upstream = upstream
+        self.service_name = service_name
+        self.instance = instance
+        self.latency = latency
+
+    async def close_upstream(self):
+        """Закрывает ответ сервиса, завершает учет запроса к экземпляру и освобождает место в лимите сервиса."""
+        await self.upstream.aclose()
+        release_instance(self.service_name, self.instance, self.latency)
+        release_admission(self.service_name)
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.close_upstream()
+
+
+async def send_upstream(service_name: str, instance: Dict, method: str, url: str, headers: Dict,
+                        content) -> Tuple[Dict, httpx.Response, float]:
+    """
+    Отправляет запрос экземпляру сервиса с потоковым чтением ответа и учитывает результат в статистике экземпляра.
+
+    :param service_name: Название сервиса.
+    :param instance: Экземпляр сервиса.
+    :param method: HTTP метод.
+    :param url: Полный URL запроса.
+    :param headers: Заголовки запроса.
+    :param content: Тело запроса: байты или асинхронный поток.
+    :return: Экземпляр, потоковый ответ и время до получения заголовков ответа.
+    :raises Exception: Если запрос не удался; экземпляр при этом помечается недоступным.
+    """
+    started = acquire_instance(service_name, instance)
+    try:
+        client = get_upstream_client(service_name)
+        upstream_request = client.build_request(method, url, headers=headers, content=content, timeout=4)
+        response = await client.send(upstream_request, stream=True)
+    except asyncio.CancelledError:
+        release_instance(service_name, instance)
+        raise
+    except Exception:
+        release_instance(service_name, instance)
+        record_result(service_name, instance, False)
+        mark_instance_dead(service_name, instance)
+        raise
+    latency = time.monotonic() - started
+    record_result(service_name, instance, response.status_code < 500, latency)
+    return instance, response, latency
+
+
+def hedge_delay(service: Dict) -> Optional[float]:
+    """
+    Вычисляет задержку перед хеджирующим запросом как перцентиль hedge_percentile недавних задержек сервиса.
+
+    :param service: Запись сервиса из словаря services.
+    :return: Задержка в секундах или None, если накоплено меньше hedge_min_samples замеров.
+    """
+    latencies = service['latencies']
+    if len(latencies) < HEDGE_MIN_SAMPLES:
+        return None
+    ordered = sorted(latencies)
+    return max(HEDGE_MIN_DELAY, ordered[min(len(ordered) - 1, int(len(ordered) * HEDGE_PERCENTILE))])
+
+
+def take_hedge_token(service: Dict) -> bool:
+    """
+    Списывает хеджирующий запрос из бюджета сервиса, пополняемого на hedge_max_rate за каждый запрос.
+
+    Бюджет не превышает hedge_burst, поэтому после затишья подряд отправляется не больше hedge_burst хеджирующих
+    запросов, даже если экземпляры начали отвечать медленно.
+
+    :param service: Запись сервиса из словаря services.
+    :return: True, если хеджирующий запрос разрешен.
+    """
+    if service['hedge_tokens'] < 1:
+        return False
+    service['hedge_tokens'] -= 1
+    return True
+
+
+async def discard_upstream(service_name: str, task: asyncio.Task):
+    """
+    Отменяет проигравший запрос хеджирования или закрывает его ответ, если он уже пришел.
+
+    :param service_name: Название сервиса.
+    :param task: Задача send_upstream.
+    """
+    if not task.done():
+        task.cancel()
+        try:
+            await task
+        except BaseException:
+            pass
+        return
+    if task.cancelled() or task.exception() is not None:
+        return
+    instance, response, latency = task.result()
+    await response.aclose()
+    release_instance(service_name, instance, latency)
+
+
+async def send_hedged(service_name: str, instance: Dict, method: str, path_and_query: str, headers: Dict,
+                      content: bytes) -> Tuple[Dict, httpx.Response, float]:
+    """
+    Отправляет идемпотентный запрос и, если ответа нет дольше перцентиля задержек сервиса, дублирует его
+    на другой живой экземпляр. Используется первый пришедший ответ, второй запрос отменяется.
+
+    :param service_name: Название сервиса.
+    :param instance: Основной экземпляр сервиса.
+    :param method: HTTP метод.
+    :param path_and_query: Путь и строка запроса.
+    :param headers: Заголовки запроса.
+    :param content: Буферизованное тело запроса.
+    :return: Экземпляр, потоковый ответ и время до получения заголовков ответа.
+    :raises Exception: Если все отправленные запросы не удались.
+    """
+    service = services[service_name]
+    service['hedge_tokens'] = min(float(HEDGE_BURST), service['hedge_tokens'] + HEDGE_MAX_RATE)
+    primary = asyncio.create_task(send_upstream(service_name, instance, method, urljoin(instance['url'], path_and_query),
+                                                headers, content))
+    delay = hedge_delay(service)
+    if delay is None:
+        return await primary
+    done, _ = await asyncio.wait({primary}, timeout=delay)
+    if done:
+        return primary.result()
+
+    others = [item for item in service['live'] if item['url'] != instance['url'] and breaker_allows(service, item)]
+    if not others or not take_hedge_token(service):
+        return await primary
+    second_instance = min(others, key=lambda item: instance_cost(service, item))
+    logger.info(f"Хеджирующий запрос в {service_name} на {second_instance['url']} после {delay:.3f} с")
+    hedge = asyncio.create_task(send_upstream(service_name, second_instance, method,
+                                              urljoin(second_instance['url'], path_and_query), headers, content))
+    pending = {primary, hedge}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    for other in pending:
+                        await discard_upstream(service_name, other)
+                    pending = set()
+                    return task.result()
+        return primary.result() if primary.exception() is None else hedge.result()
+    finally:
+        for task in pending:
+            await discard_upstream(service_name, task)
+
+
+async def single_flight(key: Tuple, factory: Callable[[], Awaitable]):
+    """
+    Выполняет обращение к сервису один раз для всех одновременных вызовов с одинаковым ключом.
+
+    Первый вызов запускает обращение, остальные ожидают его результат или исключение. Отмена одного
+    из ожидающих не отменяет общее обращение.
+
+    :param key: Ключ, определяющий одинаковые обращения.
+    :param factory: Функция, создающая корутину обращения.
+    :return: Результат обращения.
+    """
+    task = inflight_calls.get(key)
+    if task is None:
+        coalescing_stats['leaders'] += 1
+        task = asyncio.ensure_future(factory())
+        inflight_calls[key] = task
+        task.add_done_callback(lambda _: inflight_calls.pop(key, None))
+    else:
+        coalescing_stats['coalesced'] += 1
+    return await asyncio.shield(task)
+
+
+async def buffer_response(response: Awaitable[UpstreamResponse]) -> Tuple[int, Dict, bytes]:
+    """
+    Дожидается потокового ответа сервиса и полностью читает его тело.
+
+    :param response: Корутина, возвращающая потоковый ответ.
+    :return: Статус, заголовки и тело ответа.
+    """
+    response = await response
+    try:
+        body = b''.join([chunk async for chunk in response.body_iterator])
+    finally:
+        await response.close_upstream()
+    return response.status_code, dict(response.headers), body
+
+
 # Функция для проксирования запросов к соответствующему сервису
 async def proxy_request(request: Request, service_name: str):
+    """
+    Проксирует входящий запрос в указанный сервис.
+
+    Одновременные GET-запросы к путям из coalesced_routes с одинаковыми параметрами и заголовками Authorization
+    и Cookie объединяются в одно обращение к сервису, ответ которого получают все ожидающие клиенты.
+
+    :param request: Объект запроса FastAPI.
+    :param service_name: Название сервиса, которому нужно проксировать запрос.
+    :return: Ответ от сервиса.
+    :raises HTTPException: Если сервис перегружен или все его экземпляры недоступны.
+    """
+    if request.method != 'GET' or request.url.path not in COALESCED_ROUTES:
+        return await forward_request(request, service_name)
+    key = ('proxy', service_name, request.url.path, str(request.url.query),
+           tuple(request.headers.get(header) for header in COALESCING_KEY_HEADERS))
+    status_code, headers, body = await single_flight(key, lambda: buffer_response(forward_request(request, service_name)))
+    return Response(status_code=status_code, content=body, headers=headers)
+
+
+async def forward_request(request: Request, service_name: str):
     """
     Проксирует входящий запрос в указанный сервис с использованием балансировки нагрузки и логики повторных попыток.
 
+    GET-запросы к путям из hedging_routes хеджируются: если ответ задерживается дольше перцентиля задержек сервиса,
+    запрос дублируется на другой экземпляр.
+
     :param request: Объект запроса FastAPI.
     :param service_name: Название сервиса, которому нужно проксировать запрос.
     :return: Ответ от сервиса.
-    :raises HTTPException: Если все экземпляры сервиса недоступны.
+    :raises HTTPException: Если сервис перегружен или все его экземпляры недоступны.
     """
     logger.info(f"Проксирование входящего запроса в {service_name}")
     max_attempts = min(MAX_ATTEMPTS, len(services[service_name]['instances']))
+    admit_request(service_name, request.url.path)
+    try:
+        response = await send_with_retries(request, service_name, max_attempts)
+    except BaseException:
+        release_admission(service_name)
+        raise
+    # Место в лимите освобождает UpstreamResponse после передачи ответа клиенту
+    return response
+
+
+async def send_with_retries(request: Request, service_name: str, max_attempts: int) -> UpstreamResponse:
+    """
+    Отправляет входящий запрос экземплярам сервиса, повторяя его на других экземплярах при ошибках.
+
+    :param request: Объект запроса FastAPI.
+    :param service_name: Название сервиса.
+    :param max_attempts: Максимальное число попыток.
+    :return: Потоковый ответ сервиса.
+    :raises HTTPException: 503, если все экземпляры сервиса недоступны.
+    """
     attempts = 0
     # Извлечение пути и параметров запроса
     path = request.url.path
     query = str(request.url.query)
+    path_and_query = f"{path}?{query}" if query else path
+    headers = {k: v for k, v in request.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+    method = request.method
+    # Тело буферизуется только если возможна повторная попытка, иначе передается потоком
+    content = await request.body() if max_attempts > 1 else request.stream()
+    hedged = method == 'GET' and path in HEDGING_ROUTES and max_attempts > 1
+    deposit_retry_budget()
     while attempts < max_attempts:
         instance = await get_work_instance(service_name)
-        instance_url = instance['url']
-        url = urljoin(instance_url, path)
-        if query:
-            url = f"{url}?{query}"
-        headers = dict(request.headers)
-        method = request.method
-        content = await request.body()
+        if instance is None:
+            break
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.request(method, url, headers=headers, content=content, timeout=4)
-                logger.info(f"Успешный проксируемый запрос в {service_name} на {url} завершен")
-                return Response(
-                    status_code=response.status_code,
-                    content=response.content,
-                    headers={k: v for k, v in response.headers.items() if k.lower() != 'content-encoding'}
-                )
+            if hedged:
+                instance, response, latency = await send_hedged(service_name, instance, method, path_and_query,
+                                                                headers, content)
+            else:
+                instance, response, latency = await send_upstream(service_name, instance, method,
+                                                                  urljoin(instance['url'], path_and_query),
+                                                                  headers, content)
+            logger.info(f"Проксируемый запрос в {service_name} на {instance['url']}{path} "
+                        f"получил ответ {response.status_code}")
+            return UpstreamResponse(response, service_name, instance, latency)
         except Exception as e:
             logger.error(f"Ошибка проксирования для {service_name} на попытке {attempts+1}: {e}")
             attempts += 1
+            if attempts < max_attempts and not await allow_retry(service_name, attempts):
+                break
     logger.error(f"Все экземпляры {service_name} недоступны для проксирования")
     raise HTTPException(status_code=503, detail=f"Все экземпляры {service_name} недоступны")
 
@@ -334,10 +1830,265 @@ async def get_service_instance(service_name: str):
         logger.error(f"Рабочий сервис {service_name} не найден")
         raise HTTPException(status_code=404, detail=f"Рабочий сервис {service_name} не найден")
     instance = await get_work_instance(service_name)
+    if instance is None:
+        raise HTTPException(status_code=503, detail=f"Все экземпляры {service_name} недоступны")
     logger.info(f"Предоставление экземпляра {instance['url']} для сервиса {service_name}")
     return {'instance': instance}
 
 
+def registration_ttl(ttl: Optional[float]) -> float:
+    """
+    Определяет срок регистрации экземпляра.
+
+    :param ttl: Срок из запроса в секундах или None для registry_ttl.
+    :return: Срок регистрации в секундах.
+    :raises HTTPException: 400, если срок не положительный.
+    """
+    if ttl is None:
+        return REGISTRY_TTL
+    if ttl <= 0:
+        raise HTTPException(status_code=400, detail="ttl должен быть положительным")
+    return ttl
+
+
+def check_registry_token(token: Optional[str]):
+    """
+    Проверяет общий секрет, без которого нельзя изменять реестр экземпляров.
+
+    :param token: Значение заголовка X-Registry-Token.
+    :raises HTTPException: 403, если registry_token не задан в конфигурации, 401, если секрет неверный.
+    """
+    if not REGISTRY_TOKEN:
+        raise HTTPException(status_code=403, detail="Регистрация экземпляров отключена")
+    if not token or not hmac.compare_digest(token.encode(), REGISTRY_TOKEN.encode()):
+        logger.warning("Попытка изменения реестра экземпляров с неверным секретом")
+        raise HTTPException(status_code=401, detail="Неверный секрет реестра")
+
+
+def is_pinned_instance(service_name: str, url: str) -> bool:
+    """
+    Проверяет, задан ли экземпляр в конфигурации. Такие экземпляры нельзя переопределить или удалить через реестр.
+
+    :param service_name: Название сервиса.
+    :param url: URL экземпляра.
+    :return: True для экземпляра из конфигурации.
+    """
+    service = services.get(service_name)
+    return bool(service) and url in service['leases'] and service['leases'][url] is None
+
+
+@app.post("/registry/register")
+async def register_instance(registration: InstanceRegistration, x_registry_token: Optional[str] = Header(None)):
+    """
+    Регистрирует экземпляр сервиса в реестре на время ttl секунд.
+
+    :param registration: Название сервиса, URL, необязательный ID экземпляра и срок регистрации.
+    :param x_registry_token: Общий секрет реестра из заголовка X-Registry-Token.
+    :return: JSON с версией реестра и сроком регистрации.
+    :raises HTTPException: 401 или 403 без верного секрета, 400 для неположительного ttl,
+        409 для экземпляра из конфигурации.
+    """
+    check_registry_token(x_registry_token)
+    if is_pinned_instance(registration.service_name, registration.url):
+        raise HTTPException(status_code=409, detail="Экземпляр задан в конфигурации")
+    ttl = registration_ttl(registration.ttl)
+    instance = {'url': registration.url}
+    if registration.id:
+        instance['id'] = registration.id
+    # Сначала регистрация записывается в Redis: при ошибке Redis локальный реестр не расходится с общим
+    if SHARED_STATE_BACKEND == 'redis':
+        registration_data = {'service_name': registration.service_name, 'instance': instance}
+        await redis_client.set(shared_instance_key(registration.service_name, registration.url),
+                               json.dumps(registration_data), px=int(ttl * 1000))
+    add_instance(registration.service_name, instance, time.monotonic() + ttl)
+    return {'status': 'registered', 'version': registry['version'], 'ttl': ttl}
+
+
+@app.post("/registry/heartbeat")
+async def heartbeat_instance(heartbeat: InstanceHeartbeat, x_registry_token: Optional[str] = Header(None)):
+    """
+    Продлевает регистрацию экземпляра сервиса.
+
+    :param heartbeat: Название сервиса, URL экземпляра и необязательный новый срок регистрации.
+    :param x_registry_token: Общий секрет реестра из заголовка X-Registry-Token.
+    :return: JSON с версией реестра.
+    :raises HTTPException: 401 или 403 без верного секрета, 400 для неположительного ttl,
+        404, если экземпляр не зарегистрирован и должен зарегистрироваться заново.
+    """
+    check_registry_token(x_registry_token)
+    ttl = registration_ttl(heartbeat.ttl)
+    if SHARED_STATE_BACKEND == 'redis' and \
+            not await redis_client.pexpire(shared_instance_key(heartbeat.service_name, heartbeat.url), int(ttl * 1000)):
+        raise HTTPException(status_code=404, detail="Экземпляр не зарегистрирован")
+    service = services.get(heartbeat.service_name)
+    if SHARED_STATE_BACKEND != 'redis' and (not service or heartbeat.url not in service['leases']):
+        raise HTTPException(status_code=404, detail="Экземпляр не зарегистрирован")
+    if service and service['leases'].get(heartbeat.url) is not None:
+        service['leases'][heartbeat.url] = time.monotonic() + ttl
+    return {'status': 'ok', 'version': registry['version']}
+
+
+@app.post("/registry/deregister")
+async def deregister_instance(heartbeat: InstanceHeartbeat, x_registry_token: Optional[str] = Header(None)):
+    """
+    Удаляет экземпляр сервиса из реестра.
+
+    :param heartbeat: Название сервиса и URL экземпляра.
+    :param x_registry_token: Общий секрет реестра из заголовка X-Registry-Token.
+    :return: JSON с версией реестра.
+    :raises HTTPException: 401 или 403 без верного секрета, 409 для экземпляра из конфигурации,
+        404, если экземпляр не зарегистрирован.
+    """
+    check_registry_token(x_registry_token)
+    if is_pinned_instance(heartbeat.service_name, heartbeat.url):
+        raise HTTPException(status_code=409, detail="Экземпляр задан в конфигурации")
+    removed = remove_instance(heartbeat.service_name, heartbeat.url)
+    if SHARED_STATE_BACKEND == 'redis':
+        removed = await redis_client.delete(shared_instance_key(heartbeat.service_name, heartbeat.url)) > 0 or removed
+    if not removed:
+        raise HTTPException(status_code=404, detail="Экземпляр не зарегистрирован")
+    return {'status': 'deregistered', 'version': registry['version']}
+
+
+@app.get("/registry")
+async def get_registry():
+    """
+    Предоставляет текущий снимок реестра.
+
+    :return: JSON с версией реестра и живыми экземплярами всех сервисов.
+    """
+    return registry_snapshot()
+
+
+@app.get("/registry/watch")
+async def watch_registry(version: int = 0, timeout: float = REGISTRY_WATCH_TIMEOUT):
+    """
+    Long-poll эндпоинт: отвечает, как только версия реестра будет отличаться от переданной, или по истечении timeout.
+
+    Версия вычисляется по содержимому реестра и сравнивается на неравенство, поэтому ее можно передавать
+    любому процессу API Gateway.
+
+    :param version: Последняя известная клиенту версия реестра.
+    :param timeout: Максимальное время ожидания в секундах, не больше registry_watch_timeout.
+    :return: JSON с версией реестра и живыми экземплярами всех сервисов.
+    """
+    if registry['version'] == version:
+        try:
+            await asyncio.wait_for(registry['changed'].wait(), timeout=min(timeout, REGISTRY_WATCH_TIMEOUT))
+        except asyncio.TimeoutError:
+            pass
+    return registry_snapshot()
+
+
+@app.get("/discovery")
+async def discovery(request: Request, service_names: Optional[str] = None):
+    """
+    Предоставляет живые экземпляры одного или нескольких сервисов одним ответом, пригодным для кэширования.
+
+    Ответ содержит версию реестра в ETag и срок кэширования в Cache-Control, поэтому клиенты могут
+    балансировать нагрузку сами и перезапрашивать список не чаще раза в discovery_max_age секунд.
+
+    :param request: Объект запроса FastAPI.
+    :param service_names: Названия сервисов через запятую. Если не указаны, возвращаются все сервисы.
+    :return: JSON с версией реестра, сроком кэширования и списками живых экземпляров или 304, если версия не изменилась.
+    :raises HTTPException: Если один из сервисов не найден.
+    """
+    names = [name.strip() for name in service_names.split(',') if name.strip()] if service_names else list(services)
+    unknown = [name for name in names if name not in services]
+    if unknown:
+        logger.error(f"Рабочие сервисы {unknown} не найдены")
+        raise HTTPException(status_code=404, detail=f"Рабочие сервисы {', '.join(unknown)} не найдены")
+
+    etag = f'"{registry["version"]}"'
+    headers = {'ETag': etag, 'Cache-Control': f"max-age={DISCOVERY_MAX_AGE}"}
+    if request.headers.get('if-none-match') == etag:
+        return Response(status_code=304, headers=headers)
+    content = {
+        'version': registry['version'],
+        'max_age': DISCOVERY_MAX_AGE,
+        'services': {name: services[name]['live'] for name in names}
+    }
+    return JSONResponse(content=content, headers=headers)
+
+
+@app.get("/instances_health")
+async def instances_health():
+    """
+    Предоставляет таблицу состояния экземпляров сервисов, собранную фоновым монитором.
+
+    :return: JSON с состоянием, задержкой последней проверки и временем проверки каждого экземпляра.
+    """
+    return {service_name: service['health'] for service_name, service in services.items()}
+
+
+@app.get("/circuit_breakers")
+async def circuit_breakers():
+    """
+    Предоставляет состояние автоматических выключателей экземпляров и бюджета повторных попыток.
+
+    :return: JSON с состоянием и долей ошибок в окне для каждого экземпляра и остатком бюджета повторов.
+    """
+    refill_retry_budget()
+    return {
+        'breakers': {
+            service_name: {
+                url: {
+                    'state': breaker['state'],
+                    'calls': len(breaker['results']),
+                    'error_rate': sum(breaker['results']) / len(breaker['results']) if breaker['results'] else 0.0
+                }
+                for url, breaker in service['breakers'].items()
+            }
+            for service_name, service in services.items()
+        },
+        'retry_budget': retry_budget['tokens']
+    }
+
+
+@app.get("/admission")
+async def admission_state():
+    """
+    Предоставляет текущие лимиты одновременных запросов к сервисам и число отклоненных запросов.
+
+    :return: JSON с лимитом, числом незавершенных запросов и числом отклоненных запросов для каждого сервиса.
+    """
+    return {
+        service_name: {
+            'limit': service['admission']['limit'],
+            'admitted': service['admission']['admitted'],
+            'in_flight': sum(stats['in_flight'] for stats in service['stats'].values()),
+            'shed': service['admission']['shed']
+        }
+        for service_name, service in services.items()
+    }
+
+
+@app.get("/coalescing_stats")
+async def get_coalescing_stats():
+    """
+    Предоставляет статистику объединения одинаковых одновременных обращений к сервисам.
+
+    :return: JSON с числом выполненных обращений, числом присоединившихся к ним запросов и числом выполняющихся обращений.
+    """
+    return {**coalescing_stats, 'in_flight': len(inflight_calls)}
+
+
+@app.get("/token_cache_stats")
+async def get_token_cache_stats():
+    """
+    Предоставляет статистику кэша проверки токенов для мониторинга.
+
+    :return: JSON с числом попаданий, промахов, попаданий в отрицательные записи, размером кэша и долей попаданий.
+    """
+    lookups = token_cache_stats['hits'] + token_cache_stats['misses']
+    return {
+        **token_cache_stats,
+        'size': token_cache.currsize,
+        'maxsize': token_cache.maxsize,
+        'hit_rate': token_cache_stats['hits'] / lookups if lookups else 0.0
+    }
+
+
 @app.get("/")
 async def health():
     """
@@ -349,11 +2100,25 @@ async def health():
     return {"status": "API Gateway is work!"}
 
 
+def read_log_file() -> str:
+    """
+    Читает файл логов шлюза.
+
+    :return: Содержимое файла логов.
+    """
+    with open(log_file, "r", encoding="utf-8") as f:
+        return f.read()
+
+
 @app.get("/logs", response_class=HTMLResponse)
 async def get_logs():
+    # Чтение файла логов выполняется в отдельном потоке, а одновременных чтений не больше logs_max_concurrency,
+    # чтобы просмотр логов не занимал ресурсы шлюза, нужные для проксирования
+    if logs_readers['active'] >= LOGS_MAX_CONCURRENCY:
+        raise HTTPException(status_code=503, detail="API Gateway перегружен", headers={'Retry-After': '1'})
+    logs_readers['active'] += 1
     try:
-        with open(log_file, "r", encoding="utf-8") as f:
-            logs = f.read()
+        logs = await asyncio.to_thread(read_log_file)
 
         html_content = f"""
         <html>
@@ -444,8 +2209,13 @@ async def get_logs():
     except Exception as e:
         logger.error(f"Ошибка при чтении логов: {e}")
         raise HTTPException(status_code=500, detail="Ошибка при чтении логов")
+    finally:
+        logs_readers['active'] -= 1
 
 
 if __name__ == "__main__":
-    logger.info(f"Запуск API Gateway на {HOST}:{PORT}")
-    uvicorn.run(app, host=HOST, port=PORT)
+    logger.info(f"Запуск API Gateway на {HOST}:{PORT}, процессов: {WORKERS}")
+    if WORKERS > 1:
+        uvicorn.run("main:app", host=HOST, port=PORT, workers=WORKERS)
+    else:
+        uvicorn.run(app, host=HOST, port=PORT)
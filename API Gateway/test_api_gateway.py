@@ -0,0 +1,727 @@
+import asyncio
+import datetime
+import math
+import time
+import pytest
+import httpx
+import jwt
+from unittest.mock import AsyncMock, patch
+from fastapi.testclient import TestClient
+
+import main
+
+
+def make_service(*urls):
+    return main.init_service([{"url": url} for url in urls])
+
+
+@pytest.fixture
+def services(monkeypatch):
+    test_services = {
+        'auth_service': make_service("http://auth1", "http://auth2"),
+    }
+    monkeypatch.setattr(main, 'services', test_services)
+    return test_services
+
+
+class TestHealthTable:
+    @pytest.mark.asyncio
+    async def test_get_work_instance_round_robin_over_live(self, services):
+        picked = [(await main.get_work_instance('auth_service'))['url'] for _ in range(4)]
+        assert picked == ["http://auth1", "http://auth2", "http://auth1", "http://auth2"]
+
+    @pytest.mark.asyncio
+    async def test_dead_instance_is_skipped(self, services, monkeypatch):
+        monkeypatch.setattr(main, 'HEALTH_CHECK_FAILURE_THRESHOLD', 1)
+        main.mark_instance_dead('auth_service', {"url": "http://auth1"})
+        picked = {(await main.get_work_instance('auth_service'))['url'] for _ in range(4)}
+        assert picked == {"http://auth2"}
+
+    @pytest.mark.asyncio
+    async def test_no_live_instances_returns_none(self, services, monkeypatch):
+        monkeypatch.setattr(main, 'HEALTH_CHECK_FAILURE_THRESHOLD', 1)
+        main.mark_instance_dead('auth_service', {"url": "http://auth1"})
+        main.mark_instance_dead('auth_service', {"url": "http://auth2"})
+        assert await main.get_work_instance('auth_service') is None
+
+    @pytest.mark.asyncio
+    async def test_probe_updates_health_table(self, services, monkeypatch):
+        monkeypatch.setattr(main, 'HEALTH_CHECK_FAILURE_THRESHOLD', 1)
+        def handler(request):
+            return httpx.Response(200 if request.url.host == "auth2" else 500)
+
+        monkeypatch.setitem(main.upstream_clients, 'auth_service',
+                            httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+        for instance in services['auth_service']['instances']:
+            await main.probe_instance('auth_service', instance)
+        main.update_live_instances(services['auth_service'])
+
+        health = services['auth_service']['health']
+        assert health["http://auth1"]['alive'] is False
+        assert health["http://auth2"]['alive'] is True
+        assert health["http://auth2"]['latency'] is not None
+        assert [i['url'] for i in services['auth_service']['live']] == ["http://auth2"]
+
+    @pytest.mark.asyncio
+    async def test_instance_is_dead_after_consecutive_failures(self, services, monkeypatch):
+        monkeypatch.setattr(main, 'HEALTH_CHECK_FAILURE_THRESHOLD', 3)
+        statuses = iter([500, 500, 200, 500, 500, 500])
+        monkeypatch.setitem(main.upstream_clients, 'auth_service', httpx.AsyncClient(
+            transport=httpx.MockTransport(lambda request: httpx.Response(next(statuses)))))
+        instance = services['auth_service']['instances'][0]
+        health = services['auth_service']['health'][instance['url']]
+
+        alive = []
+        for _ in range(6):
+            await main.probe_instance('auth_service', instance)
+            alive.append(health['alive'])
+        assert alive == [True, True, True, True, True, False]
+
+        main.mark_instance_dead('auth_service', {"url": "http://auth2"})
+        assert services['auth_service']['health']["http://auth2"]['alive'] is True
+
+
+class TestUpstreamClients:
+    def test_client_is_shared_per_service(self, monkeypatch):
+        monkeypatch.setattr(main, 'upstream_clients', {})
+        client = main.get_upstream_client('auth_service')
+        assert main.get_upstream_client('auth_service') is client
+        assert main.get_upstream_client('matching_service') is not client
+
+
+def make_token(sub, key="test-key", hours=12, issuer="Random_chats auth service", jti=None):
+    payload = {
+        "iss": issuer,
+        "token_type": "access",
+        "sub": sub,
+        "exp": datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=hours)
+    }
+    if jti:
+        payload["jti"] = jti
+    return jwt.encode(payload, key, algorithm="HS256")
+
+
+class TestLocalTokenValidation:
+    @pytest.fixture(autouse=True)
+    def local_mode(self, monkeypatch):
+        monkeypatch.setattr(main, 'TOKEN_VALIDATION_MODE', 'local')
+        monkeypatch.setattr(main, 'JWT_KEY', 'test-key')
+        monkeypatch.setattr(main, 'revoked_tokens', set())
+
+    @pytest.mark.asyncio
+    async def test_valid_token(self):
+        assert await main.validate_token(make_token("123"), "123") is True
+
+    @pytest.mark.asyncio
+    async def test_token_of_other_user(self):
+        assert await main.validate_token(make_token("123"), "456") is False
+
+    @pytest.mark.asyncio
+    async def test_expired_token(self):
+        assert await main.validate_token(make_token("123", hours=-1), "123") is False
+
+    @pytest.mark.asyncio
+    async def test_wrong_signature_and_issuer(self):
+        assert await main.validate_token(make_token("123", key="other-key"), "123") is False
+        assert await main.validate_token(make_token("123", issuer="someone"), "123") is False
+
+    @pytest.mark.asyncio
+    async def test_revoked_token(self, monkeypatch):
+        token = make_token("123")
+        monkeypatch.setattr(main, 'revoked_tokens', {main.token_fingerprint(token)})
+        assert await main.validate_token(token, "123") is False
+
+    @pytest.mark.asyncio
+    async def test_token_revoked_by_jti(self, monkeypatch):
+        monkeypatch.setattr(main, 'revoked_tokens', {"a1b2"})
+        assert await main.validate_token(make_token("123", jti="a1b2"), "123") is False
+        assert await main.validate_token(make_token("123", jti="c3d4"), "123") is True
+
+
+class TestTokenCache:
+    @pytest.fixture(autouse=True)
+    def remote_mode(self, monkeypatch):
+        monkeypatch.setattr(main, 'TOKEN_VALIDATION_MODE', 'remote')
+        monkeypatch.setattr(main, 'token_cache', main.TLRUCache(maxsize=10, ttu=lambda k, v, now: v[1], timer=time.time))
+        monkeypatch.setattr(main, 'token_cache_stats', {'hits': 0, 'misses': 0, 'negative_hits': 0})
+
+    @pytest.mark.asyncio
+    async def test_positive_result_is_cached(self):
+        token = make_token("123")
+        with patch('main.check_token_remotely', new_callable=AsyncMock, return_value=True) as mock_check:
+            assert await main.validate_token(token, "123") is True
+            assert await main.validate_token(token, "123") is True
+            mock_check.assert_awaited_once()
+        assert main.token_cache_stats['hits'] == 1
+        assert main.token_cache_stats['misses'] == 1
+
+    @pytest.mark.asyncio
+    async def test_negative_result_is_cached(self):
+        token = make_token("123")
+        with patch('main.check_token_remotely', new_callable=AsyncMock, return_value=False) as mock_check:
+            assert await main.validate_token(token, "123") is False
+            assert await main.validate_token(token, "123") is False
+            mock_check.assert_awaited_once()
+        assert main.token_cache_stats['negative_hits'] == 1
+
+    @pytest.mark.asyncio
+    async def test_unavailable_auth_is_not_cached(self):
+        token = make_token("123")
+        with patch('main.check_token_remotely', new_callable=AsyncMock, return_value=None) as mock_check:
+            assert await main.validate_token(token, "123") is False
+            assert await main.validate_token(token, "123") is False
+            assert mock_check.await_count == 2
+
+    def test_entry_never_outlives_token(self):
+        token = make_token("123", hours=-1)
+        assert main.token_cache_expiry(token, True) <= time.time()
+        assert main.token_cache_expiry(make_token("123"), True) <= time.time() + main.TOKEN_CACHE_TTL
+
+
+class ChunkedStream(httpx.AsyncByteStream):
+    async def __aiter__(self):
+        for _ in range(10):
+            yield b"x" * 10000
+
+
+class TestStreamingProxy:
+    @pytest.fixture
+    def upstream(self, monkeypatch):
+        received = []
+
+        def handler(request):
+            received.append(request)
+            return httpx.Response(200, stream=ChunkedStream(), headers={'content-type': 'application/octet-stream'})
+
+        monkeypatch.setitem(main.upstream_clients, 'auth_service',
+                            httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+        return received
+
+    def test_response_is_streamed_back(self, services, upstream):
+        client = TestClient(main.app)
+        response = client.post("/login", json={"email": "user@example.com", "password": "password"})
+        assert response.status_code == 200
+        assert response.content == b"x" * 100000
+        assert upstream[0].url.path == "/login"
+        assert b"user@example.com" in upstream[0].read()
+        assert all(stats['in_flight'] == 0 for stats in services['auth_service']['stats'].values())
+        assert services['auth_service']['admission']['admitted'] == 0
+
+    @pytest.mark.asyncio
+    async def test_instance_is_released_when_body_is_never_sent(self, services, upstream):
+        instance = services['auth_service']['instances'][0]
+        main.acquire_instance('auth_service', instance)
+        client = main.get_upstream_client('auth_service')
+        upstream_response = await client.send(client.build_request('GET', "http://auth1/login"), stream=True)
+        response = main.UpstreamResponse(upstream_response, 'auth_service', instance, 0.01)
+
+        async def disconnected_send(message):
+            raise OSError("client disconnected")
+
+        async def receive():
+            return {'type': 'http.disconnect'}
+
+        with pytest.raises(Exception):
+            await response({'type': 'http'}, receive, disconnected_send)
+        assert upstream_response.is_closed
+        assert services['auth_service']['stats']["http://auth1"]['in_flight'] == 0
+
+    def test_request_body_is_streamed_without_retries(self, monkeypatch, upstream):
+        monkeypatch.setattr(main, 'services', {'auth_service': make_service("http://auth1")})
+        client = TestClient(main.app)
+        response = client.post("/register", content=b"y" * 50000)
+        assert response.status_code == 200
+        assert upstream[0].read() == b"y" * 50000
+
+
+class TestBalancingStrategies:
+    @pytest.fixture
+    def balanced(self, monkeypatch):
+        def factory(strategy):
+            service = main.init_service([{"url": "http://a"}, {"url": "http://b"}], strategy)
+            monkeypatch.setattr(main, 'services', {'message_service': service})
+            return service
+        return factory
+
+    @pytest.mark.asyncio
+    async def test_least_outstanding_prefers_idle_instance(self, balanced):
+        service = balanced('least_outstanding')
+        main.acquire_instance('message_service', {"url": "http://a"})
+        picked = {(await main.get_work_instance('message_service'))['url'] for _ in range(4)}
+        assert picked == {"http://b"}
+        main.release_instance('message_service', {"url": "http://a"}, 0.01)
+        assert service['stats']["http://a"]['in_flight'] == 0
+
+    @pytest.mark.asyncio
+    async def test_p2c_ewma_avoids_slow_instance(self, balanced):
+        service = balanced('p2c_ewma')
+        service['stats']["http://a"]['ewma'] = 2.0
+        service['stats']["http://b"]['ewma'] = 0.01
+        picked = {(await main.get_work_instance('message_service'))['url'] for _ in range(10)}
+        assert picked == {"http://b"}
+
+    def test_ewma_is_updated_on_release(self, balanced):
+        service = balanced('p2c_ewma')
+        main.acquire_instance('message_service', {"url": "http://a"})
+        main.release_instance('message_service', {"url": "http://a"}, 1.0)
+        main.acquire_instance('message_service', {"url": "http://a"})
+        main.release_instance('message_service', {"url": "http://a"}, 0.0)
+        assert service['stats']["http://a"]['ewma'] == pytest.approx(1.0 - main.EWMA_ALPHA)
+
+    def test_unknown_strategy_is_rejected(self, monkeypatch):
+        monkeypatch.setattr(main, 'SERVICE_BALANCING_STRATEGIES', {'auth_service': 'random'})
+        with pytest.raises(ValueError):
+            main.service_strategy('auth_service')
+
+
+class TestCircuitBreaker:
+    @pytest.mark.asyncio
+    async def test_breaker_opens_and_recovers(self, services, monkeypatch):
+        auth1 = {"url": "http://auth1"}
+        for _ in range(main.BREAKER_MIN_CALLS):
+            main.record_result('auth_service', auth1, False)
+        breaker = services['auth_service']['breakers']["http://auth1"]
+        assert breaker['state'] == 'open'
+        picked = {(await main.get_work_instance('auth_service'))['url'] for _ in range(4)}
+        assert picked == {"http://auth2"}
+
+        breaker['opened_at'] -= main.BREAKER_OPEN_SECONDS
+        assert main.breaker_allows(services['auth_service'], auth1)
+        assert breaker['state'] == 'half_open'
+        main.record_result('auth_service', auth1, True, 0.01)
+        assert breaker['state'] == 'closed'
+
+    def test_slow_calls_count_as_errors(self, services):
+        auth1 = {"url": "http://auth1"}
+        for _ in range(main.BREAKER_MIN_CALLS):
+            main.record_result('auth_service', auth1, True, main.BREAKER_SLOW_CALL_THRESHOLD + 1)
+        assert services['auth_service']['breakers']["http://auth1"]['state'] == 'open'
+
+    @pytest.mark.asyncio
+    async def test_retry_budget_limits_retries(self, monkeypatch):
+        monkeypatch.setattr(main, 'retry_budget', {'tokens': 1.0, 'updated_at': time.monotonic()})
+        monkeypatch.setattr(main, 'RETRY_BUDGET_MIN_PER_SECOND', 0)
+        monkeypatch.setattr(main, 'RETRY_BACKOFF_BASE', 0)
+        assert await main.allow_retry('auth_service', 1) is True
+        assert await main.allow_retry('auth_service', 2) is False
+
+
+class TestServiceRegistry:
+    @pytest.fixture(autouse=True)
+    def registry_token(self, monkeypatch):
+        monkeypatch.setattr(main, 'REGISTRY_TOKEN', "secret")
+
+    def test_register_heartbeat_and_deregister(self, services):
+        client = TestClient(main.app, headers={"X-Registry-Token": "secret"})
+        version = main.registry['version']
+        response = client.post("/registry/register", json={"service_name": "auth_service", "url": "http://auth3"})
+        assert response.status_code == 200
+        assert response.json()['version'] != version
+        assert "http://auth3" in [instance['url'] for instance in services['auth_service']['live']]
+
+        assert client.post("/registry/heartbeat",
+                           json={"service_name": "auth_service", "url": "http://auth3"}).status_code == 200
+        assert client.post("/registry/deregister",
+                           json={"service_name": "auth_service", "url": "http://auth3"}).status_code == 200
+        assert client.post("/registry/heartbeat",
+                           json={"service_name": "auth_service", "url": "http://auth3"}).status_code == 404
+
+    def test_registry_changes_require_secret(self, services, monkeypatch):
+        client = TestClient(main.app)
+        body = {"service_name": "auth_service", "url": "http://evil"}
+        assert client.post("/registry/register", json=body).status_code == 401
+        assert client.post("/registry/register", json=body, headers={"X-Registry-Token": "wrong"}).status_code == 401
+        monkeypatch.setattr(main, 'REGISTRY_TOKEN', None)
+        assert client.post("/registry/register", json=body, headers={"X-Registry-Token": "secret"}).status_code == 403
+        assert "http://evil" not in services['auth_service']['leases']
+
+    def test_config_instances_are_pinned(self, services):
+        client = TestClient(main.app, headers={"X-Registry-Token": "secret"})
+        body = {"service_name": "auth_service", "url": "http://auth1", "id": "evil"}
+        assert client.post("/registry/register", json=body).status_code == 409
+        assert client.post("/registry/deregister", json=body).status_code == 409
+        main.add_instance('auth_service', {"url": "http://auth1", "id": "evil"}, time.monotonic() + 30)
+        assert services['auth_service']['leases']["http://auth1"] is None
+        assert services['auth_service']['instances'][0] == {"url": "http://auth1"}
+
+    def test_expired_instances_are_removed(self, services):
+        main.add_instance('auth_service', {"url": "http://auth3"}, time.monotonic() - 1)
+        main.expire_instances()
+        assert [instance['url'] for instance in services['auth_service']['instances']] == ["http://auth1", "http://auth2"]
+
+    @pytest.mark.asyncio
+    async def test_watch_returns_on_change(self, services):
+        version = main.registry['version']
+        watcher = asyncio.create_task(main.watch_registry(version=version, timeout=5))
+        await asyncio.sleep(0)
+        main.add_instance('auth_service', {"url": "http://auth3"}, None)
+        snapshot = await asyncio.wait_for(watcher, timeout=1)
+        assert snapshot['version'] != version
+        assert {"url": "http://auth3"} in snapshot['services']['auth_service']
+
+
+class TestDiscovery:
+    def test_batched_discovery_with_etag(self, services):
+        services['message_service'] = make_service("http://msg1")
+        client = TestClient(main.app)
+        response = client.get("/discovery", params={"service_names": "auth_service,message_service"})
+        assert response.status_code == 200
+        assert set(response.json()['services']) == {'auth_service', 'message_service'}
+        assert response.headers['cache-control'] == f"max-age={main.DISCOVERY_MAX_AGE}"
+
+        cached = client.get("/discovery", params={"service_names": "auth_service"},
+                            headers={"If-None-Match": response.headers['etag']})
+        assert cached.status_code == 304
+
+    def test_unknown_service(self, services):
+        client = TestClient(main.app)
+        assert client.get("/discovery", params={"service_names": "nope"}).status_code == 404
+
+    def test_version_depends_only_on_live_instances(self, services):
+        main.bump_registry_version()
+        version = main.registry['version']
+        main.add_instance('auth_service', {"url": "http://auth3"}, time.monotonic() + 30)
+        assert main.registry['version'] != version
+        main.remove_instance('auth_service', "http://auth3")
+        assert main.registry['version'] == version
+
+
+class TestWebSocketPlacement:
+    @pytest.fixture
+    def handlers(self, monkeypatch):
+        service = main.init_service([{"id": "WSH1", "url": "http://wsh1"}, {"id": "WSH2", "url": "http://wsh2"}])
+        monkeypatch.setattr(main, 'services', {'websocket_handlers': service})
+        monkeypatch.setattr(main, 'WEBSOCKET_PLACEMENT', 'least_loaded')
+        monkeypatch.setattr(main, 'WEBSOCKET_HANDLER_CAPACITY', 3)
+        loads = {"WSH1": 2, "WSH2": 0}
+        monkeypatch.setattr(main, 'handler_loads', loads)
+        return loads
+
+    @pytest.mark.asyncio
+    async def test_least_loaded_handler_is_chosen(self, handlers):
+        picked = [(await main.place_websocket_handler("1"))['id'] for _ in range(3)]
+        assert picked == ["WSH2", "WSH2", "WSH1"]
+        assert handlers == {"WSH1": 3, "WSH2": 2}
+
+    @pytest.mark.asyncio
+    async def test_saturated_handlers_are_refused(self, handlers):
+        handlers.update({"WSH1": 3, "WSH2": 3})
+        with pytest.raises(main.HTTPException) as error:
+            await main.place_websocket_handler("1")
+        assert error.value.status_code == 503
+
+
+class TestConsistentHashPlacement:
+    @pytest.fixture
+    def handlers(self, monkeypatch):
+        instances = [{"id": f"WSH{i}", "url": f"http://wsh{i}"} for i in range(4)]
+        monkeypatch.setattr(main, 'services', {'websocket_handlers': main.init_service(instances)})
+        monkeypatch.setattr(main, 'WEBSOCKET_PLACEMENT', 'consistent_hash')
+        monkeypatch.setattr(main, 'WEBSOCKET_HASH_KEY', 'chat_pair')
+        monkeypatch.setattr(main, 'handler_loads', {})
+        return instances
+
+    @pytest.mark.asyncio
+    async def test_chat_partners_share_handler(self, handlers):
+        main.handler_loads.update({handler['id']: 100 for handler in handlers})
+        first = await main.place_websocket_handler("111", "222")
+        second = await main.place_websocket_handler("222", "111")
+        assert first is second
+
+    @pytest.mark.asyncio
+    async def test_same_user_is_routed_consistently(self, handlers, monkeypatch):
+        monkeypatch.setattr(main, 'WEBSOCKET_HASH_KEY', 'uid')
+        first = await main.place_websocket_handler("111")
+        main.handler_loads.clear()
+        assert await main.place_websocket_handler("111") is first
+
+    @pytest.mark.asyncio
+    async def test_load_is_bounded(self, handlers):
+        for uid in range(200):
+            await main.place_websocket_handler(str(uid))
+        bound = math.ceil(main.CONSISTENT_HASH_LOAD_FACTOR * 200 / len(handlers))
+        assert max(main.handler_loads.values()) <= bound
+
+
+class TestRateLimiting:
+    @pytest.fixture(autouse=True)
+    def limits(self, monkeypatch):
+        monkeypatch.setattr(main, 'RATE_LIMITS', {'/login': {'rate': 0.01, 'burst': 2}})
+        monkeypatch.setattr(main, 'RATE_LIMIT_BACKEND', 'memory')
+        monkeypatch.setattr(main, 'rate_limit_buckets', main.TTLCache(maxsize=100, ttl=1000, timer=time.monotonic))
+
+    def test_burst_then_429(self, services, monkeypatch):
+        monkeypatch.setitem(main.upstream_clients, 'auth_service',
+                            httpx.AsyncClient(transport=httpx.MockTransport(
+                                lambda request: httpx.Response(200, stream=ChunkedStream()))))
+        client = TestClient(main.app)
+        statuses = [client.post("/login", json={}).status_code for _ in range(3)]
+        assert statuses == [200, 200, 429]
+        response = client.post("/login", json={})
+        assert int(response.headers['retry-after']) > 0
+
+    def test_rotating_uids_does_not_bypass_ip_limit(self, services, monkeypatch):
+        monkeypatch.setattr(main, 'RATE_LIMITS', {'/matching': {'rate': 0.01, 'burst': 2}})
+        validate = AsyncMock(return_value=False)
+        monkeypatch.setattr(main, 'validate_token', validate)
+        client = TestClient(main.app)
+        statuses = [client.post("/matching", json={"token": "t", "uid": f"u{n}"}).status_code for n in range(50)]
+        assert statuses[:2] == [401, 401]
+        assert set(statuses[2:]) == {429}
+        assert validate.await_count == 2
+
+    def test_uid_limit_applies_after_validation(self, services, monkeypatch):
+        monkeypatch.setattr(main, 'RATE_LIMITS', {'/matching': {'rate': 0.01, 'burst': 1, 'ip_burst': 10}})
+        monkeypatch.setattr(main, 'validate_token', AsyncMock(return_value=True))
+        monkeypatch.setitem(main.upstream_clients, 'matching_service', httpx.AsyncClient(
+            transport=httpx.MockTransport(lambda request: httpx.Response(200, stream=ChunkedStream()))))
+        monkeypatch.setitem(main.services, 'matching_service', make_service("http://match1"))
+        client = TestClient(main.app)
+        statuses = [client.post("/matching", json={"token": "t", "uid": "u1"}).status_code for _ in range(2)]
+        assert statuses == [200, 429]
+        assert client.post("/matching", json={"token": "t", "uid": "u2"}).status_code == 200
+
+    def test_buckets_are_per_client(self):
+        assert main.take_token_locally("/login:uid:1", 0.01, 1) == 0
+        assert main.take_token_locally("/login:uid:1", 0.01, 1) > 0
+        assert main.take_token_locally("/login:uid:2", 0.01, 1) == 0
+
+
+class TestHedging:
+    @pytest.fixture
+    def hedged(self, monkeypatch, services):
+        calls = []
+
+        async def handler(request):
+            calls.append(request.url.host)
+            if request.url.host == "auth1":
+                await asyncio.sleep(1)
+            return httpx.Response(200, stream=ChunkedStream())
+
+        monkeypatch.setitem(main.upstream_clients, 'auth_service',
+                            httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+        monkeypatch.setattr(main, 'HEDGING_ROUTES', ['/token_check'])
+        services['auth_service']['latencies'].extend([0.01] * main.HEDGE_MIN_SAMPLES)
+        return calls
+
+    @pytest.mark.asyncio
+    async def test_slow_request_is_hedged_to_other_instance(self, services, hedged):
+        instance, response, _ = await main.send_hedged('auth_service', {"url": "http://auth1"}, 'GET',
+                                                       '/token_check?token=t&uid=1', {}, b"")
+        await response.aclose()
+        assert instance['url'] == "http://auth2"
+        assert hedged == ["auth1", "auth2"]
+        assert all(stats['in_flight'] <= 1 for stats in services['auth_service']['stats'].values())
+        assert services['auth_service']['stats']["http://auth1"]['in_flight'] == 0
+
+    @pytest.mark.asyncio
+    async def test_hedge_rate_is_capped(self, services, hedged):
+        services['auth_service']['hedge_tokens'] = 0
+        instance, response, _ = await main.send_hedged('auth_service', {"url": "http://auth1"}, 'GET',
+                                                       '/token_check', {}, b"")
+        await response.aclose()
+        assert instance['url'] == "http://auth1"
+        assert hedged == ["auth1"]
+
+    @pytest.mark.asyncio
+    async def test_hedge_burst_is_fixed(self, services, hedged, monkeypatch):
+        monkeypatch.setattr(main, 'HEDGE_MAX_RATE', 0.01)
+        services['auth_service']['hedge_tokens'] = 0
+        services['auth_service']['latencies'].clear()
+        for _ in range(1000):
+            instance, response, _ = await main.send_hedged('auth_service', {"url": "http://auth2"}, 'GET',
+                                                           '/token_check', {}, b"")
+            await response.aclose()
+        assert services['auth_service']['hedge_tokens'] == main.HEDGE_BURST
+
+    @pytest.mark.asyncio
+    async def test_no_hedging_without_latency_samples(self, services, hedged):
+        services['auth_service']['latencies'].clear()
+        instance, response, _ = await main.send_hedged('auth_service', {"url": "http://auth1"}, 'GET',
+                                                       '/token_check', {}, b"")
+        await response.aclose()
+        assert hedged == ["auth1"]
+
+
+class TestAdmissionControl:
+    @pytest.fixture
+    def saturated(self, services):
+        service = services['auth_service']
+        service['admission']['limit'] = 10.0
+        service['admission']['admitted'] = 9
+        return service
+
+    def test_low_priority_request_is_shed(self, saturated):
+        client = TestClient(main.app)
+        response = client.post("/login", json={"email": "user@example.com", "password": "password"})
+        assert response.status_code == 503
+        assert response.headers['retry-after'] == "1"
+        assert saturated['admission']['shed'] == 1
+
+    def test_priority_route_is_admitted(self, saturated):
+        assert main.admission_exceeded('auth_service', '/token_login') is False
+        assert main.admission_exceeded('auth_service', '/login') is True
+
+    def test_logs_are_limited_by_own_concurrency(self, saturated, monkeypatch):
+        client = TestClient(main.app)
+        assert client.get("/logs").status_code == 200
+        monkeypatch.setitem(main.logs_readers, 'active', main.LOGS_MAX_CONCURRENCY)
+        assert client.get("/logs").status_code == 503
+
+    @pytest.mark.asyncio
+    async def test_slot_is_reserved_at_admission(self, services, monkeypatch):
+        services['auth_service']['admission']['limit'] = 2.0
+        monkeypatch.setattr(main, 'ADMISSION_LOW_PRIORITY_SHARE', 1.0)
+        get_work_instance = main.get_work_instance
+
+        async def slow_get_work_instance(service_name):
+            await asyncio.sleep(0.05)
+            return await get_work_instance(service_name)
+
+        monkeypatch.setattr(main, 'get_work_instance', slow_get_work_instance)
+        monkeypatch.setitem(main.upstream_clients, 'auth_service', httpx.AsyncClient(
+            transport=httpx.MockTransport(lambda request: httpx.Response(200, stream=ChunkedStream()))))
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://gateway") as client:
+            responses = await asyncio.gather(*[client.post("/login", json={}) for _ in range(5)])
+        assert sorted(response.status_code for response in responses) == [200, 200, 503, 503, 503]
+        assert services['auth_service']['admission']['admitted'] == 0
+
+    @pytest.mark.asyncio
+    async def test_remote_token_check_releases_slot(self, services, monkeypatch):
+        monkeypatch.setitem(main.upstream_clients, 'auth_service', httpx.AsyncClient(
+            transport=httpx.MockTransport(lambda request: httpx.Response(401, json={'detail': 'invalid'}))))
+        assert await main.check_token_remotely("t", "1", '/matching') is False
+        assert services['auth_service']['admission']['admitted'] == 0
+
+    def test_limit_follows_aimd(self, services):
+        admission = services['auth_service']['admission']
+        admission['limit'] = 10.0
+        main.update_concurrency_limit('auth_service', False)
+        assert admission['limit'] == pytest.approx(10.1)
+        main.update_concurrency_limit('auth_service', True)
+        assert admission['limit'] == pytest.approx(10.1 * main.ADMISSION_DECREASE_RATIO)
+        main.update_concurrency_limit('auth_service', True)
+        assert admission['limit'] == pytest.approx(10.1 * main.ADMISSION_DECREASE_RATIO)
+
+
+class TestCoalescing:
+    @pytest.mark.asyncio
+    async def test_identical_token_checks_share_one_upstream_call(self, monkeypatch, services):
+        calls = []
+
+        async def handler(request):
+            calls.append(request.url.query)
+            await asyncio.sleep(0.05)
+            return httpx.Response(200, stream=ChunkedStream())
+
+        monkeypatch.setitem(main.upstream_clients, 'auth_service',
+                            httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://gateway") as client:
+            responses = await asyncio.gather(*[client.get("/token_check", params={"token": "t", "uid": "1"})
+                                               for _ in range(5)])
+        assert all(response.content == b"x" * 100000 for response in responses)
+        assert len(calls) == 1
+        assert main.inflight_calls == {}
+        assert services['auth_service']['admission']['admitted'] == 0
+
+    @pytest.mark.asyncio
+    async def test_different_credentials_are_not_coalesced(self, monkeypatch, services):
+        calls = []
+
+        async def handler(request):
+            calls.append(request.headers.get('cookie'))
+            await asyncio.sleep(0.05)
+            return httpx.Response(200, stream=ChunkedStream())
+
+        monkeypatch.setitem(main.upstream_clients, 'auth_service',
+                            httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://gateway") as client:
+            await asyncio.gather(*[client.get("/token_check", params={"token": "t", "uid": "1"},
+                                              headers={"Cookie": f"session={n % 2}"}) for n in range(4)])
+        assert sorted(calls) == ["session=0", "session=1"]
+
+    @pytest.mark.asyncio
+    async def test_errors_are_shared_and_not_cached(self):
+        calls = []
+
+        async def failing():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            raise RuntimeError("upstream failed")
+
+        results = await asyncio.gather(*[main.single_flight(('test',), failing) for _ in range(3)],
+                                       return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+        assert len(calls) == 1
+        with pytest.raises(RuntimeError):
+            await main.single_flight(('test',), failing)
+        assert len(calls) == 2
+
+
+class TestBenchmark:
+    @pytest.mark.asyncio
+    async def test_benchmark_reports_latency_percentiles(self, monkeypatch):
+        import benchmark
+        monkeypatch.setattr(main, 'services', dict(main.services))
+        monkeypatch.setattr(main, 'upstream_clients', {})
+        monkeypatch.setattr(main, 'RATE_LIMITS', main.RATE_LIMITS)
+        results = await benchmark.run_benchmark(['login', 'get_websocket_handler'], total=20, concurrency=5)
+        for result in results.values():
+            assert result['statuses'] == {'200': 20}
+            assert 0 < result['p50_ms'] <= result['p95_ms'] <= result['p99_ms']
+
+
+class TestSharedState:
+    @pytest.fixture
+    def shared(self, monkeypatch, services):
+        client = AsyncMock()
+        monkeypatch.setattr(main, 'SHARED_STATE_BACKEND', 'redis')
+        monkeypatch.setattr(main, 'redis_client', client)
+        return client
+
+    @pytest.mark.asyncio
+    async def test_round_robin_pointer_is_shared(self, shared):
+        shared.incr.side_effect = [1, 2, 3]
+        picked = [(await main.get_work_instance('auth_service'))['url'] for _ in range(3)]
+        assert picked == ["http://auth2", "http://auth1", "http://auth2"]
+        shared.incr.assert_awaited_with("gateway:rr:auth_service")
+
+    @pytest.mark.asyncio
+    async def test_round_robin_falls_back_to_local_pointer(self, shared):
+        shared.incr.side_effect = ConnectionError("redis is down")
+        picked = {(await main.get_work_instance('auth_service'))['url'] for _ in range(2)}
+        assert picked == {"http://auth1", "http://auth2"}
+
+    @pytest.mark.asyncio
+    async def test_worker_without_lease_loads_shared_health(self, services, shared):
+        shared.set.return_value = None
+        shared.hgetall.return_value = {
+            b"auth_service|http://auth1": b'{"alive": false, "latency": null, "checked_at": 1.0}'
+        }
+        with patch('main.probe_instance', new_callable=AsyncMock) as mock_probe:
+            await main.check_all_instances()
+        mock_probe.assert_not_awaited()
+        assert [instance['url'] for instance in services['auth_service']['live']] == ["http://auth2"]
+
+    def test_registration_with_explicit_ttl(self, services, shared, monkeypatch):
+        monkeypatch.setattr(main, 'REGISTRY_TOKEN', "secret")
+        client = TestClient(main.app, headers={"X-Registry-Token": "secret"})
+        body = {"service_name": "auth_service", "url": "http://auth3", "ttl": 30}
+        assert client.post("/registry/register", json=body).status_code == 200
+        assert shared.set.await_args.kwargs == {'px': 30000}
+        shared.pexpire.return_value = True
+        assert client.post("/registry/heartbeat", json={**body, "ttl": 1.5}).status_code == 200
+        shared.pexpire.assert_awaited_with(main.shared_instance_key('auth_service', "http://auth3"), 1500)
+        assert client.post("/registry/register", json={**body, "ttl": 0}).status_code == 400
+        assert client.post("/registry/heartbeat", json={**body, "ttl": -1}).status_code == 400
+
+    def test_failed_shared_registration_leaves_local_registry_unchanged(self, services, shared, monkeypatch):
+        monkeypatch.setattr(main, 'REGISTRY_TOKEN', "secret")
+        shared.set.side_effect = ConnectionError("redis is down")
+        client = TestClient(main.app, headers={"X-Registry-Token": "secret"}, raise_server_exceptions=False)
+        body = {"service_name": "auth_service", "url": "http://auth3", "ttl": 30}
+        assert client.post("/registry/register", json=body).status_code == 500
+        assert "http://auth3" not in services['auth_service']['leases']
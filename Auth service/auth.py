@@ -1,12 +1,24 @@
 import uvicorn
+import asyncio
+import time
 import random
 import hashlib
+import hmac
+import base64
+import os
+import uuid
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 import jwt
 import asyncpg
 import json
-from fastapi import FastAPI, HTTPException, Depends
+import csv
+import redis.asyncio as redis
+from cachetools import TTLCache
+from fastapi import FastAPI, HTTPException, Depends, Header, Request
 from pydantic import BaseModel
+from typing import AsyncIterator, List, Optional
 from fastapi.responses import HTMLResponse
 import logging
 
@@ -24,6 +36,45 @@ PASSWORD_ENCRYPTION_KEY = config['password_key']
 API_GATEWAY_URL = config.get('api_gateway_url', 'http://localhost:8300')
 MAX_ATTEMPTS = config.get('max_attempts', 5)
 
+DB_POOL_MIN_SIZE = config.get('db_pool_min_size', 5)
+DB_POOL_MAX_SIZE = config.get('db_pool_max_size', 20)
+DB_POOL_ACQUIRE_TIMEOUT = config.get('db_pool_acquire_timeout', 5)
+DB_STATEMENT_CACHE_SIZE = config.get('db_statement_cache_size', 1024)
+DB_MAX_INACTIVE_CONNECTION_LIFETIME = config.get('db_max_inactive_connection_lifetime', 300)
+DB_COMMAND_TIMEOUT = config.get('db_command_timeout', 10)
+DB_ENSURE_INDEXES = config.get('db_ensure_indexes', True)
+
+PASSWORD_KDF = config.get('password_kdf', 'scrypt')
+PBKDF2_ITERATIONS = config.get('pbkdf2_iterations', 600000)
+SCRYPT_N = config.get('scrypt_n', 2 ** 14)
+SCRYPT_R = config.get('scrypt_r', 8)
+SCRYPT_P = config.get('scrypt_p', 1)
+HASH_WORKERS = config.get('hash_workers', 4)
+
+TOKEN_ISSUER = 'Random_chats auth service'
+TOKEN_LIFETIMES = {'access': 12, 'refresh': 96}
+TOKEN_CHECK_MODE = config.get('token_check_mode', 'session')
+REVOKED_TOKENS_REFRESH_INTERVAL = config.get('revoked_tokens_refresh_interval', 10)
+SESSION_PURGE_INTERVAL = config.get('session_purge_interval', 3600)
+
+PROFILE_CACHE_SIZE = config.get('profile_cache_size', 10000)
+PROFILE_CACHE_TTL = config.get('profile_cache_ttl', 60)
+PROFILE_CACHE_BACKEND = config.get('profile_cache_backend', 'memory')
+REDIS_URL = config.get('redis_url', 'redis://localhost:6379/0')
+BATCH_MAX_UIDS = config.get('batch_max_uids', 500)
+UID_BLOCK_SIZE = config.get('uid_block_size', 100)
+IMPORT_BATCH_SIZE = config.get('import_batch_size', 1000)
+IMPORT_MAX_REPORTED_FAILURES = config.get('import_max_reported_failures', 1000)
+IMPORT_HASH_WORKERS = config.get('import_hash_workers', 2)
+IMPORT_TOKEN = config.get('import_token')
+
+if PROFILE_CACHE_BACKEND not in ('memory', 'redis'):
+    raise ValueError(f"Неизвестное хранилище кэша профилей: {PROFILE_CACHE_BACKEND}")
+if TOKEN_CHECK_MODE not in ('session', 'stateless'):
+    raise ValueError(f"Неизвестный режим проверки токенов: {TOKEN_CHECK_MODE}")
+if PASSWORD_KDF not in ('scrypt', 'pbkdf2_sha256'):
+    raise ValueError(f"Неизвестная функция хеширования паролей: {PASSWORD_KDF}")
+
 app = FastAPI(title="Auth Service")
 
 logging.basicConfig(level=logging.INFO,
@@ -34,20 +85,344 @@ logging.basicConfig(level=logging.INFO,
                     ])
 logger = logging.getLogger("Auth Service")
 
+# Пул потоков для хеширования паролей: hashlib освобождает GIL, поэтому хеширование не блокирует цикл событий
+hash_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix='password-hash')
+# Отдельный пул для массового импорта, чтобы импорт не задерживал хеширование при входе и регистрации
+import_hash_executor = ThreadPoolExecutor(max_workers=IMPORT_HASH_WORKERS, thread_name_prefix='import-hash')
+
+# Пул соединений с базой данных, создается при запуске сервиса
+db_pool = None
+db_pool_stats = {'acquired': 0, 'acquire_timeouts': 0, 'acquire_wait_total': 0.0}
+
+# Запросы к таблице пользователей: каждый выбирает только нужные обработчику столбцы.
+# Текст запросов неизменен, поэтому asyncpg готовит запрос при первом выполнении на соединении, а затем берет
+# подготовленный запрос из кэша соединения (db_statement_cache_size)
+USER_QUERIES = {
+    'email_exists': "SELECT 1 FROM users2 WHERE email = $1",
+    'credentials_by_email': "SELECT uid, password FROM users2 WHERE email = $1",
+    'tokens_by_uid': "SELECT uid, access_token, refresh_token FROM users2 WHERE uid = $1",
+    'profile_by_uid': "SELECT username, sex, age, preffered_age, preffered_sex FROM users2 WHERE uid = $1",
+    'profiles_by_uids': "SELECT uid, username, sex, age, preffered_age, preffered_sex FROM users2 "
+                        "WHERE uid = ANY($1::text[])",
+}
+
+# Сессии хранятся отдельно от users2: по одной строке на выданный токен с идентификатором jti
+SESSION_TABLE_QUERY = """
+    CREATE TABLE IF NOT EXISTS user_sessions (
+        jti text PRIMARY KEY,
+        uid text NOT NULL,
+        token_type text NOT NULL,
+        expires_at timestamptz NOT NULL,
+        revoked boolean NOT NULL DEFAULT false
+    );
+    CREATE INDEX IF NOT EXISTS user_sessions_active_uid_idx ON user_sessions (uid) WHERE NOT revoked;
+"""
+
+SESSION_QUERIES = {
+    'insert': "INSERT INTO user_sessions (jti, uid, token_type, expires_at) VALUES ($1, $2, $3, $4)",
+    'is_active': "SELECT 1 FROM user_sessions WHERE jti = $1 AND NOT revoked AND expires_at > now()",
+    'revoke_by_uid': "UPDATE user_sessions SET revoked = true "
+                     "WHERE uid = $1 AND token_type = ANY($2::text[]) AND NOT revoked",
+    'revoked_jtis': "SELECT jti FROM user_sessions WHERE revoked AND expires_at > now()",
+    'purge_expired': "DELETE FROM user_sessions WHERE expires_at <= now()",
+}
+
+# UID выдаются из последовательности users2_uid_seq блоками: одно обращение к базе данных резервирует блок,
+# а UID внутри блока выдаются без запросов. Значения последовательности всегда 12-значные.
+# Размер блока - шаг последовательности. uid_block_size задает его только при создании последовательности,
+# а все экземпляры берут шаг из базы данных, поэтому блоки не пересекаются при разных настройках экземпляров
+UID_SEQUENCE_QUERY = f"""
+    CREATE SEQUENCE IF NOT EXISTS users2_uid_seq
+        START WITH 100000000000 MINVALUE 100000000000 MAXVALUE 999999999999 INCREMENT BY {UID_BLOCK_SIZE}
+"""
+UID_BLOCK_SIZE_QUERY = """
+    SELECT increment_by FROM pg_sequences WHERE schemaname = current_schema() AND sequencename = 'users2_uid_seq'
+"""
+UID_BLOCK_QUERY = "SELECT nextval('users2_uid_seq')"
+uid_allocator = {'next': 0, 'end': 0, 'block_size': UID_BLOCK_SIZE, 'lock': asyncio.Lock()}
+
+REGISTER_QUERY = """
+    INSERT INTO users2 (uid, email, password, username, sex, age, preffered_age, preffered_sex, avatar_code, access_token, refresh_token)
+    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, NULL, NULL)
+    ON CONFLICT DO NOTHING
+    RETURNING uid
+"""
+
+# Массовый импорт: пакет строк копируется командой COPY во временную таблицу, откуда переносится в users2 одним
+# запросом. ON CONFLICT пропускает занятые email, а RETURNING сообщает, какие строки вставлены
+IMPORT_COLUMNS = ('uid', 'email', 'password', 'username', 'sex', 'age', 'preffered_age', 'preffered_sex', 'avatar_code')
+IMPORT_QUERIES = {
+    'create_staging': "CREATE TEMP TABLE users2_import (LIKE users2 INCLUDING DEFAULTS) ON COMMIT DROP",
+    'move_staging': f"""
+        INSERT INTO users2 ({', '.join(IMPORT_COLUMNS)})
+        SELECT {', '.join(IMPORT_COLUMNS)} FROM users2_import
+        ON CONFLICT DO NOTHING
+        RETURNING email
+    """,
+    'existing_emails': "SELECT email FROM users2 WHERE email = ANY($1::text[])",
+}
+IMPORT_FORMATS = ('ndjson', 'csv')
+
+# Кэш профилей пользователей по uid для /matching_info и /get_info_by_id
+profile_cache = TTLCache(maxsize=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL)
+profile_cache_stats = {'hits': 0, 'shared_hits': 0, 'misses': 0}
+
+# Клиент Redis создается только для общего между экземплярами кэша профилей
+redis_client = redis.from_url(REDIS_URL) if PROFILE_CACHE_BACKEND == 'redis' else None
+
+# Идентификаторы отозванных, но еще не истекших токенов для проверки без обращения к базе данных
+revoked_jtis = set()
+background_tasks = []
+
+# Столбцы, по которым ищутся пользователи и которые должны иметь уникальный индекс
+UNIQUE_USER_COLUMNS = ('uid', 'email')
+
+
+async def ensure_user_indexes(connection):
+    """
+    Проверяет, что столбцы uid и email таблицы users2 имеют уникальные индексы, и создает недостающие.
 
-async def get_db_connection():
+    :param connection: Соединение с базой данных.
+    """
+    query = """
+        SELECT a.attname
+        FROM pg_index i
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+        WHERE i.indrelid = 'users2'::regclass AND i.indisunique AND i.indnatts = 1
+    """
+    indexed = {row['attname'] for row in await connection.fetch(query)}
+    for column in UNIQUE_USER_COLUMNS:
+        if column in indexed:
+            continue
+        logger.warning(f"Столбец users2.{column} не имеет уникального индекса, индекс будет создан")
+        try:
+            await connection.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS users2_{column}_key ON users2 ({column})")
+        except asyncpg.PostgresError as e:
+            logger.error(f"Не удалось создать уникальный индекс для users2.{column}: {e}")
+            raise
+
+
+async def prepare_uid_sequence(connection):
+    """
+    Создает последовательность UID, если ее нет, и берет из нее размер блока UID.
+
+    :param connection: Соединение с базой данных.
+    """
+    await connection.execute(UID_SEQUENCE_QUERY)
+    block_size = await connection.fetchval(UID_BLOCK_SIZE_QUERY)
+    if block_size != UID_BLOCK_SIZE:
+        logger.warning(f"Шаг последовательности users2_uid_seq равен {block_size}, uid_block_size={UID_BLOCK_SIZE} "
+                       f"не применяется")
+    uid_allocator['block_size'] = block_size
+
+
+async def fetch_user(db, query_name: str, *args):
+    """
+    Выполняет запрос из USER_QUERIES и возвращает одну строку.
+
+    :param db: Подключение к базе данных.
+    :param query_name: Название запроса.
+    :param args: Параметры запроса.
+    :return: Строка результата или None, если пользователь не найден.
+    """
+    return await db.fetchrow(USER_QUERIES[query_name], *args)
+
+
+@app.on_event("startup")
+async def startup_event():
+    """Создание пула соединений, таблицы сессий, проверка индексов и запуск обслуживания сессий при запуске сервиса."""
+    global db_pool
+    logger.info(f"Создание пула соединений с базой данных с параметрами пользователя {config['user']}")
     try:
-        logger.info(f"Подключение к базе данных с параметрами пользователя {config['user']}")
-        return await asyncpg.connect(
+        db_pool = await asyncpg.create_pool(
             user=config['user'],
             password=config['password'],
             database=config['database'],
             host=config['db_host'],
-            port=config['db_port']
+            port=config['db_port'],
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+            max_inactive_connection_lifetime=DB_MAX_INACTIVE_CONNECTION_LIFETIME,
+            command_timeout=DB_COMMAND_TIMEOUT
         )
     except Exception as e:
         logger.error(f"Ошибка подключения к базе данных: {e}")
         raise
+    async with db_pool.acquire() as connection:
+        await connection.execute(SESSION_TABLE_QUERY)
+        await prepare_uid_sequence(connection)
+        if DB_ENSURE_INDEXES:
+            await ensure_user_indexes(connection)
+    if TOKEN_CHECK_MODE == 'stateless':
+        await refresh_revoked_jtis()
+    background_tasks.append(asyncio.create_task(session_monitor()))
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Остановка фоновых задач, закрытие пула соединений и пула хеширования при завершении работы сервиса."""
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+    if db_pool is not None:
+        await db_pool.close()
+    if redis_client is not None:
+        await redis_client.aclose()
+    hash_executor.shutdown(wait=False)
+    import_hash_executor.shutdown(wait=False)
+
+
+async def get_db_connection():
+    """
+    Выдает обработчику соединение из пула и возвращает его в пул после обработки запроса.
+
+    :return: Соединение с базой данных.
+    :raises HTTPException: 503, если свободное соединение не освободилось за db_pool_acquire_timeout секунд.
+    """
+    started = time.monotonic()
+    try:
+        connection = await db_pool.acquire(timeout=DB_POOL_ACQUIRE_TIMEOUT)
+    except asyncio.TimeoutError:
+        db_pool_stats['acquire_timeouts'] += 1
+        logger.error(f"Нет свободных соединений с базой данных в течение {DB_POOL_ACQUIRE_TIMEOUT} с")
+        raise HTTPException(status_code=503, detail="Database is busy")
+    db_pool_stats['acquired'] += 1
+    db_pool_stats['acquire_wait_total'] += time.monotonic() - started
+    try:
+        yield connection
+    finally:
+        await db_pool.release(connection)
+
+
+# Соединение из пула для обработчиков, которым база данных нужна не при каждом запросе
+db_connection = asynccontextmanager(get_db_connection)
+
+
+async def get_profile(uid: str):
+    """
+    Получает профиль пользователя из кэша процесса, общего кэша в Redis или базы данных.
+
+    Соединение с базой данных берется из пула только при промахе кэша. Ошибки Redis не мешают
+    получить профиль из базы данных.
+
+    :param uid: UID пользователя.
+    :return: Словарь с именем, полом, возрастом и предпочтениями пользователя или None, если пользователь не найден.
+    """
+    profile = profile_cache.get(uid)
+    if profile is not None:
+        profile_cache_stats['hits'] += 1
+        return profile
+
+    if redis_client is not None:
+        try:
+            raw = await redis_client.get(f"profile:{uid}")
+        except Exception as e:
+            logger.error(f"Ошибка чтения профиля из Redis: {e}")
+            raw = None
+        if raw is not None:
+            profile_cache_stats['shared_hits'] += 1
+            profile = json.loads(raw)
+            profile_cache[uid] = profile
+            return profile
+
+    profile_cache_stats['misses'] += 1
+    async with db_connection() as db:
+        user = await fetch_user(db, 'profile_by_uid', uid)
+    if user is None:
+        return None
+    profile = dict(user)
+    profile_cache[uid] = profile
+    if redis_client is not None:
+        try:
+            await redis_client.set(f"profile:{uid}", json.dumps(profile), ex=PROFILE_CACHE_TTL)
+        except Exception as e:
+            logger.error(f"Ошибка записи профиля в Redis: {e}")
+    return profile
+
+
+async def get_profiles(uids: List[str]) -> dict:
+    """
+    Получает профили нескольких пользователей: из кэша процесса, затем из Redis и одним запросом из базы данных.
+
+    :param uids: UID пользователей без повторов.
+    :return: Словарь профилей по uid; ненайденные пользователи отсутствуют.
+    """
+    profiles = {}
+    missing = []
+    for uid in uids:
+        profile = profile_cache.get(uid)
+        if profile is not None:
+            profile_cache_stats['hits'] += 1
+            profiles[uid] = profile
+        else:
+            missing.append(uid)
+
+    if missing and redis_client is not None:
+        try:
+            values = await redis_client.mget([f"profile:{uid}" for uid in missing])
+        except Exception as e:
+            logger.error(f"Ошибка чтения профилей из Redis: {e}")
+            values = [None] * len(missing)
+        for uid, raw in zip(missing, values):
+            if raw is not None:
+                profile_cache_stats['shared_hits'] += 1
+                profiles[uid] = profile_cache[uid] = json.loads(raw)
+        missing = [uid for uid in missing if uid not in profiles]
+
+    if not missing:
+        return profiles
+    profile_cache_stats['misses'] += len(missing)
+    async with db_connection() as db:
+        rows = await db.fetch(USER_QUERIES['profiles_by_uids'], missing)
+    loaded = {}
+    for row in rows:
+        profile = dict(row)
+        uid = profile.pop('uid')
+        profiles[uid] = profile_cache[uid] = loaded[f"profile:{uid}"] = profile
+    if loaded and redis_client is not None:
+        try:
+            pipe = redis_client.pipeline()
+            for key, profile in loaded.items():
+                pipe.set(key, json.dumps(profile), ex=PROFILE_CACHE_TTL)
+            await pipe.execute()
+        except Exception as e:
+            logger.error(f"Ошибка записи профилей в Redis: {e}")
+    return profiles
+
+
+async def refresh_revoked_jtis():
+    """
+    Загружает идентификаторы отозванных и еще не истекших токенов.
+
+    При ошибке сохраняется ранее загруженный список.
+    """
+    global revoked_jtis
+    try:
+        async with db_pool.acquire(timeout=DB_POOL_ACQUIRE_TIMEOUT) as connection:
+            rows = await connection.fetch(SESSION_QUERIES['revoked_jtis'])
+        revoked_jtis = {row['jti'] for row in rows}
+    except Exception as e:
+        logger.error(f"Ошибка загрузки отозванных токенов: {e}")
+
+
+async def session_monitor():
+    """
+    Фоновая задача, обновляющая список отозванных токенов и удаляющая истекшие сессии.
+    """
+    purged_at = time.monotonic()
+    while True:
+        await asyncio.sleep(REVOKED_TOKENS_REFRESH_INTERVAL)
+        if TOKEN_CHECK_MODE == 'stateless':
+            await refresh_revoked_jtis()
+        if time.monotonic() - purged_at >= SESSION_PURGE_INTERVAL:
+            purged_at = time.monotonic()
+            try:
+                async with db_pool.acquire(timeout=DB_POOL_ACQUIRE_TIMEOUT) as connection:
+                    result = await connection.execute(SESSION_QUERIES['purge_expired'])
+                logger.info(f"Удаление истекших сессий: {result}")
+            except Exception as e:
+                logger.error(f"Ошибка удаления истекших сессий: {e}")
 
 
 class RegistrationRequest(BaseModel):
@@ -78,6 +453,21 @@ class MatchingGetInfo(BaseModel):
     uid: str
 
 
+class UsersBatchRequest(BaseModel):
+    uids: List[str]
+    fields: Optional[List[str]] = None
+
+
+# Поля профиля, которые можно запросить через /users/batch, и соответствующие им столбцы users2
+PROFILE_FIELDS = {
+    'username': 'username',
+    'sex': 'sex',
+    'age': 'age',
+    'preferred_age': 'preffered_age',
+    'preferred_sex': 'preffered_sex',
+}
+
+
 class InvalidTokenValue(Exception):
     pass
 
@@ -86,51 +476,183 @@ def custom_hasher(password: str) -> str:
     """
     Хеширует пароль с использованием SHA-256 и соли.
 
+    Используется только для проверки паролей, сохраненных до перехода на hash_password.
+
     :param password: Пароль для хеширования.
     :return: Хешированный пароль.
     """
-    logger.info("Хеширование пароля")
     salt = PASSWORD_ENCRYPTION_KEY
     return hashlib.sha256((password + salt).encode()).hexdigest()
 
 
+def b64encode(data: bytes) -> str:
+    """Кодирует байты в base64 без символов выравнивания."""
+    return base64.b64encode(data).decode().rstrip('=')
+
+
+def b64decode(data: str) -> bytes:
+    """Декодирует base64 без символов выравнивания."""
+    return base64.b64decode(data + '=' * (-len(data) % 4))
+
+
+def derive_key(password: str, algorithm: str, params: list, salt: bytes) -> bytes:
+    """
+    Вычисляет ключ из пароля указанной функцией с указанными параметрами.
+
+    :param password: Пароль.
+    :param algorithm: 'scrypt' или 'pbkdf2_sha256'.
+    :param params: Параметры стоимости: [n, r, p] для scrypt или [iterations] для PBKDF2.
+    :param salt: Соль.
+    :return: Ключ длиной 32 байта.
+    """
+    if algorithm == 'scrypt':
+        n, r, p = params
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r, dklen=32)
+    return hashlib.pbkdf2_hmac('sha256', password.encode(), salt, params[0], dklen=32)
+
+
+def current_hash_params() -> list:
+    """
+    Возвращает параметры стоимости текущей функции хеширования из конфигурации.
+
+    :return: [n, r, p] для scrypt или [iterations] для PBKDF2.
+    """
+    return [SCRYPT_N, SCRYPT_R, SCRYPT_P] if PASSWORD_KDF == 'scrypt' else [PBKDF2_ITERATIONS]
+
+
+def hash_password(password: str) -> str:
+    """
+    Хеширует пароль текущей функцией хеширования со случайной солью.
+
+    Результат имеет вид '<функция>$<параметры через запятую>$<соль>$<ключ>', поэтому при смене функции
+    или ее стоимости ранее сохраненные пароли продолжают проверяться.
+
+    :param password: Пароль для хеширования.
+    :return: Строка хеша в версионированном формате.
+    """
+    params = current_hash_params()
+    salt = os.urandom(16)
+    key = derive_key(password, PASSWORD_KDF, params, salt)
+    return f"{PASSWORD_KDF}${','.join(map(str, params))}${b64encode(salt)}${b64encode(key)}"
+
+
+def verify_password(password: str, stored_password: str) -> bool:
+    """
+    Проверяет пароль по сохраненному хешу в версионированном или старом формате.
+
+    :param password: Введенный пароль.
+    :param stored_password: Сохраненный хеш.
+    :return: True, если пароль верный.
+    """
+    if '$' not in stored_password:
+        return hmac.compare_digest(stored_password, custom_hasher(password))
+    try:
+        algorithm, params, salt, key = stored_password.split('$')
+        supposed_key = derive_key(password, algorithm, [int(value) for value in params.split(',')], b64decode(salt))
+    except (ValueError, TypeError) as e:
+        logger.error(f"Некорректный формат хеша пароля: {e}")
+        return False
+    return hmac.compare_digest(supposed_key, b64decode(key))
+
+
+def needs_rehash(stored_password: str) -> bool:
+    """
+    Проверяет, сохранен ли пароль старым форматом, другой функцией или с другой стоимостью.
+
+    :param stored_password: Сохраненный хеш.
+    :return: True, если хеш нужно пересчитать при следующем входе.
+    """
+    if '$' not in stored_password:
+        return True
+    algorithm, params = stored_password.split('$')[:2]
+    return algorithm != PASSWORD_KDF or params != ','.join(map(str, current_hash_params()))
+
+
+async def hash_password_async(password: str) -> str:
+    """
+    Хеширует пароль в пуле потоков, не блокируя цикл событий.
+
+    :param password: Пароль для хеширования.
+    :return: Строка хеша в версионированном формате.
+    """
+    logger.info("Хеширование пароля")
+    return await asyncio.get_running_loop().run_in_executor(hash_executor, hash_password, password)
+
+
+async def verify_password_async(password: str, stored_password: str) -> bool:
+    """
+    Проверяет пароль в пуле потоков, не блокируя цикл событий.
+
+    :param password: Введенный пароль.
+    :param stored_password: Сохраненный хеш.
+    :return: True, если пароль верный.
+    """
+    return await asyncio.get_running_loop().run_in_executor(hash_executor, verify_password, password, stored_password)
+
+
 async def uid_generator(db) -> str:
     """
-    Генерирует уникальный идентификатор пользователя.
+    Выдает следующий UID из зарезервированного блока последовательности, резервируя новый блок при исчерпании.
+
+    UID из последовательности не повторяются между экземплярами сервиса, поэтому проверять их в базе данных не нужно.
 
     :param db: Подключение к базе данных.
-    :return: Уникальный идентификатор пользователя.
+    :return: 12-значный идентификатор пользователя.
     """
-    try:
-        while True:
-            created_uid = ''.join(str(random.randint(0, 9)) for _ in range(12))
-            logger.info(f"Сгенерирован UID: {created_uid}")
-            query = "SELECT uid FROM users2 WHERE uid = $1"
-            checker = await db.fetchval(query, created_uid)
-            if not checker:
-                logger.info(f"Уникальный UID подтверждён: {created_uid}")
-                return created_uid
-    except Exception as e:
-        logger.error(f"Ошибка генерации UID: {e}")
-        raise
+    async with uid_allocator['lock']:
+        if uid_allocator['next'] >= uid_allocator['end']:
+            start = await db.fetchval(UID_BLOCK_QUERY)
+            uid_allocator['next'], uid_allocator['end'] = start, start + uid_allocator['block_size']
+            logger.info(f"Зарезервирован блок UID с {start}")
+        uid = uid_allocator['next']
+        uid_allocator['next'] += 1
+    return f"{uid:012d}"
+
+
+async def insert_user(db, user: RegistrationRequest, hashed_password: str, avatar: int) -> Optional[str]:
+    """
+    Добавляет пользователя в users2 одним запросом INSERT ... ON CONFLICT без предварительной проверки email и UID.
+
+    Пустой результат вставки означает, что email уже занят или UID совпал со случайным UID, выданным до перехода
+    на последовательность. Во втором случае вставка повторяется со следующим UID.
+
+    :param db: Подключение к базе данных.
+    :param user: Данные пользователя.
+    :param hashed_password: Хеш пароля.
+    :param avatar: Код аватара.
+    :return: UID нового пользователя или None, если email уже занят.
+    :raises RuntimeError: Если за max_attempts попыток не нашлось свободного UID.
+    """
+    for _ in range(MAX_ATTEMPTS):
+        uid = await uid_generator(db)
+        inserted = await db.fetchval(REGISTER_QUERY, uid, user.email, hashed_password, user.username, user.sex,
+                                     user.age, user.preferred_age, user.preferred_sex, avatar)
+        if inserted is not None:
+            return inserted
+        if await fetch_user(db, 'email_exists', user.email):
+            return None
+        logger.warning(f"UID {uid} уже занят, выдается следующий")
+    raise RuntimeError("Failed to allocate uid")
 
 
-def token_generator(user_data: str, token_type: str) -> str:
+def token_generator(user_data: str, token_type: str, jti: str, expires_at: datetime.datetime) -> str:
     """
     Генерирует JWT токен.
 
     :param user_data: Данные пользователя для включения в токен.
     :param token_type: Тип токена ('access' или 'refresh').
+    :param jti: Идентификатор токена, по которому хранится его сессия.
+    :param expires_at: Момент истечения токена.
     :return: Сгенерированный JWT токен.
     """
     try:
-        lifetime = 96 if token_type == 'refresh' else 12
         logger.info(f"Генерация {token_type} токена для пользователя {user_data}")
         payload = {
-            "iss": 'Random_chats auth service',
+            "iss": TOKEN_ISSUER,
             "token_type": token_type,
             "sub": user_data,
-            "exp": datetime.datetime.utcnow() + datetime.timedelta(hours=lifetime)
+            "jti": jti,
+            "exp": expires_at
         }
         token = jwt.encode(payload, PRIVATE_JWT_KEY, algorithm="HS256")
         return token
@@ -139,6 +661,210 @@ def token_generator(user_data: str, token_type: str) -> str:
         raise
 
 
+async def issue_tokens(db, uid: str, token_types: list) -> dict:
+    """
+    Выдает пользователю токены указанных типов и отзывает ранее выданные токены тех же типов.
+
+    :param db: Подключение к базе данных.
+    :param uid: UID пользователя.
+    :param token_types: Типы выдаваемых токенов.
+    :return: Словарь токенов по типам.
+    """
+    tokens = {}
+    sessions = []
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for token_type in token_types:
+        jti = uuid.uuid4().hex
+        expires_at = now + datetime.timedelta(hours=TOKEN_LIFETIMES[token_type])
+        tokens[token_type] = token_generator(uid, token_type, jti, expires_at)
+        sessions.append((jti, uid, token_type, expires_at))
+    async with db.transaction():
+        await db.execute(SESSION_QUERIES['revoke_by_uid'], uid, token_types)
+        await db.executemany(SESSION_QUERIES['insert'], sessions)
+    return tokens
+
+
+def decode_token(token: str) -> dict:
+    """
+    Проверяет подпись, издателя и срок действия токена.
+
+    :param token: JWT токен.
+    :return: Содержимое токена.
+    :raises jwt.InvalidTokenError: Если токен недействителен.
+    """
+    return jwt.decode(token, PRIVATE_JWT_KEY, algorithms=['HS256'], issuer=TOKEN_ISSUER,
+                      options={'require': ['exp', 'iss', 'sub']})
+
+
+async def session_is_active(db, token: str, payload: dict) -> bool:
+    """
+    Проверяет, что сессия токена не отозвана.
+
+    Токен с jti проверяется одним запросом по первичному ключу таблицы сессий или, в режиме stateless,
+    по загруженному списку отозванных токенов без обращения к базе данных. Токены, выданные до появления
+    сессий, сравниваются со столбцами users2.
+
+    :param db: Подключение к базе данных или None в режиме stateless.
+    :param token: JWT токен.
+    :param payload: Проверенное содержимое токена.
+    :return: True, если сессия активна.
+    """
+    jti = payload.get('jti')
+    if jti is None:
+        user = await fetch_user(db, 'tokens_by_uid', payload['sub'])
+        return user is not None and token in (user['access_token'], user['refresh_token'])
+    if TOKEN_CHECK_MODE == 'stateless':
+        return jti not in revoked_jtis
+    return await db.fetchval(SESSION_QUERIES['is_active'], jti) is not None
+
+
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """
+    Разбивает поток байтов на строки в кодировке UTF-8.
+
+    :param chunks: Асинхронный поток фрагментов тела запроса или файла.
+    :return: Асинхронный поток строк без символов перевода строки.
+    """
+    buffer = b''
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b'\n')
+        for line in lines:
+            yield line.rstrip(b'\r').decode('utf-8')
+    if buffer:
+        yield buffer.rstrip(b'\r').decode('utf-8')
+
+
+def record_import_failure(report: dict, line: int, error: str, email: Optional[str] = None):
+    """
+    Учитывает строку, которую не удалось импортировать.
+
+    В отчет попадают первые import_max_reported_failures ошибок, остальные только подсчитываются.
+
+    :param report: Отчет об импорте.
+    :param line: Номер строки во входных данных.
+    :param error: Описание ошибки.
+    :param email: Email пользователя, если строку удалось разобрать.
+    """
+    report['failed'] += 1
+    if len(report['failures']) < IMPORT_MAX_REPORTED_FAILURES:
+        report['failures'].append({'line': line, 'email': email, 'error': error})
+
+
+async def import_row(db, line: int, user: RegistrationRequest, record: tuple, report: dict):
+    """
+    Записывает одного пользователя из пакета импорта отдельным запросом, чтобы получить ошибку именно этой строки.
+
+    :param db: Подключение к базе данных.
+    :param line: Номер строки во входных данных.
+    :param user: Данные пользователя.
+    :param record: Запись пакета в порядке IMPORT_COLUMNS.
+    :param report: Отчет об импорте.
+    """
+    try:
+        uid = await insert_user(db, user, record[2], record[-1])
+    except (asyncpg.PostgresError, RuntimeError) as e:
+        record_import_failure(report, line, str(e), user.email)
+        return
+    if uid is None:
+        record_import_failure(report, line, "Email is already used", user.email)
+    else:
+        report['imported'] += 1
+
+
+async def import_batch(db, batch: list, report: dict):
+    """
+    Хеширует пароли пакета пользователей в отдельном пуле потоков и записывает пакет в users2 через COPY.
+
+    Строки, пропущенные из-за совпадения UID со старым случайным UID, и все строки пакета, запись которого
+    завершилась ошибкой, записываются по одной, чтобы повторить вставку с новым UID или получить ошибку каждой строки.
+
+    :param db: Подключение к базе данных.
+    :param batch: Список пар (номер строки, данные пользователя).
+    :param report: Отчет об импорте, который дополняется результатами пакета.
+    """
+    loop = asyncio.get_running_loop()
+    hashed_passwords = await asyncio.gather(*(loop.run_in_executor(import_hash_executor, hash_password, user.password)
+                                              for _, user in batch))
+    records = []
+    for (_, user), hashed_password in zip(batch, hashed_passwords):
+        records.append((await uid_generator(db), user.email, hashed_password, user.username, user.sex, user.age,
+                        user.preferred_age, user.preferred_sex, random.randint(0, 100)))
+    try:
+        async with db.transaction():
+            await db.execute(IMPORT_QUERIES['create_staging'])
+            await db.copy_records_to_table('users2_import', records=records, columns=IMPORT_COLUMNS)
+            inserted = {row['email'] for row in await db.fetch(IMPORT_QUERIES['move_staging'])}
+    except asyncpg.PostgresError as e:
+        logger.error(f"Ошибка записи пакета из {len(batch)} пользователей, строки записываются по одной: {e}")
+        for (line, user), record in zip(batch, records):
+            await import_row(db, line, user, record, report)
+        return
+
+    skipped = [user.email for _, user in batch if user.email not in inserted]
+    taken = {row['email'] for row in await db.fetch(IMPORT_QUERIES['existing_emails'], skipped)} if skipped else set()
+    for (line, user), record in zip(batch, records):
+        if user.email in inserted:
+            report['imported'] += 1
+        elif user.email in taken:
+            record_import_failure(report, line, "Email is already used", user.email)
+        else:
+            await import_row(db, line, user, record, report)
+    logger.info(f"Импортирован пакет: {len(inserted)} из {len(batch)} пользователей одним запросом")
+
+
+async def import_users(db, lines: AsyncIterator[str], data_format: str) -> dict:
+    """
+    Импортирует пользователей из потока строк NDJSON или CSV пакетами по import_batch_size.
+
+    Строка NDJSON содержит объект с полями запроса /register, первая строка CSV - заголовок с названиями этих полей.
+    Строки с ошибками пропускаются и попадают в отчет, остальные строки импортируются.
+
+    :param db: Подключение к базе данных.
+    :param lines: Асинхронный поток строк входных данных.
+    :param data_format: Формат данных: ndjson или csv.
+    :return: Отчет с числом импортированных и пропущенных строк и описанием ошибок по номерам строк.
+    """
+    report = {'imported': 0, 'failed': 0, 'failures': []}
+    header = None
+    seen_emails = set()
+    batch = []
+    line_number = 0
+    async for line in lines:
+        line_number += 1
+        if not line.strip():
+            continue
+        try:
+            if data_format == 'csv':
+                values = next(csv.reader([line]))
+                if header is None:
+                    header = values
+                    continue
+                if len(values) != len(header):
+                    raise ValueError(f"Expected {len(header)} columns, got {len(values)}")
+                row = dict(zip(header, values))
+            else:
+                row = json.loads(line)
+                if not isinstance(row, dict):
+                    raise ValueError("Expected JSON object")
+            user = RegistrationRequest(**row)
+        except (ValueError, csv.Error) as e:
+            record_import_failure(report, line_number, str(e))
+            continue
+        if user.email in seen_emails:
+            record_import_failure(report, line_number, "Duplicate email in import", user.email)
+            continue
+        seen_emails.add(user.email)
+        batch.append((line_number, user))
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            await import_batch(db, batch, report)
+            batch = []
+    if batch:
+        await import_batch(db, batch, report)
+    logger.info(f"Импорт завершен: импортировано {report['imported']}, пропущено {report['failed']}")
+    return report
+
+
 @app.post("/register")
 async def registration(request: RegistrationRequest, db=Depends(get_db_connection)):
     """
@@ -150,23 +876,15 @@ async def registration(request: RegistrationRequest, db=Depends(get_db_connectio
     """
     try:
         logger.info(f"Регистрация нового пользователя с email: {request.email}")
-        query = "SELECT email FROM users2 WHERE email = $1"
-        existing_user = await db.fetchval(query, request.email)
-        if existing_user:
+        hashed_password = await hash_password_async(request.password)
+        avatar = random.randint(0, 100)
+        try:
+            uid = await insert_user(db, request, hashed_password, avatar)
+        except RuntimeError as e:
+            raise HTTPException(status_code=500, detail=str(e))
+        if uid is None:
             logger.error(f"Попытка регистрации с существующим email: {request.email}")
             raise HTTPException(status_code=400, detail="Email is already used")
-
-        hashed_password = custom_hasher(request.password)
-        uid = await uid_generator(db)
-        avatar = random.randint(0, 100)
-
-        insert_query = """
-            INSERT INTO users2 (uid, email, password, username, sex, age, preffered_age, preffered_sex, avatar_code, access_token, refresh_token)
-            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)
-        """
-        await db.execute(insert_query, uid, request.email, hashed_password, request.username1, request.sex,
-                         request.age, request.preferred_age, request.preferred_sex, avatar, None, None)
-
         logger.info(f"Пользователь зарегистрирован: {request.email}")
         return {"status": "success", "message": "User registered successfully", "avatar_code": avatar}
     except Exception as e:
@@ -185,28 +903,27 @@ async def login(request: LoginRequest, db=Depends(get_db_connection)):
     """
     try:
         logger.info(f"Авторизация пользователя с email: {request.email}")
-        query = "SELECT * FROM users2 WHERE email = $1"
-        user = await db.fetchrow(query, request.email)
+        user = await fetch_user(db, 'credentials_by_email', request.email)
         if not user:
             logger.error(f"Пользователь не найден: {request.email}")
             raise HTTPException(status_code=400, detail="User not found")
 
         stored_password = user['password']
-        supposed_password = custom_hasher(request.password)
-        if stored_password != supposed_password:
+        if not await verify_password_async(request.password, stored_password):
             logger.error(f"Неправильный пароль для пользователя: {request.email}")
             raise HTTPException(status_code=400, detail="Incorrect password")
 
         uid = user['uid']
-        access_token = token_generator(uid, 'access')
-        refresh_token = token_generator(uid, 'refresh')
-
-        update_query = """
-            UPDATE users2 SET access_token = $1, refresh_token = $2 WHERE uid = $3
-        """
-        await db.execute(update_query, access_token, refresh_token, uid)
+        if needs_rehash(stored_password):
+            logger.info(f"Обновление хеша пароля пользователя: {request.email}")
+            rehashed_password = await hash_password_async(request.password)
+            await db.execute("UPDATE users2 SET password = $1 WHERE uid = $2", rehashed_password, uid)
+        # Токены, выданные до появления таблицы сессий, перестают действовать после нового входа
+        await db.execute("UPDATE users2 SET access_token = NULL, refresh_token = NULL "
+                         "WHERE uid = $1 AND (access_token IS NOT NULL OR refresh_token IS NOT NULL)", uid)
+        tokens = await issue_tokens(db, uid, ['access', 'refresh'])
         logger.info(f"Успешная авторизация пользователя: {request.email}")
-        return {"status": "success", "access_token": access_token, "refresh_token": refresh_token, "uid": uid}
+        return {"status": "success", "access_token": tokens['access'], "refresh_token": tokens['refresh'], "uid": uid}
     except Exception as e:
         logger.error(f"Ошибка авторизации пользователя: {e}")
         raise
@@ -223,16 +940,9 @@ async def authentification(request: TokenAuthentification, db=Depends(get_db_con
     """
     logger.info("Аутентификация пользователя с токеном")
     try:
-        dec_token = jwt.decode(request.token, PRIVATE_JWT_KEY,
-                               algorithms='HS256', options={'verify_iss': True}, issuer='Random_chats auth service')
+        dec_token = decode_token(request.token)
 
-        query = "SELECT * FROM users2 WHERE uid = $1"
-        user = await db.fetchrow(query, dec_token['sub'])
-        if user is None:
-            logger.error("Неверный токен, требуется повторная авторизация")
-            raise HTTPException(status_code=400, detail="Invalid token. Relogin is required")
-
-        if request.token != user['access_token'] and request.token != user['refresh_token']:
+        if not await session_is_active(db, request.token, dec_token):
             logger.error(f"Неизвестный токен для пользователя с uid: {dec_token['sub']}")
             raise InvalidTokenValue('Token is not found')
 
@@ -241,10 +951,8 @@ async def authentification(request: TokenAuthentification, db=Depends(get_db_con
             return {"status": "success", "message": "Access token is up to date"}
 
         if dec_token['token_type'] == 'refresh':
-            uid = user['uid']
-            new_access_token = token_generator(uid, 'access')
-            query = "UPDATE users2 SET access_token = $1 WHERE uid = $2"
-            await db.execute(query, new_access_token, uid)
+            uid = dec_token['sub']
+            new_access_token = (await issue_tokens(db, uid, ['access']))['access']
             logger.info(f"Обновление access токена для пользователя с uid: {uid}")
             return {"status": "success", "message": "New token is sent", "access token": new_access_token}
     except jwt.ExpiredSignatureError:
@@ -253,33 +961,38 @@ async def authentification(request: TokenAuthentification, db=Depends(get_db_con
     except jwt.InvalidIssuerError:
         logger.error("Неверный издатель токена, требуется повторная авторизация")
         raise HTTPException(status_code=400, detail="Invalid issuer. Relogin is required")
-    except InvalidTokenValue:
+    except (InvalidTokenValue, jwt.InvalidTokenError):
         logger.error("Неверный токен, требуется повторная авторизация")
         raise HTTPException(status_code=400, detail="Invalid token. Relogin is required")
 
 
-@app.post("/token_check")
-async def token_validity_check(request: ServiceCheckToken, db=Depends(get_db_connection)):
+async def check_token(token: str, uid: str) -> dict:
     """
-    Проверяет валидность токена.
+    Проверяет валидность токена пользователя.
 
-    :param request: Токен и UID для проверки.
-    :param db: Подключение к базе данных.
+    Подпись и срок действия проверяются без базы данных, соединение из пула берется только для проверки сессии.
+
+    :param token: Токен для проверки.
+    :param uid: UID пользователя, которому должен принадлежать токен.
     :return: Статус валидности токена.
     """
-    logger.info(f"Проверка валидности токена для пользователя с uid: {request.uid}")
+    logger.info(f"Проверка валидности токена для пользователя с uid: {uid}")
     try:
-        query = "SELECT * FROM users2 WHERE uid = $1"
-        user = await db.fetchrow(query, request.uid)
-        if user is None:
-            logger.error(f"Пользователь не найден по uid: {request.uid}")
-            raise HTTPException(status_code=400, detail="User not found")
+        payload = decode_token(token)
+        if payload['sub'] != uid:
+            logger.error(f"Токен выдан другому пользователю, а не {uid}")
+            raise InvalidTokenValue('Invalid token')
 
-        if request.token != user['access_token'] and request.token != user['refresh_token']:
-            logger.error(f"Недействительный токен для пользователя с uid: {request.uid}")
+        if TOKEN_CHECK_MODE == 'stateless' and payload.get('jti'):
+            is_active = await session_is_active(None, token, payload)
+        else:
+            async with db_connection() as db:
+                is_active = await session_is_active(db, token, payload)
+        if not is_active:
+            logger.error(f"Недействительный токен для пользователя с uid: {uid}")
             raise InvalidTokenValue('Invalid token')
 
-        logger.info(f"Токен действителен для пользователя с uid: {request.uid}")
+        logger.info(f"Токен действителен для пользователя с uid: {uid}")
         return {"status": "success", "message": "Token is up to date, user submitted"}
     except jwt.ExpiredSignatureError:
         logger.error("Срок действия токена истек")
@@ -287,24 +1000,78 @@ async def token_validity_check(request: ServiceCheckToken, db=Depends(get_db_con
     except jwt.InvalidIssuerError:
         logger.error("Неверный издатель токена")
         raise HTTPException(status_code=400, detail="Invalid issuer")
-    except InvalidTokenValue:
+    except (InvalidTokenValue, jwt.InvalidTokenError):
         logger.error("Неверный токен")
         raise HTTPException(status_code=400, detail="Invalid token")
 
 
+@app.post("/token_check")
+async def token_validity_check(request: ServiceCheckToken):
+    """
+    Проверяет валидность токена.
+
+    :param request: Токен и UID для проверки.
+    :return: Статус валидности токена.
+    """
+    return await check_token(request.token, request.uid)
+
+
+@app.get("/token_check")
+async def token_validity_check_by_query(token: str, uid: str):
+    """
+    Проверяет валидность токена, переданного в параметрах запроса, как его проксирует API Gateway.
+
+    :param token: Токен для проверки.
+    :param uid: UID пользователя.
+    :return: Статус валидности токена.
+    """
+    return await check_token(token, uid)
+
+
+@app.post("/logout")
+async def logout(request: TokenAuthentification, db=Depends(get_db_connection)):
+    """
+    Отзывает все токены пользователя, которому принадлежит переданный токен.
+
+    :param request: Токен пользователя.
+    :param db: Подключение к базе данных.
+    :return: Статус выхода.
+    """
+    try:
+        payload = decode_token(request.token)
+    except jwt.InvalidTokenError:
+        logger.error("Неверный токен при выходе пользователя")
+        raise HTTPException(status_code=400, detail="Invalid token")
+    if not await session_is_active(db, request.token, payload):
+        raise HTTPException(status_code=400, detail="Invalid token")
+    await db.execute(SESSION_QUERIES['revoke_by_uid'], payload['sub'], ['access', 'refresh'])
+    logger.info(f"Токены пользователя с uid {payload['sub']} отозваны")
+    return {"status": "success", "message": "Tokens are revoked"}
+
+
+@app.get("/revoked_tokens")
+async def get_revoked_tokens(db=Depends(get_db_connection)):
+    """
+    Предоставляет идентификаторы (jti) отозванных, но еще не истекших токенов для локальной проверки в API Gateway.
+
+    :param db: Подключение к базе данных.
+    :return: JSON со списком идентификаторов отозванных токенов.
+    """
+    rows = await db.fetch(SESSION_QUERIES['revoked_jtis'])
+    return {"revoked": [row['jti'] for row in rows]}
+
+
 @app.get("/matching_info")
-async def get_info_by_url(request: MatchingGetInfo, db=Depends(get_db_connection)):
+async def get_info_by_url(request: MatchingGetInfo):
     """
     Получает информацию о пользователе для сервиса Matching.
 
     :param request: UID пользователя.
-    :param db: Подключение к базе данных.
     :return: Информация о пользователе.
     """
     logger.info(f"Получение информации о пользователе для uid: {request.uid}")
     try:
-        query = "SELECT * FROM users2 WHERE uid = $1"
-        user = await db.fetchrow(query, request.uid)
+        user = await get_profile(request.uid)
         if user is None:
             logger.error(f"Пользователь не найден по uid: {request.uid}")
             raise HTTPException(status_code=400, detail="User not found")
@@ -318,19 +1085,17 @@ async def get_info_by_url(request: MatchingGetInfo, db=Depends(get_db_connection
 
 
 @app.get('/get_info_by_id')
-async def get_name(request: MatchingGetInfo, db=Depends(get_db_connection)):
+async def get_name(request: MatchingGetInfo):
     """
     Получает имя пользователя по его UID.
 
     :param request: UID пользователя.
-    :param db: Подключение к базе данных.
     :return: Имя пользователя.
     """
     logger.info(f"Получение имени пользователя для uid: {request.uid}")
 
     try:
-        query = "SELECT * FROM users2 WHERE uid = $1"
-        user = await db.fetchrow(query, request.uid)
+        user = await get_profile(request.uid)
         if user is None:
             logger.error(f"Пользователь не найден по uid: {request.uid}")
             raise HTTPException(status_code=400, detail="User not found")
@@ -342,6 +1107,99 @@ async def get_name(request: MatchingGetInfo, db=Depends(get_db_connection)):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/users/batch")
+async def get_users_batch(request: UsersBatchRequest):
+    """
+    Получает данные нескольких пользователей одним запросом.
+
+    :param request: Список UID (не более batch_max_uids) и необязательный список полей
+        (username, sex, age, preferred_age, preferred_sex; по умолчанию все).
+    :return: JSON с данными найденных пользователей по uid и списком ненайденных UID.
+    :raises HTTPException: 400, если UID слишком много или запрошено неизвестное поле.
+    """
+    uids = list(dict.fromkeys(request.uids))
+    if len(uids) > BATCH_MAX_UIDS:
+        raise HTTPException(status_code=400, detail=f"Too many uids, maximum is {BATCH_MAX_UIDS}")
+    fields = request.fields or list(PROFILE_FIELDS)
+    unknown = [field for field in fields if field not in PROFILE_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+
+    logger.info(f"Получение информации о {len(uids)} пользователях")
+    profiles = await get_profiles(uids)
+    return {
+        "users": {uid: {field: profile[PROFILE_FIELDS[field]] for field in fields} for uid, profile in profiles.items()},
+        "not_found": [uid for uid in uids if uid not in profiles]
+    }
+
+
+@app.post("/users/import")
+async def import_users_endpoint(request: Request, format: str = 'ndjson', x_import_token: Optional[str] = Header(None),
+                                db=Depends(get_db_connection)):
+    """
+    Массово регистрирует пользователей из тела запроса в формате NDJSON или CSV.
+
+    Тело читается потоком, поэтому размер импорта не ограничен памятью сервиса.
+
+    :param request: Запрос с пользователями в теле, по одному на строку.
+    :param format: Формат тела: ndjson или csv.
+    :param x_import_token: Общий секрет импорта из заголовка X-Import-Token.
+    :return: JSON с числом импортированных и пропущенных строк и ошибками по номерам строк.
+    :raises HTTPException: 403, если import_token не задан в конфигурации, 401, если секрет неверный,
+        400, если формат не поддерживается.
+    """
+    if not IMPORT_TOKEN:
+        raise HTTPException(status_code=403, detail="Bulk import is disabled")
+    if not x_import_token or not hmac.compare_digest(x_import_token.encode(), IMPORT_TOKEN.encode()):
+        logger.warning("Попытка массового импорта с неверным секретом")
+        raise HTTPException(status_code=401, detail="Invalid import token")
+    if format not in IMPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format, expected one of: {', '.join(IMPORT_FORMATS)}")
+    logger.info(f"Массовый импорт пользователей в формате {format}")
+    return await import_users(db, iter_lines(request.stream()), format)
+
+
+@app.get("/db_pool_stats")
+async def get_db_pool_stats():
+    """
+    Предоставляет состояние пула соединений с базой данных для мониторинга.
+
+    :return: JSON с размером пула, числом занятых и свободных соединений, числом выдач соединений,
+        средним временем ожидания соединения и числом превышений времени ожидания.
+    """
+    if db_pool is None:
+        raise HTTPException(status_code=503, detail="Database pool is not initialized")
+    size = db_pool.get_size()
+    idle = db_pool.get_idle_size()
+    acquired = db_pool_stats['acquired']
+    return {
+        'min_size': db_pool.get_min_size(),
+        'max_size': db_pool.get_max_size(),
+        'size': size,
+        'in_use': size - idle,
+        'idle': idle,
+        'acquired': acquired,
+        'acquire_timeouts': db_pool_stats['acquire_timeouts'],
+        'avg_acquire_wait': db_pool_stats['acquire_wait_total'] / acquired if acquired else 0.0
+    }
+
+
+@app.get("/profile_cache_stats")
+async def get_profile_cache_stats():
+    """
+    Предоставляет статистику кэша профилей пользователей для мониторинга.
+
+    :return: JSON с числом попаданий в кэш процесса и в Redis, промахов, размером кэша и долей попаданий.
+    """
+    lookups = profile_cache_stats['hits'] + profile_cache_stats['shared_hits'] + profile_cache_stats['misses']
+    return {
+        **profile_cache_stats,
+        'size': profile_cache.currsize,
+        'maxsize': profile_cache.maxsize,
+        'hit_rate': (profile_cache_stats['hits'] + profile_cache_stats['shared_hits']) / lookups if lookups else 0.0
+    }
+
+
 @app.get("/")
 async def health():
     """
@@ -0,0 +1,75 @@
+"""
+Массовый импорт пользователей в Auth Service из файла NDJSON или CSV.
+
+Скрипт подключается к базе данных из config.json напрямую и использует тот же конвейер, что и POST /users/import:
+пароли хешируются в пуле потоков, пользователи записываются в users2 пакетами через COPY.
+
+Запуск из каталога Auth service:
+
+    python import_users.py users.ndjson --hash-workers 8
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator
+
+import asyncpg
+
+import auth
+
+
+async def read_file(path: str, chunk_size: int = 1 << 20) -> AsyncIterator[bytes]:
+    """
+    Читает файл фрагментами.
+
+    :param path: Путь к файлу.
+    :param chunk_size: Размер фрагмента в байтах.
+    :return: Асинхронный поток фрагментов файла.
+    """
+    with open(path, 'rb') as source:
+        while chunk := source.read(chunk_size):
+            yield chunk
+
+
+async def run_import(path: str, data_format: str) -> dict:
+    """
+    Импортирует пользователей из файла в базу данных.
+
+    :param path: Путь к файлу.
+    :param data_format: Формат файла: ndjson или csv.
+    :return: Отчет об импорте.
+    """
+    connection = await asyncpg.connect(
+        user=auth.config['user'],
+        password=auth.config['password'],
+        database=auth.config['database'],
+        host=auth.config['db_host'],
+        port=auth.config['db_port']
+    )
+    try:
+        await auth.prepare_uid_sequence(connection)
+        return await auth.import_users(connection, auth.iter_lines(read_file(path)), data_format)
+    finally:
+        await connection.close()
+        auth.import_hash_executor.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Массовый импорт пользователей в Auth Service")
+    parser.add_argument('path', help="Файл с пользователями, по одному на строку")
+    parser.add_argument('--format', choices=auth.IMPORT_FORMATS,
+                        help="Формат файла, по умолчанию определяется по расширению")
+    parser.add_argument('--batch-size', type=int, default=auth.IMPORT_BATCH_SIZE, help="Число пользователей в пакете COPY")
+    parser.add_argument('--hash-workers', type=int, default=os.cpu_count(), help="Число потоков хеширования паролей")
+    parser.add_argument('--log-level', default='WARNING', help="Уровень логирования во время импорта")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(args.log_level)
+
+    auth.IMPORT_BATCH_SIZE = args.batch_size
+    auth.import_hash_executor = ThreadPoolExecutor(max_workers=args.hash_workers, thread_name_prefix='import-hash')
+    import_format = args.format or ('csv' if args.path.lower().endswith('.csv') else 'ndjson')
+    import_report = asyncio.run(run_import(args.path, import_format))
+    print(json.dumps(import_report, ensure_ascii=False, indent=4))
@@ -0,0 +1,476 @@
+import asyncio
+import json
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import auth
+
+
+class FakePool:
+    def __init__(self, size=2, busy=False):
+        self.size = size
+        self.busy = busy
+        self.in_use = 0
+
+    async def acquire(self, timeout=None):
+        if self.busy:
+            raise asyncio.TimeoutError()
+        self.in_use += 1
+        return object()
+
+    async def release(self, connection):
+        self.in_use -= 1
+
+    def get_size(self):
+        return self.size
+
+    def get_idle_size(self):
+        return self.size - self.in_use
+
+    def get_min_size(self):
+        return 1
+
+    def get_max_size(self):
+        return self.size
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    fake_pool = FakePool()
+    monkeypatch.setattr(auth, 'db_pool', fake_pool)
+    monkeypatch.setattr(auth, 'db_pool_stats', {'acquired': 0, 'acquire_timeouts': 0, 'acquire_wait_total': 0.0})
+    return fake_pool
+
+
+class TestConnectionPool:
+    @pytest.mark.asyncio
+    async def test_connection_is_returned_to_pool(self, pool):
+        dependency = auth.get_db_connection()
+        await dependency.__anext__()
+        assert pool.in_use == 1
+        with pytest.raises(StopAsyncIteration):
+            await dependency.__anext__()
+        assert pool.in_use == 0
+        assert auth.db_pool_stats['acquired'] == 1
+
+    @pytest.mark.asyncio
+    async def test_acquire_timeout_returns_503(self, pool):
+        pool.busy = True
+        with pytest.raises(HTTPException) as error:
+            await auth.get_db_connection().__anext__()
+        assert error.value.status_code == 503
+        assert auth.db_pool_stats['acquire_timeouts'] == 1
+
+    def test_pool_stats(self, pool):
+        pool.in_use = 1
+        response = TestClient(auth.app).get("/db_pool_stats")
+        assert response.status_code == 200
+        assert response.json()['in_use'] == 1
+        assert response.json()['idle'] == 1
+
+
+class FakeConnection:
+    def __init__(self, rows=None, indexed=()):
+        self.rows = rows or {}
+        self.indexed = list(indexed)
+        self.executed = []
+
+    async def fetchrow(self, query, *args):
+        self.executed.append(query)
+        return self.rows.get(args)
+
+    async def fetch(self, query, *args):
+        return [{'attname': column} for column in self.indexed]
+
+    async def execute(self, query, *args):
+        self.executed.append(query)
+
+
+class TestUserQueries:
+    @pytest.mark.asyncio
+    async def test_queries_select_only_needed_columns(self):
+        connection = FakeConnection(rows={("user@example.com",): {'uid': '123456789012', 'password': 'hash'}})
+        user = await auth.fetch_user(connection, 'credentials_by_email', "user@example.com")
+        assert user == {'uid': '123456789012', 'password': 'hash'}
+        assert connection.executed == ["SELECT uid, password FROM users2 WHERE email = $1"]
+        assert all('*' not in query for query in auth.USER_QUERIES.values())
+
+    @pytest.mark.asyncio
+    async def test_missing_unique_index_is_created(self):
+        connection = FakeConnection(indexed=['uid'])
+        await auth.ensure_user_indexes(connection)
+        assert connection.executed == ["CREATE UNIQUE INDEX IF NOT EXISTS users2_email_key ON users2 (email)"]
+
+
+class TestPasswordHashing:
+    def test_hash_is_versioned_and_salted(self):
+        first = auth.hash_password("password")
+        second = auth.hash_password("password")
+        assert first.startswith(f"{auth.PASSWORD_KDF}$")
+        assert first != second
+        assert auth.verify_password("password", first)
+        assert not auth.verify_password("wrong", first)
+        assert not auth.needs_rehash(first)
+
+    def test_legacy_hash_is_verified_and_marked_for_upgrade(self):
+        legacy = auth.custom_hasher("password")
+        assert auth.verify_password("password", legacy)
+        assert not auth.verify_password("wrong", legacy)
+        assert auth.needs_rehash(legacy)
+
+    def test_cost_change_requires_rehash(self, monkeypatch):
+        monkeypatch.setattr(auth, 'PASSWORD_KDF', 'pbkdf2_sha256')
+        monkeypatch.setattr(auth, 'PBKDF2_ITERATIONS', 1000)
+        stored = auth.hash_password("password")
+        monkeypatch.setattr(auth, 'PBKDF2_ITERATIONS', 2000)
+        assert auth.verify_password("password", stored)
+        assert auth.needs_rehash(stored)
+
+    @pytest.mark.asyncio
+    async def test_hashing_runs_off_event_loop(self):
+        stored = await auth.hash_password_async("password")
+        assert await auth.verify_password_async("password", stored)
+
+
+class FakeSessionConnection:
+    def __init__(self):
+        self.sessions = {}
+        self.revoked = []
+
+    def transaction(self):
+        connection = self
+
+        class Transaction:
+            async def __aenter__(self):
+                return connection
+
+            async def __aexit__(self, *args):
+                return False
+
+        return Transaction()
+
+    async def execute(self, query, *args):
+        self.revoked.append(args)
+
+    async def executemany(self, query, rows):
+        for jti, uid, token_type, expires_at in rows:
+            self.sessions[jti] = uid
+
+    async def fetchval(self, query, jti):
+        return 1 if jti in self.sessions else None
+
+
+class TestSessions:
+    @pytest.mark.asyncio
+    async def test_tokens_carry_session_ids(self):
+        connection = FakeSessionConnection()
+        tokens = await auth.issue_tokens(connection, "123456789012", ['access', 'refresh'])
+        payloads = {token_type: auth.decode_token(token) for token_type, token in tokens.items()}
+        assert set(connection.sessions) == {payload['jti'] for payload in payloads.values()}
+        assert payloads['refresh']['token_type'] == 'refresh'
+        assert connection.revoked == [("123456789012", ['access', 'refresh'])]
+        assert await auth.session_is_active(connection, tokens['access'], payloads['access'])
+
+    @pytest.mark.asyncio
+    async def test_stateless_check_does_not_touch_database(self, monkeypatch):
+        connection = FakeSessionConnection()
+        token = (await auth.issue_tokens(connection, "123456789012", ['access']))['access']
+        monkeypatch.setattr(auth, 'TOKEN_CHECK_MODE', 'stateless')
+        monkeypatch.setattr(auth, 'db_pool', None)
+        monkeypatch.setattr(auth, 'revoked_jtis', set())
+        assert (await auth.check_token(token, "123456789012"))['status'] == "success"
+
+        monkeypatch.setattr(auth, 'revoked_jtis', {auth.decode_token(token)['jti']})
+        with pytest.raises(HTTPException):
+            await auth.check_token(token, "123456789012")
+
+    @pytest.mark.asyncio
+    async def test_token_of_other_user_is_rejected(self, monkeypatch):
+        token = (await auth.issue_tokens(FakeSessionConnection(), "123456789012", ['access']))['access']
+        with pytest.raises(HTTPException):
+            await auth.check_token(token, "210987654321")
+
+
+class ProfilePool(FakePool):
+    def __init__(self, rows):
+        super().__init__()
+        self.connection = FakeConnection(rows=rows)
+
+    async def acquire(self, timeout=None):
+        await super().acquire(timeout)
+        return self.connection
+
+
+class TestProfileCache:
+    @pytest.fixture
+    def profiles(self, monkeypatch):
+        profile = {'username': 'user', 'sex': 'male', 'age': 20, 'preffered_age': '18-25', 'preffered_sex': 'female'}
+        pool = ProfilePool({("123456789012",): profile})
+        monkeypatch.setattr(auth, 'db_pool', pool)
+        monkeypatch.setattr(auth, 'profile_cache', auth.TTLCache(maxsize=10, ttl=60))
+        monkeypatch.setattr(auth, 'profile_cache_stats', {'hits': 0, 'shared_hits': 0, 'misses': 0})
+        return pool
+
+    def test_repeated_lookups_hit_cache(self, profiles):
+        client = TestClient(auth.app)
+        first = client.request("GET", "/matching_info", json={"uid": "123456789012"})
+        second = client.request("GET", "/get_info_by_id", json={"uid": "123456789012"})
+        assert first.json()['preferred_sex'] == "female"
+        assert second.json() == {"username": "user"}
+        assert len(profiles.connection.executed) == 1
+        assert client.get("/profile_cache_stats").json()['hit_rate'] == 0.5
+
+    @pytest.mark.asyncio
+    async def test_expired_profile_is_reloaded(self, profiles, monkeypatch):
+        now = [0.0]
+        monkeypatch.setattr(auth, 'profile_cache', auth.TTLCache(maxsize=10, ttl=60, timer=lambda: now[0]))
+        await auth.get_profile("123456789012")
+        now[0] = 61.0
+        await auth.get_profile("123456789012")
+        assert len(profiles.connection.executed) == 2
+
+
+class BatchConnection:
+    def __init__(self, profiles):
+        self.profiles = profiles
+        self.queries = []
+
+    async def fetch(self, query, uids):
+        self.queries.append((query, list(uids)))
+        return [{'uid': uid, **self.profiles[uid]} for uid in uids if uid in self.profiles]
+
+
+class TestUsersBatch:
+    @pytest.fixture
+    def batch(self, monkeypatch):
+        profiles = {
+            uid: {'username': f"user{uid[-1]}", 'sex': 'male', 'age': 20, 'preffered_age': '18-25',
+                  'preffered_sex': 'female'}
+            for uid in ("100000000001", "100000000002", "100000000003")
+        }
+        pool = ProfilePool({})
+        pool.connection = BatchConnection(profiles)
+        monkeypatch.setattr(auth, 'db_pool', pool)
+        monkeypatch.setattr(auth, 'profile_cache', auth.TTLCache(maxsize=10, ttl=60))
+        monkeypatch.setattr(auth, 'profile_cache_stats', {'hits': 0, 'shared_hits': 0, 'misses': 0})
+        return pool.connection
+
+    def test_batch_uses_one_query_and_cache(self, batch):
+        auth.profile_cache["100000000001"] = {'username': 'cached', 'sex': 'male', 'age': 20,
+                                              'preffered_age': '18-25', 'preffered_sex': 'female'}
+        response = TestClient(auth.app).post("/users/batch", json={
+            "uids": ["100000000001", "100000000002", "100000000003", "999999999999", "100000000002"],
+            "fields": ["username"]
+        })
+        assert response.status_code == 200
+        assert response.json() == {
+            "users": {"100000000001": {"username": "cached"}, "100000000002": {"username": "user2"},
+                      "100000000003": {"username": "user3"}},
+            "not_found": ["999999999999"]
+        }
+        assert len(batch.queries) == 1
+        assert "ANY($1" in batch.queries[0][0]
+        assert batch.queries[0][1] == ["100000000002", "100000000003", "999999999999"]
+
+    def test_batch_limits(self, batch, monkeypatch):
+        monkeypatch.setattr(auth, 'BATCH_MAX_UIDS', 2)
+        client = TestClient(auth.app)
+        assert client.post("/users/batch", json={"uids": ["1", "2", "3"]}).status_code == 400
+        assert client.post("/users/batch", json={"uids": ["1"], "fields": ["password"]}).status_code == 400
+
+
+class RegisterConnection:
+    def __init__(self, taken_uids=(), emails=()):
+        self.taken_uids = set(taken_uids)
+        self.emails = set(emails)
+        self.blocks = 0
+        self.inserts = []
+
+    async def fetchval(self, query, *args):
+        if query == auth.UID_BLOCK_QUERY:
+            self.blocks += 1
+            return 100000000000 + (self.blocks - 1) * 100
+        self.inserts.append(args)
+        uid, email = args[0], args[1]
+        if uid in self.taken_uids or email in self.emails:
+            return None
+        self.taken_uids.add(uid)
+        self.emails.add(email)
+        return uid
+
+    async def fetchrow(self, query, *args):
+        return {'?column?': 1} if args[0] in self.emails else None
+
+
+class TestRegistration:
+    @pytest.fixture
+    def registration(self, monkeypatch):
+        connection = RegisterConnection(taken_uids={"100000000001"})
+        monkeypatch.setattr(auth, 'uid_allocator', {'next': 0, 'end': 0, 'block_size': 100, 'lock': asyncio.Lock()})
+        monkeypatch.setattr(auth, 'PASSWORD_KDF', 'pbkdf2_sha256')
+        monkeypatch.setattr(auth, 'PBKDF2_ITERATIONS', 1000)
+        auth.app.dependency_overrides[auth.get_db_connection] = lambda: connection
+        yield connection
+        auth.app.dependency_overrides.clear()
+
+    @staticmethod
+    def register(email):
+        return TestClient(auth.app).post("/register", json={
+            "email": email, "username": "user", "password": "password", "sex": "male", "age": 20,
+            "preferred_age": "18-25", "preferred_sex": "female"
+        })
+
+    @pytest.mark.asyncio
+    async def test_uids_come_from_reserved_blocks(self, registration):
+        uids = [await auth.uid_generator(registration) for _ in range(101)]
+        assert len(set(uids)) == len(uids)
+        assert all(len(uid) == 12 for uid in uids)
+        assert registration.blocks == 2
+
+    @pytest.mark.asyncio
+    async def test_block_size_comes_from_sequence(self, registration):
+        class SequenceConnection:
+            def __init__(self):
+                self.queries = []
+
+            async def execute(self, query):
+                self.queries.append(query)
+
+            async def fetchval(self, query):
+                return 40
+
+        connection = SequenceConnection()
+        await auth.prepare_uid_sequence(connection)
+        assert auth.uid_allocator['block_size'] == 40
+        assert not any("ALTER" in query for query in connection.queries)
+
+    def test_register_is_single_insert(self, registration):
+        assert self.register("first@example.com").status_code == 200
+        assert len(registration.inserts) == 1
+        assert registration.inserts[0][3] == "user"
+
+    def test_uid_collision_is_retried(self, registration):
+        self.register("first@example.com")
+        assert self.register("second@example.com").status_code == 200
+        assert [args[0] for args in registration.inserts] == ["100000000000", "100000000001", "100000000002"]
+
+    def test_duplicate_email_is_rejected(self, registration):
+        self.register("first@example.com")
+        response = self.register("first@example.com")
+        assert response.status_code == 400
+        assert response.json()['detail'] == "Email is already used"
+
+
+class ImportConnection(RegisterConnection):
+    def __init__(self, emails=(), taken_uids=(), failing_email=None):
+        super().__init__(taken_uids=taken_uids, emails=emails)
+        self.failing_email = failing_email
+        self.copies = []
+
+    def transaction(self):
+        class Transaction:
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, *args):
+                return False
+
+        return Transaction()
+
+    async def execute(self, query, *args):
+        return "CREATE TABLE"
+
+    async def copy_records_to_table(self, table, records, columns):
+        self.copies.append(list(records))
+        if any(record[1] == self.failing_email for record in records):
+            raise auth.asyncpg.StringDataRightTruncationError("value too long")
+
+    async def fetchval(self, query, *args):
+        if query == auth.REGISTER_QUERY and args[1] == self.failing_email:
+            raise auth.asyncpg.StringDataRightTruncationError("value too long")
+        return await super().fetchval(query, *args)
+
+    async def fetch(self, query, *args):
+        if query == auth.IMPORT_QUERIES['existing_emails']:
+            return [{'email': email} for email in args[0] if email in self.emails]
+        inserted = [record[1] for record in self.copies[-1]
+                    if record[1] not in self.emails and record[0] not in self.taken_uids]
+        self.emails.update(inserted)
+        self.taken_uids.update(record[0] for record in self.copies[-1] if record[1] in inserted)
+        return [{'email': email} for email in inserted]
+
+
+class TestUsersImport:
+    USER = {"username": "user", "password": "password", "sex": "male", "age": 20,
+            "preferred_age": "18-25", "preferred_sex": "female"}
+
+    @pytest.fixture
+    def importer(self, monkeypatch):
+        connection = ImportConnection(emails={"taken@example.com"}, taken_uids={"100000000001"},
+                                      failing_email="long@example.com")
+        monkeypatch.setattr(auth, 'IMPORT_TOKEN', "secret")
+        # Импорт не должен занимать пул хеширования входа и регистрации
+        closed_executor = auth.ThreadPoolExecutor(max_workers=1)
+        closed_executor.shutdown()
+        monkeypatch.setattr(auth, 'hash_executor', closed_executor)
+        monkeypatch.setattr(auth, 'uid_allocator', {'next': 0, 'end': 0, 'block_size': 100, 'lock': asyncio.Lock()})
+        monkeypatch.setattr(auth, 'PASSWORD_KDF', 'pbkdf2_sha256')
+        monkeypatch.setattr(auth, 'PBKDF2_ITERATIONS', 1000)
+        monkeypatch.setattr(auth, 'IMPORT_BATCH_SIZE', 2)
+        auth.app.dependency_overrides[auth.get_db_connection] = lambda: connection
+        yield connection
+        auth.app.dependency_overrides.clear()
+
+    def test_ndjson_import_reports_failed_lines(self, importer):
+        lines = [
+            json.dumps({"email": "a@example.com", **self.USER}),
+            "not json",
+            json.dumps({"email": "taken@example.com", **self.USER}),
+            json.dumps({"email": "a@example.com", **self.USER}),
+            json.dumps({"email": "b@example.com", **self.USER}),
+        ]
+        response = self.client().post("/users/import", content="\n".join(lines))
+        report = response.json()
+        assert report['imported'] == 2
+        assert [(failure['line'], failure['email'], failure['error']) for failure in report['failures']] == [
+            (2, None, "Expecting value: line 1 column 1 (char 0)"),
+            (3, "taken@example.com", "Email is already used"),
+            (4, "a@example.com", "Duplicate email in import"),
+        ]
+        assert [len(copy) for copy in importer.copies] == [2, 1]
+        assert all(record[2].startswith("pbkdf2_sha256$") for copy in importer.copies for record in copy)
+
+    def test_csv_import(self, importer):
+        header = "email,username,password,sex,age,preferred_age,preferred_sex"
+        body = f"{header}\r\nc@example.com,user,password,male,20,18-25,female\r\nd@example.com,user\r\n"
+        report = self.client().post("/users/import?format=csv", content=body).json()
+        assert report['imported'] == 1
+        assert report['failures'][0]['line'] == 3
+
+    def test_unknown_format_is_rejected(self, importer):
+        assert self.client().post("/users/import?format=xml", content="").status_code == 400
+
+    def test_import_requires_secret(self, importer, monkeypatch):
+        client = TestClient(auth.app)
+        assert client.post("/users/import", content="").status_code == 401
+        assert client.post("/users/import", content="", headers={"X-Import-Token": "wrong"}).status_code == 401
+        monkeypatch.setattr(auth, 'IMPORT_TOKEN', None)
+        assert self.client().post("/users/import", content="").status_code == 403
+
+    def test_uid_collision_is_retried_with_new_uid(self, importer):
+        lines = [json.dumps({"email": f"{name}@example.com", **self.USER}) for name in ("c", "d")]
+        report = self.client().post("/users/import", content="\n".join(lines)).json()
+        assert report == {'imported': 2, 'failed': 0, 'failures': []}
+        assert {"c@example.com", "d@example.com"} <= importer.emails
+
+    def test_failed_batch_is_reported_per_row(self, importer):
+        lines = [json.dumps({"email": f"{name}@example.com", **self.USER}) for name in ("e", "long")]
+        report = self.client().post("/users/import", content="\n".join(lines)).json()
+        assert report['imported'] == 1
+        assert [(failure['line'], failure['email']) for failure in report['failures']] == [(2, "long@example.com")]
+        assert "e@example.com" in importer.emails
+
+    @staticmethod
+    def client():
+        return TestClient(auth.app, headers={"X-Import-Token": "secret"})
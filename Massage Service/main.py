@@ -1,6 +1,8 @@
 import os
+import time
+import random
 import logging
-from typing import List, Optional
+from typing import Dict, List, Optional
 from datetime import datetime
 from fastapi import FastAPI, HTTPException
 from bson import ObjectId
@@ -48,6 +50,9 @@ logger = logging.getLogger(SERVICE_NAME)
 
 http_client = httpx.AsyncClient()
 
+# Кэш ответа /discovery API Gateway: ETag, момент устаревания и живые экземпляры по сервисам
+discovery_cache = {'etag': None, 'expires_at': 0.0, 'services': {}}
+
 
 def validate_object_id(id_str: str, name: str) -> ObjectId:
     try:
@@ -56,9 +61,32 @@ def validate_object_id(id_str: str, name: str) -> ObjectId:
         raise HTTPException(status_code=422, detail=f"Invalid {name}: {id_str}")
 
 
+async def get_service_instances(client: httpx.AsyncClient, service_name: str) -> List[Dict]:
+    """
+    Получает живые экземпляры сервиса из API Gateway, кэшируя ответ /discovery на время max-age.
+
+    :param client: HTTP клиент.
+    :param service_name: Название сервиса.
+    :return: Список экземпляров сервиса, возможно пустой.
+    """
+    if time.monotonic() >= discovery_cache['expires_at']:
+        headers = {'If-None-Match': discovery_cache['etag']} if discovery_cache['etag'] else {}
+        response = await client.get(f"{API_GATEWAY_URL}/discovery", headers=headers)
+        if response.status_code == 200:
+            discovery_cache['services'] = response.json().get('services', {})
+            discovery_cache['etag'] = response.headers.get('etag')
+        elif response.status_code != 304:
+            logger.error(f"Не удалось получить экземпляры сервисов из API Gateway: {response.text}")
+            return discovery_cache['services'].get(service_name, [])
+        cache_control = response.headers.get('cache-control', '')
+        max_age = int(cache_control.split('max-age=')[1]) if 'max-age=' in cache_control else 0
+        discovery_cache['expires_at'] = time.monotonic() + max_age
+    return discovery_cache['services'].get(service_name, [])
+
+
 async def request_with_retry(method: str, service_name: str, path: str, **kwargs) -> Optional[httpx.Response]:
     """
-    Выполняет HTTP запрос к сервису с повторными попытками и обновлением URL из API Gateway.
+    Выполняет HTTP запрос к сервису с повторными попытками, выбирая экземпляры из кэша /discovery API Gateway.
 
     :param method: HTTP метод ('GET', 'POST', 'PUT', 'DELETE').
     :param service_name: Название сервиса.
@@ -67,14 +95,13 @@ async def request_with_retry(method: str, service_name: str, path: str, **kwargs
     :return: Ответ httpx.Response или None.
     """
     attempts = 0
+    offset = random.randrange(1 << 16)
     while attempts < MAX_ATTEMPTS:
-        url = f"{API_GATEWAY_URL}/get_service_instance?service_name={service_name}"
         try:
-            response = await http_client.get(url)
-            if response.status_code == 200:
-                instance = response.json().get('instance')
-                service_url = instance['url']
-                full_url = f"{service_url}{path}"
+            instances = await get_service_instances(http_client, service_name)
+            if instances:
+                instance = instances[(offset + attempts) % len(instances)]
+                full_url = f"{instance['url']}{path}"
                 response = await http_client.request(method, full_url, **kwargs)
                 if response.status_code == 200:
                     return response
@@ -82,10 +109,12 @@ async def request_with_retry(method: str, service_name: str, path: str, **kwargs
                     logger.error(f"Ошибка при обращении к {service_name}: {response.status_code} {response.text}")
                     attempts += 1
             else:
-                logger.error(f"Не удалось получить экземпляр {service_name} из API Gateway: {response.text}")
+                logger.error(f"Не удалось получить экземпляр {service_name} из API Gateway")
+                discovery_cache['expires_at'] = 0.0
                 attempts += 1
         except Exception as e:
             logger.error(f"Исключение при обращении к {service_name}: {e}")
+            discovery_cache['expires_at'] = 0.0
             attempts += 1
     logger.error(f"Не удалось связаться с {service_name} после {MAX_ATTEMPTS} попыток")
     return None
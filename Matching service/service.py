@@ -4,7 +4,9 @@ from fastapi import FastAPI, HTTPException
 import httpx
 import redis.asyncio as redis
 import json
-from typing import List, Optional
+import time
+import random
+from typing import Dict, List, Optional
 
 import logging
 from fastapi.responses import HTMLResponse
@@ -31,6 +33,9 @@ logger = logging.getLogger("Matching Service")
 API_GATEWAY_URL = config.get('api_gateway_url', 'http://localhost:8500')
 MAX_ATTEMPTS = config.get('max_attempts', 5)
 
+# Кэш ответа /discovery API Gateway: ETag, момент устаревания и живые экземпляры по сервисам
+discovery_cache = {'etag': None, 'expires_at': 0.0, 'services': {}}
+
 
 class CreateRequest(BaseModel):
     uid: str
@@ -70,9 +75,32 @@ async def add_user_to_queue(uid: str, queue_key: str) -> bool:
 
 
 
+async def get_service_instances(client: httpx.AsyncClient, service_name: str) -> List[Dict]:
+    """
+    Получает живые экземпляры сервиса из API Gateway, кэшируя ответ /discovery на время max-age.
+
+    :param client: HTTP клиент.
+    :param service_name: Название сервиса.
+    :return: Список экземпляров сервиса, возможно пустой.
+    """
+    if time.monotonic() >= discovery_cache['expires_at']:
+        headers = {'If-None-Match': discovery_cache['etag']} if discovery_cache['etag'] else {}
+        response = await client.get(f"{API_GATEWAY_URL}/discovery", headers=headers)
+        if response.status_code == 200:
+            discovery_cache['services'] = response.json().get('services', {})
+            discovery_cache['etag'] = response.headers.get('etag')
+        elif response.status_code != 304:
+            logger.warning(f"Не удалось получить экземпляры сервисов из API Gateway: статус код {response.status_code}")
+            return discovery_cache['services'].get(service_name, [])
+        cache_control = response.headers.get('cache-control', '')
+        max_age = int(cache_control.split('max-age=')[1]) if 'max-age=' in cache_control else 0
+        discovery_cache['expires_at'] = time.monotonic() + max_age
+    return discovery_cache['services'].get(service_name, [])
+
+
 async def request_with_retry(method: str, service_name: str, path: str, **kwargs) -> Optional[httpx.Response]:
     """
-    Выполняет HTTP запрос к сервису с повторными попытками и обновлением URL из API Gateway.
+    Выполняет HTTP запрос к сервису с повторными попытками, выбирая экземпляры из кэша /discovery API Gateway.
 
     :param method: HTTP метод ('GET', 'POST', 'PUT', 'DELETE').
     :param service_name: Название сервиса.
@@ -81,16 +109,15 @@ async def request_with_retry(method: str, service_name: str, path: str, **kwargs
     :return: Ответ httpx.Response или None.
     """
     attempts = 0
+    offset = random.randrange(1 << 16)
     while attempts < MAX_ATTEMPTS:
-        url = f"{API_GATEWAY_URL}/get_service_instance?service_name={service_name}"
         try:
             logger.info(f"Попытка обращения к {service_name}: {attempts + 1}")
             async with httpx.AsyncClient() as client:
-                response = await client.get(url)
-                if response.status_code == 200:
-                    instance = response.json().get('instance')
-                    service_url = instance['url']
-                    full_url = f"{service_url}{path}"
+                instances = await get_service_instances(client, service_name)
+                if instances:
+                    instance = instances[(offset + attempts) % len(instances)]
+                    full_url = f"{instance['url']}{path}"
                     response = await client.request(method, full_url, **kwargs)
                     if response.status_code == 200:
                         logger.info(f"Успешный запрос для {service_name} на {full_url}")
@@ -99,10 +126,12 @@ async def request_with_retry(method: str, service_name: str, path: str, **kwargs
                         logger.warning(f"Неудачный ответ от сервиса {service_name}: {response.status_code}")
                         attempts += 1
                 else:
-                    logger.warning(f"Не удалось получить URL сервиса {service_name}: статус код {response.status_code}")
+                    logger.warning(f"Не удалось получить URL сервиса {service_name}")
+                    discovery_cache['expires_at'] = 0.0
                     attempts += 1
         except Exception as e:
             logger.error(f"Ошибка при обращении к сервису {service_name}: попытка {attempts + 1} - {e}")
+            discovery_cache['expires_at'] = 0.0
             attempts += 1
     logger.error(f"Не удалось связаться с {service_name} после {MAX_ATTEMPTS} попыток")
     raise HTTPException(status_code=503, detail=f"Не удалось связаться с {service_name} после {MAX_ATTEMPTS} попыток")